@@ -0,0 +1,9 @@
+import pytest
+
+from vrpc import fsb_queue
+
+
+@pytest.fixture
+def queue_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(fsb_queue, "get_queue_base_folder", lambda: str(tmp_path) + "/")
+    return tmp_path
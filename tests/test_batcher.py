@@ -0,0 +1,50 @@
+import numpy as np
+
+from vrpc.batcher import FaceChipBatcher
+from vrpc.data_models.converter import get_ocvmat_from_mat
+from vrpc.data_models.data import ObjectInfo
+from vrpc.fsb_queue import FsbQueueConsumer, FsbQueueProducer
+
+
+def make_object_info(i, face_chip_shape=(150, 120, 3)):
+    return ObjectInfo(face_chip=get_ocvmat_from_mat(np.full(face_chip_shape, i, dtype=np.uint8)),
+                      extended_face_chip=get_ocvmat_from_mat(np.full((112, 112, 1), i, dtype=np.uint8)))
+
+
+def test_batches_reuse_the_buffer():
+    batcher = FaceChipBatcher(4, {"face_chip": (112, 112, 3), "extended_face_chip": (64, 64, 1)})
+    batches = []
+    for i in range(10):
+        batch = batcher.add(f"ch{i % 2}", make_object_info(i))
+        if batch is not None:
+            batches.append((batch, batch.images["face_chip"].copy(), batch.images["extended_face_chip"].copy()))
+    batches.append((batcher.flush(), None, None))
+    assert [len(batch) for batch, _, _ in batches] == [4, 4, 2]
+    assert batcher.flush() is None
+    assert np.shares_memory(batches[0][0].images["face_chip"], batches[1][0].images["face_chip"])
+    for b, (batch, face_chips, extended_face_chips) in enumerate(batches[:2]):
+        assert face_chips.shape == (4, 112, 112, 3) and extended_face_chips.shape == (4, 64, 64, 1)
+        for row, (channel_id, object_info) in enumerate(batch.items):
+            assert (face_chips[row] == b * 4 + row).all() and (extended_face_chips[row] == b * 4 + row).all()
+    assert (batches[2][0].images["face_chip"][1] == 9).all()
+
+
+def test_mismatching_chip_is_dropped():
+    batcher = FaceChipBatcher(2)
+    assert batcher.add("ch1", make_object_info(1, (112, 112, 1))) is None
+    assert batcher.add("ch1", ObjectInfo()) is None
+    assert batcher.flush() is None
+
+
+def test_collect(queue_folder):
+    producer = FsbQueueProducer(0, "ch1")
+    producer.put_many([make_object_info(i) for i in range(5)])
+    consumer = FsbQueueConsumer(0)
+    consumer.glob_directory()
+    batcher = FaceChipBatcher(4)
+    first = batcher.collect(consumer, timeout=2.0)
+    second = batcher.collect(consumer, timeout=0.2)
+    consumer.stop()
+    producer.stop()
+    assert len(first) == 4 and len(second) == 1
+    assert [object_info.message_id for _, object_info in first.items + second.items] == [1, 2, 3, 4, 5]
@@ -0,0 +1,71 @@
+import collections
+import threading
+import time
+
+from vrpc.consumer import Consumer
+from vrpc.data_models.data import ObjectInfo
+from vrpc.fsb_queue import FsbQueueConsumer, FsbQueueProducer
+
+
+def test_channels_are_pinned_to_workers(queue_folder):
+    handled = collections.defaultdict(list)
+    threads = collections.defaultdict(set)
+    lock = threading.Lock()
+
+    def handler(channel_id, item):
+        with lock:
+            handled[channel_id].append(item.message_id)
+            threads[channel_id].add(threading.current_thread().name)
+
+    producers = [FsbQueueProducer(0, f"ch{i}") for i in range(6)]
+    consumer = Consumer(0, workers=3, handler=handler)
+    consumer.start()
+    for _ in range(5):
+        for producer in producers:
+            producer.put_many([ObjectInfo(gender="M") for _ in range(10)])
+    start = time.monotonic()
+    stats = consumer.stats()
+    while sum(s.processed for s in stats) < 300 and time.monotonic() - start < 5.0:
+        time.sleep(0.05)
+        stats = consumer.stats()
+    consumer.stop()
+    consumer.join()
+    for producer in producers:
+        producer.stop()
+    assert sorted(handled) == [f"ch{i}" for i in range(6)]
+    for channel_id, ids in handled.items():
+        assert ids == list(range(1, 51))
+        assert threads[channel_id] == {f"ConsumerWorker{consumer.get_worker(channel_id)}"}
+    assert sum(s.processed for s in stats) == 300
+    assert sum(s.channels for s in stats) == 6
+    assert all(s.pending == 0 and s.lag >= 0 for s in stats)
+
+
+def test_stop_delivers_the_batch_read(queue_folder):
+    handled = []
+
+    def handler(channel_id, item):
+        # Slow enough for the queue of the worker to fill up with the batch
+        time.sleep(0.001)
+        handled.append(item.message_id)
+
+    producer = FsbQueueProducer(0, "ch1")
+    producer.put_many([ObjectInfo(gender="M") for _ in range(200)])
+    consumer = Consumer(0, workers=1, handler=handler, max_pending=4)
+    consumer.start()
+    start = time.monotonic()
+    while not handled and time.monotonic() - start < 5.0:
+        time.sleep(0.001)
+    consumer.stop()
+    consumer.join()
+    # Whatever the stopped consumer did not handle is left for the next one
+    rest = []
+    next_consumer = FsbQueueConsumer(0)
+    for _ in range(100):
+        items = next_consumer.get_many(max_items=64, timeout=0.05)
+        if not items and len(handled) + len(rest) >= 200:
+            break
+        rest += [item.message_id for _, item in items]
+    next_consumer.stop()
+    producer.stop()
+    assert handled + rest == list(range(1, 201))
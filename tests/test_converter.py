@@ -0,0 +1,121 @@
+import logging
+import time
+
+import numpy as np
+import pytest
+
+from vrpc.data_models import converter
+from vrpc.data_models.converter import (DEFAULT_IMAGE_CODECS, Codec, ImageCodec, encode_images, get_mat_from_ocvmat,
+                                        get_mats_from_ocvmats, get_ocvmat_from_mat, get_ocvmats_from_mats)
+from vrpc.data_models.data import ObjectInfo, OcvMat
+
+
+def make_image(height, width):
+    # Smooth content compresses like a camera frame, noise would not compress at all
+    y, x = np.mgrid[0:height, 0:width]
+    return np.dstack([(x * 255 // width), (y * 255 // height), ((x + y) % 256)]).astype(np.uint8)
+
+
+@pytest.mark.parametrize("codec, lossless", [
+    (ImageCodec(), True),
+    (ImageCodec(Codec.PNG, 1), True),
+    (ImageCodec(Codec.JPEG, 80), False),
+    (ImageCodec(Codec.WEBP, 80), False),
+    (ImageCodec(Codec.WEBP, 101), True),
+])
+def test_codec_round_trip(caplog, codec, lossless):
+    caplog.set_level(logging.INFO)
+    image = make_image(1080, 1920)
+    start = time.perf_counter()
+    ocvmat = get_ocvmat_from_mat(image, codec)
+    encoded = time.perf_counter()
+    ocvmat = OcvMat().parse(bytes(ocvmat))
+    decoded_start = time.perf_counter()
+    mat = get_mat_from_ocvmat(ocvmat)
+    decoded = time.perf_counter()
+    logging.info(f"{codec.codec.name} q{codec.quality}: {image.nbytes} -> {len(ocvmat.mat_data)} bytes "
+                 f"encode {(encoded - start) * 1000:.1f} ms decode {(decoded - decoded_start) * 1000:.1f} ms")
+    assert ocvmat.codec == codec.codec
+    assert mat.shape == image.shape
+    if lossless:
+        assert np.array_equal(mat, image)
+    else:
+        assert np.abs(mat.astype(np.int16) - image).mean() < 4
+
+
+def test_encode_images():
+    object_info = ObjectInfo(face_chip=get_ocvmat_from_mat(make_image(112, 112)),
+                             full_image=get_ocvmat_from_mat(make_image(720, 1280)))
+    encode_images(object_info)
+    assert object_info.face_chip.codec == Codec.PNG
+    assert object_info.full_image.codec == Codec.JPEG
+    assert len(object_info.full_image.mat_data) < 720 * 1280 * 3 // 10
+    assert np.array_equal(get_mat_from_ocvmat(object_info.face_chip), make_image(112, 112))
+    assert len(object_info.extended_face_chip.mat_data) == 0
+    # Already encoded images are left alone
+    face_chip = object_info.face_chip.mat_data
+    encode_images(object_info, {**DEFAULT_IMAGE_CODECS, "face_chip": ImageCodec(Codec.JPEG)})
+    assert object_info.face_chip.mat_data == face_chip
+
+
+@pytest.mark.parametrize("dtype, shape", [
+    (np.uint8, (48, 64)),
+    (np.uint8, (48, 64, 4)),
+    (np.int8, (48, 64, 2)),
+    (np.uint16, (48, 64, 1)),
+    (np.int16, (48, 64, 3)),
+    (np.int32, (48, 64)),
+    (np.float32, (48, 64, 2)),
+    (np.float64, (48, 64, 3)),
+    (np.float16, (48, 64)),
+])
+def test_dtypes(dtype, shape):
+    image = (np.arange(np.prod(shape)) % 100).astype(dtype).reshape(shape)
+    ocvmat = OcvMat().parse(bytes(get_ocvmat_from_mat(image)))
+    mat = get_mat_from_ocvmat(ocvmat)
+    assert mat.dtype == dtype
+    assert np.array_equal(mat, image.reshape(shape[0], shape[1], -1))
+
+
+def test_legacy_mat_data_type():
+    image = make_image(32, 48)
+    ocvmat = OcvMat(rows=32, cols=48, mat_data_type=image.dtype.num, mat_data_size=3, mat_data=image.tobytes())
+    assert np.array_equal(get_mat_from_ocvmat(ocvmat), image)
+
+
+def test_zero_copy_and_copy_flag():
+    image = make_image(64, 64)
+    ocvmat = get_ocvmat_from_mat(image)
+    image[0, 0, 0] = 42
+    assert ocvmat.mat_data[0] == 42
+    mat = get_mat_from_ocvmat(ocvmat)
+    assert not mat.flags.writeable and np.shares_memory(mat, image)
+    mat = get_mat_from_ocvmat(ocvmat, copy=True)
+    assert mat.flags.writeable and not np.shares_memory(mat, image)
+    # Non-contiguous views are copied exactly once
+    ocvmat = get_ocvmat_from_mat(image[::2, ::2], copy=False)
+    assert np.array_equal(get_mat_from_ocvmat(ocvmat), image[::2, ::2])
+    ocvmat = get_ocvmat_from_mat(image, copy=True)
+    image[0, 0, 0] = 7
+    assert ocvmat.mat_data[0] == 42
+
+
+def test_batch_conversion():
+    mats = np.stack([make_image(112, 112) + i for i in range(8)])
+    ocvmats = get_ocvmats_from_mats(mats)
+    assert all(np.shares_memory(get_mat_from_ocvmat(ocvmat), mats) for ocvmat in ocvmats)
+    stacked = get_mats_from_ocvmats(ocvmats)
+    assert stacked.shape == mats.shape and np.array_equal(stacked, mats)
+    out = np.empty_like(mats)
+    assert get_mats_from_ocvmats(ocvmats[:4], out) is out and np.array_equal(out[:4], mats[:4])
+    with pytest.raises(ValueError):
+        get_mats_from_ocvmats(ocvmats + [get_ocvmat_from_mat(make_image(64, 64))])
+
+
+def test_batch_conversion_decodes_once(monkeypatch):
+    ocvmats = get_ocvmats_from_mats(np.stack([make_image(112, 112)] * 4), ImageCodec(Codec.PNG, 1))
+    decoded = []
+    imdecode = converter.cv2.imdecode
+    monkeypatch.setattr(converter.cv2, "imdecode", lambda *args: decoded.append(1) or imdecode(*args))
+    assert get_mats_from_ocvmats(ocvmats).shape == (4, 112, 112, 3)
+    assert len(decoded) == 4
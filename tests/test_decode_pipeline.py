@@ -0,0 +1,63 @@
+import collections
+import time
+
+import cv2
+import numpy as np
+
+from vrpc.data_models.converter import Codec, ImageCodec, get_ocvmat_from_mat
+from vrpc.data_models.data import ObjectInfo
+from vrpc.decode_pipeline import DecodePipeline, DecodePolicy
+from vrpc.fsb_queue import FsbQueueConsumer, FsbQueueProducer
+
+
+def test_decoded_in_channel_order(queue_folder):
+    image = np.zeros((112, 112, 3), dtype=np.uint8)
+    image[..., 0] = 255
+    face_chip = get_ocvmat_from_mat(image, ImageCodec(Codec.PNG, 1))
+    producers = [FsbQueueProducer(0, f"ch{i}") for i in range(3)]
+    consumer = FsbQueueConsumer(0)
+    pipeline = DecodePipeline(consumer,
+                              DecodePolicy(sizes={"face_chip": (56, 56)}, color_conversion=cv2.COLOR_BGR2RGB),
+                              workers=4,
+                              max_in_flight=8)
+    for _ in range(4):
+        for producer in producers:
+            producer.put_many([ObjectInfo(face_chip=face_chip) for _ in range(10)])
+    records = collections.defaultdict(list)
+    start = time.monotonic()
+    while sum(len(r) for r in records.values()) < 120 and time.monotonic() - start < 10.0:
+        for record in pipeline.get_many():
+            records[record.channel_id].append(record)
+    pipeline.stop()
+    assert pipeline.get() is None
+    consumer.stop()
+    for producer in producers:
+        producer.stop()
+    assert sorted(records) == ["ch0", "ch1", "ch2"]
+    for channel_records in records.values():
+        assert [r.object_info.message_id for r in channel_records] == list(range(1, 41))
+        for record in channel_records:
+            assert list(record.images) == ["face_chip"]
+            chip = record.images["face_chip"]
+            assert chip.shape == (56, 56, 3)
+            assert (chip[..., 2] == 255).all() and (chip[..., 0] == 0).all()
+
+
+def test_stop_leaves_what_has_no_room_unread(queue_folder):
+    producer = FsbQueueProducer(0, "ch1")
+    producer.put_many([ObjectInfo(gender="M") for _ in range(20)])
+    consumer = FsbQueueConsumer(0)
+    pipeline = DecodePipeline(consumer, workers=2, max_in_flight=4)
+    time.sleep(0.3)
+    pipeline.stop()
+    ids = [record.object_info.message_id for record in pipeline.get_many(timeout=0)]
+    assert len(ids) == 4
+    # Anything read is decoded, the rest is still there for the next reader
+    for _ in range(100):
+        items = consumer.get_many(max_items=64, timeout=0.05)
+        ids += [item.message_id for _, item in items]
+        if len(ids) >= 20:
+            break
+    consumer.stop()
+    producer.stop()
+    assert ids == list(range(1, 21))
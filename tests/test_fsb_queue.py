@@ -0,0 +1,741 @@
+import asyncio
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from vrpc import fsb_queue, fsb_queue_compression, fsb_queue_notifier
+from vrpc.data_models.converter import get_mat_from_ocvmat, get_ocvmat_from_mat
+from vrpc.data_models.data import ObjectInfo
+from vrpc.fsb_queue import (AllocationPolicy, BlobPolicy, CheckpointPolicy, Durability, DurabilityPolicy,
+                            FsbQueueConsumer, FsbQueueProducer, Overflow, QuotaPolicy, RingPolicy, RotationPolicy,
+                            _CursorFile, _SegmentIndex)
+from vrpc.fsb_queue_asyncio import AsyncFsbQueueConsumer, AsyncFsbQueueProducer
+from vrpc.fsb_queue_compression import Compression, CompressionPolicy
+from vrpc.fsb_queue_groups import load_groups, unregister_group
+from vrpc.fsb_queue_notifier import FILE_CREATED, FILE_DELETED
+from vrpc.fsb_queue_retention import FsbQueueJanitor, RetentionPolicy
+from vrpc.fsb_queue_scheduler import FsbQueueScheduler
+
+
+def drain(consumer, count, attempts=1000):
+    items = []
+    while len(items) < count and attempts > 0:
+        attempts -= 1
+        ret = consumer.get()
+        if ret is not None:
+            items.append(ret)
+    return items
+
+
+def test_put_many(queue_folder, caplog):
+    caplog.set_level(logging.INFO)
+    producer = FsbQueueProducer(0, "ch1", rotation=RotationPolicy(max_records=100))
+    producer.put_many([ObjectInfo(gender="M") for _ in range(250)])
+    producer.put(ObjectInfo(gender="F"))
+    producer.stop()
+
+    consumer = FsbQueueConsumer(0)
+    consumer.glob_directory()
+    items = drain(consumer, 251)
+    consumer.stop()
+    assert [item.message_id for _, item in items] == list(range(1, 252))
+    assert items[-1][1].gender == "F"
+
+
+@pytest.mark.parametrize("policy", [
+    DurabilityPolicy(Durability.NONE),
+    DurabilityPolicy(Durability.FLUSH),
+    DurabilityPolicy(Durability.FDATASYNC_RECORDS, records=50),
+    DurabilityPolicy(Durability.FDATASYNC_INTERVAL, interval_ms=10),
+    DurabilityPolicy(Durability.FDATASYNC_ROTATION),
+])
+def test_durability_policy(queue_folder, caplog, policy):
+    caplog.set_level(logging.INFO)
+    producer = FsbQueueProducer(0, "ch1", durability=policy)
+    start = time.perf_counter()
+    for _ in range(200):
+        producer.put(ObjectInfo(gender="M"))
+    elapsed = time.perf_counter() - start
+    producer.stop()
+    logging.info(f"{policy.mode.name} 200 puts in {elapsed * 1000:.2f} ms")
+
+    consumer = FsbQueueConsumer(0, durability=policy)
+    consumer.glob_directory()
+    items = drain(consumer, 200)
+    consumer.stop()
+    assert [item.message_id for _, item in items] == list(range(1, 201))
+
+
+def test_cursor_file_keeps_legacy_layout(tmp_path):
+    file_name = str(tmp_path / ".ch1.fsrs")
+    with open(file_name, "wb") as f:
+        f.write(struct.pack("<iQQ", 3, 7, 99))
+    reader = _CursorFile(file_name, writable=False)
+    assert reader.read() == (3, 7, 99)
+    reader.close()
+
+    cursor = _CursorFile(file_name)
+    assert cursor.read() == (3, 7, 99)
+    cursor.write(4, 8, 120)
+    cursor.close()
+    with open(file_name, "rb") as f:
+        assert struct.unpack("<iQQ", f.read(struct.calcsize("<iQQ"))) == (4, 8, 120)
+
+
+def test_cursor_file_left_torn(tmp_path):
+    file_name = str(tmp_path / ".ch1.fsws")
+    # A writer killed between the two generation stores
+    with open(file_name, "wb") as f:
+        f.write(struct.pack("<iQQQ", 3, 7, 99, 7))
+    reader = _CursorFile(file_name, writable=False)
+    start = time.monotonic()
+    assert reader.read() == (3, 7, 99)
+    assert reader.read() == (3, 7, 99)
+    assert time.monotonic() - start < 1.0
+    writer = _CursorFile(file_name)
+    writer.write(3, 8, 120)
+    assert reader.read() == (3, 8, 120)
+    writer.close()
+    reader.close()
+
+
+def test_consumer_resumes_from_checkpoint(queue_folder):
+    producer = FsbQueueProducer(0, "ch1")
+    producer.put_many([ObjectInfo() for _ in range(50)])
+    producer.stop()
+
+    consumer = FsbQueueConsumer(0, checkpoint=CheckpointPolicy(records=10))
+    consumer.glob_directory()
+    first = drain(consumer, 30)
+    consumer.stop()
+
+    consumer = FsbQueueConsumer(0)
+    consumer.glob_directory()
+    rest = drain(consumer, 20)
+    consumer.stop()
+    assert [item.message_id for _, item in first + rest] == list(range(1, 51))
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_get_wakes_up_on_append(queue_folder, monkeypatch, use_inotify):
+    if not use_inotify:
+        monkeypatch.setattr(fsb_queue_notifier, "_load_libc", lambda: None)
+    consumer = FsbQueueConsumer(0)
+    producer = FsbQueueProducer(0, "ch1")
+    consumer.glob_directory()
+    assert consumer.get(timeout=0.05) is None
+
+    timer = threading.Timer(0.2, producer.put, args=(ObjectInfo(gender="M"), ))
+    timer.start()
+    start = time.monotonic()
+    ret = None
+    while ret is None and time.monotonic() - start < 5.0:
+        ret = consumer.get(timeout=5.0)
+    elapsed = time.monotonic() - start
+    timer.join()
+    consumer.stop()
+    producer.stop()
+    assert ret is not None and ret[1].gender == "M"
+    assert elapsed < 1.0
+
+
+def test_new_channel_is_discovered_without_glob(queue_folder):
+    consumer = FsbQueueConsumer(0)
+    producer = FsbQueueProducer(0, "ch2")
+    producer.put(ObjectInfo(gender="F"))
+    start = time.monotonic()
+    ret = None
+    while ret is None and time.monotonic() - start < 2.0:
+        ret = consumer.get(timeout=0.05)
+    consumer.stop()
+    producer.stop()
+    assert ret is not None and ret[0] == "ch2"
+
+
+def test_segment_index(tmp_path):
+    for name in ["ch1_00002.fsbq", "ch1_00003.fsbq", "ch2_00007.fsbq", ".ch1.fsws", "ch1_00001.tmp"]:
+        (tmp_path / name).write_bytes(b"")
+    index = _SegmentIndex(str(tmp_path))
+    assert index.first("ch1") == 2 and index.last("ch1") == 3
+    assert index.has_next("ch1", 2) and not index.has_next("ch1", 3)
+    index.on_file_changed("ch1_00004.fsbq", FILE_CREATED)
+    index.on_file_changed("ch1_00002.fsbq", FILE_DELETED)
+    assert index.first("ch1") == 3 and index.last("ch1") == 4
+    assert index.first("ch3") is None
+
+
+def test_segment_index_refreshes_unknown_segments(tmp_path):
+    (tmp_path / "ch1_00001.fsbq").write_bytes(b"")
+    index = _SegmentIndex(str(tmp_path))
+    # Written by another process, nothing reports it to an index that is not live
+    (tmp_path / "ch1_00002.fsbq").write_bytes(b"")
+    assert index.first("ch1", 2) == 2 and index.last("ch1") == 2
+
+
+def test_producer_rotation_updates_segment_index(queue_folder):
+    # No consumer, so no file watch feeds the index
+    producer = FsbQueueProducer(0, "ch1", rotation=RotationPolicy(max_records=2))
+    index = fsb_queue._get_segment_index(str(queue_folder / "00000"))
+    assert index.last("ch1") == 1
+    producer.put_many([ObjectInfo(gender="M") for _ in range(5)])
+    assert index.first("ch1") == 1 and index.last("ch1") == 3
+    producer.stop()
+
+
+def test_segment_index_keeps_changes_during_build(tmp_path, monkeypatch):
+    index = _SegmentIndex(str(tmp_path))
+    scandir = os.scandir
+
+    def racing_scandir(path):
+        # Created and reported by the watch after the scan listed the folder
+        index.add("ch1", 5)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", racing_scandir)
+    index.build()
+    assert index.first("ch1") == 5
+
+
+@pytest.mark.parametrize("policy, segments", [
+    (RotationPolicy(max_bytes=0, max_records=30), 4),
+    (RotationPolicy(max_bytes=2000), 5),
+])
+def test_rotation_policy(queue_folder, policy, segments):
+    producer = FsbQueueProducer(0, "ch1", rotation=policy)
+    producer.put_many([ObjectInfo(gender="M", race="A" * 80) for _ in range(100)])
+    producer.stop()
+    files = sorted((queue_folder / "00000").glob("ch1_*.fsbq"))
+    assert len(files) == segments
+    if policy.max_bytes > 0:
+        assert all(f.stat().st_size <= policy.max_bytes + 4 for f in files)
+
+
+def test_recycled_segments_hide_stale_records(queue_folder):
+    rotation = RotationPolicy(max_bytes=4096, max_records=10)
+    allocation = AllocationPolicy(preallocate=True, recycle_pool_size=2)
+    producer = FsbQueueProducer(0, "ch1", rotation=rotation, allocation=allocation)
+    consumer = FsbQueueConsumer(0, allocation=allocation)
+    consumer.glob_directory()
+    producer.put_many([ObjectInfo(gender="M") for _ in range(25)])
+    assert [item.message_id for _, item in drain(consumer, 25)] == list(range(1, 26))
+    assert len(list((queue_folder / "00000" / ".recycle").iterdir())) == 2
+
+    producer.put_many([ObjectInfo(gender="F") for _ in range(8)])
+    assert [item.message_id for _, item in drain(consumer, 8)] == list(range(26, 34))
+    assert consumer.get(timeout=0.1) is None
+    consumer.stop()
+    producer.stop()
+
+
+def test_recycled_segment_opened_while_reading(queue_folder, monkeypatch):
+    rotation = RotationPolicy(max_records=5)
+    allocation = AllocationPolicy(recycle_pool_size=4)
+    producer = FsbQueueProducer(0, "ch1", rotation=rotation, allocation=allocation)
+    consumer = FsbQueueConsumer(0, allocation=allocation)
+    consumer.glob_directory()
+    producer.put_many([ObjectInfo(gender="M") for _ in range(10)])
+    received = [item.message_id for _, item in drain(consumer, 10)]
+    assert len(list((queue_folder / "00000" / ".recycle").iterdir())) == 1
+
+    preallocate = fsb_queue._FsbQueueProducer._FsbQueueProducer__preallocate
+
+    def read_then_preallocate(self):
+        # The recycled file is in place but the write session does not name it yet
+        received.extend(item.message_id for _, item in consumer.get_many(timeout=0))
+        preallocate(self)
+
+    monkeypatch.setattr(fsb_queue._FsbQueueProducer, "_FsbQueueProducer__preallocate", read_then_preallocate)
+    producer.put_many([ObjectInfo(gender="F") for _ in range(10)])
+    received.extend(item.message_id for _, item in drain(consumer, 20 - len(received)))
+    assert received == list(range(1, 21))
+    consumer.stop()
+    producer.stop()
+
+
+def test_get_many(queue_folder):
+    producers = [FsbQueueProducer(0, f"ch{i}", rotation=RotationPolicy(max_records=7)) for i in range(3)]
+    for producer in producers:
+        producer.put_many([ObjectInfo(gender="M") for _ in range(20)])
+    consumer = FsbQueueConsumer(0)
+    consumer.glob_directory()
+    items = []
+    while len(items) < 60:
+        batch = consumer.get_many(max_items=16, timeout=1.0)
+        assert 0 < len(batch) <= 16
+        items.extend(batch)
+    assert len(consumer.get_many(max_items=16, max_bytes=1, timeout=0.05)) == 0
+    consumer.stop()
+    for producer in producers:
+        producer.stop()
+    for i in range(3):
+        assert [item.message_id for channel_id, item in items if channel_id == f"ch{i}"] == list(range(1, 21))
+
+
+def test_zero_copy_images(queue_folder):
+    allocation = AllocationPolicy(recycle_pool_size=4)
+    producer = FsbQueueProducer(0, "ch1", rotation=RotationPolicy(max_records=3), allocation=allocation)
+    images = [np.full((112, 112, 3), i, dtype=np.uint8) for i in range(10)]
+    producer.put_many([ObjectInfo(gender="M", face_chip=get_ocvmat_from_mat(image)) for image in images])
+    producer.stop()
+
+    consumer = FsbQueueConsumer(0, allocation=allocation, zero_copy=True)
+    consumer.glob_directory()
+    items = drain(consumer, 10)
+    consumer.stop()
+    assert [item.gender for _, item in items] == ["M"] * 10
+    for (_, item), image in zip(items, images):
+        assert isinstance(item.face_chip.mat_data, memoryview)
+        assert np.array_equal(get_mat_from_ocvmat(item.face_chip), image)
+    # Segments whose records are still referenced must not be handed back to the producer
+    assert not (queue_folder / "00000" / fsb_queue._RECYCLE_FOLDER).exists() or not any(
+        (queue_folder / "00000" / fsb_queue._RECYCLE_FOLDER).iterdir())
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/maps"), reason="needs /proc/self/maps")
+def test_zero_copy_live_segment_mappings(queue_folder):
+    producer = FsbQueueProducer(0, "ch1")
+    consumer = FsbQueueConsumer(0, zero_copy=True)
+    consumer.glob_directory()
+    items = []
+    for i in range(2000):
+        producer.put(ObjectInfo(gender="M", race="x" * 100))
+        ret = consumer.get(timeout=1.0)
+        if ret is not None:
+            items.append(ret)
+    with open("/proc/self/maps") as f:
+        mappings = sum(1 for line in f if line.rstrip().endswith("ch1_00001.fsbq"))
+    consumer.stop()
+    producer.stop()
+    assert [item.message_id for _, item in items] == list(range(1, 2001))
+    assert mappings < 32
+
+
+@pytest.mark.parametrize("options", [
+    dict(fields=["gender"]),
+    dict(exclude_images=True),
+    dict(exclude_images=True, lazy_images=True),
+    dict(lazy_images=True, zero_copy=True),
+])
+def test_projection(queue_folder, options):
+    producer = FsbQueueProducer(0, "ch1")
+    image = np.full((112, 112, 3), 7, dtype=np.uint8)
+    producer.put_many([ObjectInfo(gender="M", race="R", face_chip=get_ocvmat_from_mat(image)) for _ in range(5)])
+    producer.stop()
+
+    consumer = FsbQueueConsumer(0, **options)
+    consumer.glob_directory()
+    items = drain(consumer, 5)
+    consumer.stop()
+    assert [item.message_id for _, item in items] == list(range(1, 6))
+    for _, item in items:
+        assert item.gender == "M"
+        assert item.race == ("" if "fields" in options else "R")
+        if options.get("lazy_images"):
+            assert np.array_equal(get_mat_from_ocvmat(item.face_chip), image)
+        else:
+            assert item.face_chip.rows == 0 and len(item.face_chip.mat_data) == 0
+
+
+def test_blob_segments(queue_folder):
+    producer = FsbQueueProducer(0, "ch1", rotation=RotationPolicy(max_records=4), blob=BlobPolicy(enabled=True))
+    images = [np.full((112, 112, 3), i, dtype=np.uint8) for i in range(10)]
+    small = np.zeros((4, 4, 3), dtype=np.uint8)
+    items = [ObjectInfo(gender="M", face_chip=get_ocvmat_from_mat(image), extended_face_chip=get_ocvmat_from_mat(small))
+             for image in images]
+    producer.put_many(items)
+    producer.stop()
+    assert len(items[0].face_chip.mat_data) == 112 * 112 * 3
+    assert len(list((queue_folder / "00000").glob("*.fsbb"))) == 3
+
+    consumer = FsbQueueConsumer(0)
+    consumer.glob_directory()
+    consumed = drain(consumer, 10)
+    consumer.stop()
+    # Consumed segments are gone with their blob segments, the records can still resolve their images
+    assert sorted(path.name for path in (queue_folder / "00000").glob("*.fsb?")) == ["ch1_00003.fsbb", "ch1_00003.fsbq"]
+    for (_, item), image in zip(consumed, images):
+        assert np.array_equal(get_mat_from_ocvmat(item.face_chip), image)
+        assert item.face_chip.blob.length == image.nbytes
+        assert np.array_equal(get_mat_from_ocvmat(item.extended_face_chip), small)
+        assert item.extended_face_chip.blob.length == 0
+
+
+@pytest.mark.parametrize("spill", [True, False])
+def test_ring(queue_folder, spill):
+    ring = RingPolicy(enabled=True, capacity=4096, spill=spill)
+    producer = FsbQueueProducer(0, "ch1", ring=ring)
+    consumer = FsbQueueConsumer(0)
+    consumer.glob_directory()
+    items = []
+
+    def consume():
+        items.extend(drain(consumer, 500, attempts=10000))
+
+    thread = threading.Thread(target=consume)
+    thread.start()
+    for i in range(50):
+        # Batches larger than the ring spill over to the segments while the consumer catches up
+        producer.put_many([ObjectInfo(gender="M", race="x" * 100) for _ in range(10)])
+    thread.join()
+    consumer.stop()
+    producer.stop()
+    assert [item.message_id for _, item in items] == list(range(1, 501))
+    if not spill:
+        assert not list((queue_folder / "00000").glob("*.fsbq"))[1:]
+
+
+@pytest.mark.parametrize("codec", [Compression.ZLIB, Compression.LZ4, Compression.ZSTD])
+def test_compression(queue_folder, caplog, codec):
+    caplog.set_level(logging.INFO)
+    if not fsb_queue_compression.is_available(codec):
+        pytest.skip(f"{codec.name} is not installed")
+    compression = CompressionPolicy(codec, dictionary_samples=50)
+    producers = [FsbQueueProducer(0, f"ch{i}", compression=compression) for i in range(2)]
+    for i in range(10):
+        for producer in producers:
+            producer.put_many([ObjectInfo(gender="M", race="Asian", capture_time=i) for _ in range(10)])
+    for producer in producers:
+        producer.stop()
+    assert (queue_folder / "00000" / ".dictionary").exists()
+    segment_bytes = sum(path.stat().st_size for path in (queue_folder / "00000").glob("*.fsbq"))
+    logging.info(f"{codec.name} 200 records in {segment_bytes} bytes")
+
+    consumer = FsbQueueConsumer(0)
+    consumer.glob_directory()
+    items = drain(consumer, 200)
+    consumer.stop()
+    for i in range(2):
+        assert [item.message_id for channel_id, item in items if channel_id == f"ch{i}"] == list(range(1, 101))
+    assert all(item.race == "Asian" for _, item in items)
+
+
+def test_compressed_rotation_follows_file_size(queue_folder):
+    compression = CompressionPolicy(Compression.ZLIB, dictionary_size=0)
+    producer = FsbQueueProducer(0, "ch1", rotation=RotationPolicy(max_bytes=2000), compression=compression)
+    for _ in range(100):
+        producer.put_many([ObjectInfo(gender="M", race="Asian" * 20) for _ in range(10)])
+    producer.stop()
+    files = sorted((queue_folder / "00000").glob("ch1_*.fsbq"))
+    # Uncompressed, the 1000 records would take more than 50 segments
+    assert len(files) < 15
+    assert all(f.stat().st_size <= 2000 + 4 for f in files)
+
+
+def test_compressed_block_resume(queue_folder):
+    producer = FsbQueueProducer(0, "ch1", compression=CompressionPolicy(Compression.ZLIB))
+    producer.put_many([ObjectInfo(gender="M") for _ in range(20)])
+    producer.put_many([ObjectInfo(gender="F") for _ in range(5)])
+    producer.stop()
+
+    consumer = FsbQueueConsumer(0)
+    consumer.glob_directory()
+    first = drain(consumer, 7)
+    consumer.stop()
+    # Resumes inside the first block, decompressing it again but skipping what was read already
+    consumer = FsbQueueConsumer(0)
+    consumer.glob_directory()
+    rest = drain(consumer, 18)
+    consumer.stop()
+    assert [item.message_id for _, item in first + rest] == list(range(1, 26))
+
+
+def test_scheduler_deficit_round_robin():
+    scheduler = FsbQueueScheduler()
+    scheduler.add("ch1", weight=3)
+    scheduler.add("ch2")
+    served = []
+    for _ in range(4):
+        channel_id, quantum = scheduler.take()
+        served.append((channel_id, quantum))
+        scheduler.release(channel_id, quantum, is_drained=False)
+    assert served == [("ch1", 3), ("ch2", 1), ("ch1", 3), ("ch2", 1)]
+    # What is left of a quantum is served before the next channel
+    assert scheduler.take() == ("ch1", 3)
+    scheduler.release("ch1", 1, is_drained=False)
+    assert scheduler.take() == ("ch1", 2)
+    scheduler.release("ch1", 2, is_drained=True)
+    scheduler.set_weight("ch2", 2)
+    assert scheduler.take() == ("ch2", 2)
+    scheduler.release("ch2", 0, is_drained=True)
+    assert scheduler.take() is None
+
+
+def test_scheduler_keeps_wakeup_during_service():
+    scheduler = FsbQueueScheduler()
+    scheduler.add("ch1")
+    assert scheduler.take() == ("ch1", 1)
+    # Data arrived after the visit looked and before it gave the channel back
+    scheduler.mark_ready("ch1")
+    scheduler.mark_ready("ch3")
+    scheduler.release("ch1", 0, is_drained=True)
+    assert scheduler.take() == ("ch1", 1)
+    scheduler.release("ch1", 0, is_drained=True)
+    assert scheduler.take() is None
+    assert not scheduler.wait(0.01)
+
+
+def test_weights(queue_folder):
+    producers = [FsbQueueProducer(0, f"ch{i}") for i in range(2)]
+    for producer in producers:
+        producer.put_many([ObjectInfo(gender="M") for _ in range(30)])
+    consumer = FsbQueueConsumer(0, weights={"ch0": 3})
+    consumer.glob_directory()
+    batch = consumer.get_many(max_items=8, timeout=1.0)
+    consumer.stop()
+    for producer in producers:
+        producer.stop()
+    assert [channel_id for channel_id, _ in batch].count("ch0") == 6
+
+
+def test_get_blocks_without_channels(queue_folder):
+    consumer = FsbQueueConsumer(0)
+    start, cpu_start = time.monotonic(), time.process_time()
+    assert consumer.get(timeout=0.5) is None
+    assert consumer.get_many(timeout=0.5) == []
+    elapsed, cpu = time.monotonic() - start, time.process_time() - cpu_start
+    consumer.stop()
+    assert elapsed >= 1.0 and cpu < 0.2
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_stop_wakes_up_blocked_get(queue_folder, monkeypatch, use_inotify):
+    if not use_inotify:
+        monkeypatch.setattr(fsb_queue_notifier, "_load_libc", lambda: None)
+    producer = FsbQueueProducer(0, "ch1")
+    consumer = FsbQueueConsumer(0)
+    consumer.glob_directory()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(consumer.get(timeout=None))),
+        threading.Thread(target=lambda: results.append(consumer.get_many(timeout=None))),
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    cpu_start = time.process_time()
+    consumer.stop()
+    for thread in threads:
+        thread.join(timeout=1.0)
+    producer.stop()
+    assert not any(thread.is_alive() for thread in threads)
+    assert sorted(results, key=str) == [None, []]
+    assert time.process_time() - cpu_start < 0.5
+
+
+def test_consumer_groups(queue_folder):
+    producer = FsbQueueProducer(0, "ch1", rotation=RotationPolicy(max_records=10))
+    recognition = FsbQueueConsumer(0, group="recognition")
+    archive = FsbQueueConsumer(0, group="archive")
+    producer.put_many([ObjectInfo(gender="M") for _ in range(25)])
+    folder = queue_folder / "00000"
+    assert load_groups(str(folder)) == ["recognition", "archive"]
+
+    recognition.glob_directory()
+    assert [item.message_id for _, item in drain(recognition, 25)] == list(range(1, 26))
+    # Archive has not read them yet
+    assert len(list(folder.glob("ch1_*.fsbq"))) == 3
+    archive.glob_directory()
+    assert [item.message_id for _, item in drain(archive, 25)] == list(range(1, 26))
+    assert sorted(path.name for path in folder.glob("ch1_*.fsbq")) == ["ch1_00003.fsbq"]
+    assert (folder / ".ch1.recognition.fsrs").exists() and (folder / ".ch1.archive.fsrs").exists()
+
+    # A group that went away no longer holds segments back
+    archive.stop()
+    unregister_group(str(folder), "archive")
+    producer.put_many([ObjectInfo(gender="F") for _ in range(10)])
+    assert [item.message_id for _, item in drain(recognition, 10)] == list(range(26, 36))
+    assert sorted(path.name for path in folder.glob("ch1_*.fsbq")) == ["ch1_00004.fsbq"]
+    recognition.stop()
+    producer.stop()
+
+
+def test_consumer_groups_are_all_woken_up(queue_folder):
+    producer = FsbQueueProducer(0, "ch1", ring=RingPolicy(enabled=True))
+    consumers = [FsbQueueConsumer(0, group=group) for group in ("recognition", "archive")]
+    for consumer in consumers:
+        consumer.glob_directory()
+        assert consumer.get(timeout=0.05) is None
+    results = {}
+
+    def consume(consumer):
+        results[consumer] = consumer.get(timeout=2.0)
+
+    threads = [threading.Thread(target=consume, args=(consumer, )) for consumer in consumers]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    producer.put(ObjectInfo(gender="M"))
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    for consumer in consumers:
+        consumer.stop()
+    producer.stop()
+    # With two groups the record goes to the segment, where both of them find it
+    assert [result[1].message_id for result in results.values()] == [1, 1]
+    assert elapsed < 1.0
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_asyncio(queue_folder, monkeypatch, use_inotify):
+    if not use_inotify:
+        monkeypatch.setattr(fsb_queue_notifier, "_load_libc", lambda: None)
+
+    async def run():
+        consumer = AsyncFsbQueueConsumer(0)
+        assert await consumer.get(timeout=0.05) is None
+        producers = [AsyncFsbQueueProducer(0, f"ch{i}") for i in range(20)]
+        received = collections.defaultdict(list)
+
+        async def receive():
+            async for channel_id, item in consumer:
+                received[channel_id].append(item.message_id)
+                if sum(len(ids) for ids in received.values()) == 200:
+                    break
+
+        receiver = asyncio.ensure_future(receive())
+        await asyncio.gather(*(producer.put_many([ObjectInfo(gender="M") for _ in range(10)])
+                               for producer in producers))
+        await asyncio.wait_for(receiver, 10.0)
+        waiter = asyncio.ensure_future(consumer.get())
+        await asyncio.sleep(0.05)
+        consumer.stop()
+        assert await asyncio.wait_for(waiter, 1.0) is None
+        for producer in producers:
+            await producer.stop()
+        return received
+
+    received = asyncio.run(run())
+    assert sorted(received) == sorted(f"ch{i}" for i in range(20))
+    assert all(ids == list(range(1, 11)) for ids in received.values())
+
+
+def test_segment_index_counts_segments_of_other_processes(queue_folder):
+    producer = FsbQueueProducer(0, "ch1", rotation=RotationPolicy(max_records=4))
+    producer.put_many([ObjectInfo(gender="M") for _ in range(6)])
+    # An index of its own stands for another process, nothing is reported to it
+    index = _SegmentIndex(str(queue_folder / "00000"))
+    assert index.usage("ch1")[1] == 0
+    index.refresh_usage()
+    assert index.usage("ch1")[1] == 6
+    # Only what was appended to the segment still written is read
+    producer.put_many([ObjectInfo(gender="M") for _ in range(2)])
+    index.refresh_usage()
+    assert index.usage("ch1") == fsb_queue._get_segment_index(str(queue_folder / "00000")).usage("ch1")
+    assert index.usage("ch1")[1] == 8
+    producer.stop()
+    index.remove("ch1", 1)
+    index.refresh_usage()
+    assert index.usage("ch1")[1] == 4 and index.usage()[1] == 4
+
+
+def test_quota_drop_newest(queue_folder):
+    producer = FsbQueueProducer(0, "ch1", quota=QuotaPolicy(channel_max_records=10, overflow=Overflow.DROP_NEWEST))
+    items = [ObjectInfo(gender="M") for _ in range(30)]
+    producer.put_many(items)
+    assert [item.message_id for item in items] == list(range(1, 11)) + [0] * 20
+    assert producer.drop_counters().dropped_records == 20
+    producer.stop()
+    consumer = FsbQueueConsumer(0)
+    assert [item.message_id for _, item in drain(consumer, 10)] == list(range(1, 11))
+    assert consumer.get(timeout=0.2) is None
+    consumer.stop()
+
+
+def test_quota_drop_oldest_moves_cursors(queue_folder):
+    producer = FsbQueueProducer(0, "ch1", rotation=RotationPolicy(max_records=5),
+                                quota=QuotaPolicy(channel_max_records=10, overflow=Overflow.DROP_OLDEST))
+    producer.put_many([ObjectInfo(gender="M") for _ in range(10)])
+    consumer = FsbQueueConsumer(0)
+    assert [item.message_id for _, item in drain(consumer, 2)] == [1, 2]
+    consumer.stop()
+    for _ in range(20):
+        producer.put(ObjectInfo(gender="M"))
+    counters = producer.drop_counters()
+    assert counters.dropped_records == 0 and counters.dropped_segments == 4
+    producer.stop()
+    consumer = FsbQueueConsumer(0)
+    assert [item.message_id for _, item in drain(consumer, 10)] == list(range(21, 31))
+    consumer.stop()
+
+
+def test_quota_degrade(queue_folder):
+    image = get_ocvmat_from_mat(np.zeros((100, 100, 3), dtype=np.uint8))
+    producer = FsbQueueProducer(0, "ch1", quota=QuotaPolicy(queue_max_bytes=70000, overflow=Overflow.DEGRADE))
+    items = [ObjectInfo(gender="M", full_image=image) for _ in range(3)]
+    producer.put_many(items)
+    counters = producer.drop_counters()
+    assert counters.degraded_records == 1 and counters.dropped_records == 0
+    assert len(items[2].full_image.mat_data) == 30000
+    producer.stop()
+    consumer = FsbQueueConsumer(0)
+    received = [item for _, item in drain(consumer, 3)]
+    assert [len(item.full_image.mat_data) for item in received] == [30000, 30000, 0]
+    consumer.stop()
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_quota_block(queue_folder, monkeypatch, use_inotify):
+    if not use_inotify:
+        monkeypatch.setattr(fsb_queue_notifier, "_load_libc", lambda: None)
+    producer = FsbQueueProducer(0, "ch1", quota=QuotaPolicy(channel_max_records=5, block_timeout_ms=5000))
+    consumer = FsbQueueConsumer(0)
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(drain(consumer, 10)))
+    reader.start()
+    for _ in range(10):
+        producer.put(ObjectInfo(gender="M"))
+    reader.join()
+    assert producer.drop_counters().dropped_records == 0
+    assert [item.message_id for _, item in received] == list(range(1, 11))
+    producer.stop()
+    consumer.stop()
+
+    producer = FsbQueueProducer(0, "ch2", quota=QuotaPolicy(channel_max_records=5, block_timeout_ms=100))
+    producer.put_many([ObjectInfo(gender="M") for _ in range(6)])
+    counters = producer.drop_counters()
+    assert counters.block_timeouts == 1 and counters.dropped_records == 1
+    producer.stop()
+
+
+def test_retention_by_age(queue_folder):
+    producer = FsbQueueProducer(0, "ch1", rotation=RotationPolicy(max_records=5))
+    producer.put_many([ObjectInfo(gender="M") for _ in range(20)])
+    consumer = FsbQueueConsumer(0)
+    assert [item.message_id for _, item in drain(consumer, 2)] == [1, 2]
+    consumer.stop()
+    old = time.time() - 3600
+    for file_counter in (1, 2):
+        os.utime(queue_folder / "00000" / f"ch1_{file_counter:05d}.fsbq", (old, old))
+    janitor = FsbQueueJanitor(0, RetentionPolicy(max_age_ms=60000))
+    assert janitor.purge() == 2
+    assert janitor.purge() == 0
+    assert sorted(p.name for p in (queue_folder / "00000").glob("*.fsbq")) == ["ch1_00003.fsbq", "ch1_00004.fsbq"]
+    consumer = FsbQueueConsumer(0)
+    assert [item.message_id for _, item in drain(consumer, 10)] == list(range(11, 21))
+    consumer.stop()
+    producer.stop()
+
+
+def test_retention_by_size(queue_folder):
+    producers = [FsbQueueProducer(0, f"ch{i}", rotation=RotationPolicy(max_records=5)) for i in range(2)]
+    for producer in producers:
+        producer.put_many([ObjectInfo(gender="M") for _ in range(20)])
+    janitor = FsbQueueJanitor(0, RetentionPolicy(max_bytes=1, check_interval_ms=50))
+    janitor.start()
+    start = time.monotonic()
+    while len(list((queue_folder / "00000").glob("*.fsbq"))) > 2 and time.monotonic() - start < 5.0:
+        time.sleep(0.05)
+    janitor.stop()
+    # The segments still written to stay whatever the limit
+    assert sorted(p.name for p in (queue_folder / "00000").glob("*.fsbq")) == ["ch0_00004.fsbq", "ch1_00004.fsbq"]
+    for producer in producers:
+        producer.put(ObjectInfo(gender="M"))
+        producer.stop()
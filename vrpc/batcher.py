@@ -0,0 +1,103 @@
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy.typing import DTypeLike
+
+from .data_models.converter import get_mat_from_ocvmat
+from .data_models.data import ObjectInfo
+from .fsb_queue import FsbQueueConsumer
+
+DEFAULT_CHIP_SHAPES: Dict[str, Tuple[int, int, int]] = {"face_chip": (112, 112, 3)}
+
+
+@dataclass
+class FaceChipBatch:
+    """``images`` maps every field to a (n, H, W, C) view of the batcher buffer, row ``i`` belongs to
+    ``items[i]``. The views are overwritten by the next batch of the batcher.
+    """
+    images: Dict[str, np.ndarray]
+    items: List[Tuple[str, ObjectInfo]]
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class FaceChipBatcher:
+    """Assembles the chips of up to ``batch_size`` records into preallocated (N, H, W, C) buffers.
+
+    ``shapes`` gives the (H, W, C) every field is resized to with ``interpolation``. The buffers are
+    allocated once and reused by every batch. A record whose chips can not all be decoded or whose
+    channel count differs is dropped.
+    """
+    def __init__(self,
+                 batch_size: int,
+                 shapes: Optional[Mapping[str, Tuple[int, int, int]]] = None,
+                 dtype: DTypeLike = np.uint8,
+                 interpolation: int = cv2.INTER_LINEAR) -> None:
+        self.name = "FaceChipBatcher"
+        self.__batch_size: int = batch_size
+        self.__shapes: Dict[str, Tuple[int, int, int]] = dict(shapes if shapes is not None else DEFAULT_CHIP_SHAPES)
+        self.__interpolation: int = interpolation
+        self.__buffers: Dict[str, np.ndarray] = {
+            field: np.empty((batch_size, ) + shape, dtype=dtype)
+            for field, shape in self.__shapes.items()
+        }
+        self.__items: List[Tuple[str, ObjectInfo]] = []
+
+    def __fill(self, field: str, row: int, object_info: ObjectInfo) -> bool:
+        mat = get_mat_from_ocvmat(getattr(object_info, field))
+        dst = self.__buffers[field][row]
+        height, width, channels = dst.shape
+        if mat is None or mat.size == 0 or mat.shape[2] != channels or mat.dtype != dst.dtype:
+            return False
+        if mat.shape == dst.shape:
+            np.copyto(dst, mat)
+        elif channels == 1:
+            # OpenCV drops the single channel axis, resize into a 2-D view of the same row
+            cv2.resize(mat[:, :, 0], (width, height),
+                       dst=dst.reshape(height, width),
+                       interpolation=self.__interpolation)
+        else:
+            cv2.resize(mat, (width, height), dst=dst, interpolation=self.__interpolation)
+        return True
+
+    def add(self, channel_id: str, object_info: ObjectInfo) -> Optional[FaceChipBatch]:
+        """Adds a record, returns the batch once ``batch_size`` records are in."""
+        row = len(self.__items)
+        for field in self.__shapes:
+            if not self.__fill(field, row, object_info):
+                logging.getLogger(self.name).error(
+                    f"Dropping {channel_id} {object_info.message_id}, its {field} does not fit the batch")
+                return None
+        self.__items.append((channel_id, object_info))
+        if len(self.__items) >= self.__batch_size:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[FaceChipBatch]:
+        """Returns what was added since the last batch, None when nothing was."""
+        if not self.__items:
+            return None
+        n = len(self.__items)
+        batch = FaceChipBatch({field: buffer[:n] for field, buffer in self.__buffers.items()}, self.__items)
+        self.__items = []
+        return batch
+
+    def collect(self, consumer: FsbQueueConsumer, timeout: Optional[float] = None) -> Optional[FaceChipBatch]:
+        """Fills a batch from ``consumer``, returning it when full or, partially filled, once ``timeout``
+        seconds elapsed. None when nothing arrived.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            items = consumer.get_many(max_items=self.__batch_size - len(self.__items), timeout=remaining)
+            for channel_id, object_info in items:
+                batch = self.add(channel_id, object_info)
+                if batch is not None:
+                    return batch
+            if deadline is not None and time.monotonic() >= deadline:
+                return self.flush()
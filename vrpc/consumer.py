@@ -1,40 +1,129 @@
-import glob
 import logging
 import os
-import struct
+import queue
 import threading
-
-import cv2
-import numpy as np
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Set, Tuple
 
 from .data_models.converter import get_mat_from_ocvmat
+from .data_models.data import ObjectInfo
 from .fsb_queue import FsbQueueConsumer
-from .utils import get_folder, get_session_folder
 
 LOGGER = logging.getLogger("consumer")
 
+_STATS_INTERVAL: float = 10.0
+
+
+def decode_face_chips(channel_id: str, item: ObjectInfo):
+    LOGGER.info(f"{channel_id} {item.message_id}")
+    try:
+        face_chip_cv_mat = get_mat_from_ocvmat(item.face_chip)
+        extended_face_chip_cv_mat = get_mat_from_ocvmat(item.extended_face_chip)
+    except Exception as e:
+        pass
+
+
+@dataclass
+class WorkerStats:
+    """``lag`` is how long, in seconds, the last record waited between being read and being handled."""
+    worker: int
+    channels: int
+    processed: int
+    pending: int
+    records_per_second: float
+    lag: float
+
+
+class _Worker(threading.Thread):
+    def __init__(self, index: int, handler: Callable[[str, ObjectInfo], None], max_pending: int) -> None:
+        super().__init__(name=f"ConsumerWorker{index}", daemon=True)
+        self.index: int = index
+        self.queue: "queue.Queue[Optional[Tuple[float, str, ObjectInfo]]]" = queue.Queue(max_pending)
+        self.channels: Set[str] = set()
+        self.__handler: Callable[[str, ObjectInfo], None] = handler
+        self.__processed: int = 0
+        self.__lag: float = 0.0
+        self.__last_stats: Tuple[float, int] = (time.monotonic(), 0)
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                break
+            read_time, channel_id, item = entry
+            try:
+                self.__handler(channel_id, item)
+            except Exception as e:
+                LOGGER.exception(f"Handler failed for {channel_id} {item.message_id} {e}")
+            self.__lag = time.monotonic() - read_time
+            self.__processed += 1
+
+    def stats(self) -> WorkerStats:
+        """Throughput is measured since the previous call."""
+        now, processed = time.monotonic(), self.__processed
+        last_time, last_processed = self.__last_stats
+        self.__last_stats = (now, processed)
+        return WorkerStats(self.index, len(self.channels), processed, self.queue.qsize(),
+                           (processed - last_processed) / max(now - last_time, 1e-9), self.__lag)
+
 
 class Consumer(threading.Thread):
-    def __init__(self, queu_id=0) -> None:
+    """Reads the queue and hands every record to one of ``workers`` threads, one per core by default.
+
+    A channel is pinned to a worker by the hash of its id, so its records are handled in order while
+    different channels are handled in parallel. A worker holds at most ``max_pending`` records, past
+    that reading waits for it. ``handler`` receives the channel id and the record.
+    """
+    def __init__(self,
+                 queu_id=0,
+                 workers: int = 0,
+                 handler: Optional[Callable[[str, ObjectInfo], None]] = None,
+                 max_pending: int = 1024) -> None:
         super().__init__()
         self.__is_shut_down = threading.Event()
         self.__already_shutting_down = False
         self.__fsb_q = FsbQueueConsumer(queu_id)
+        handler = handler if handler is not None else decode_face_chips
+        self.__workers: List[_Worker] = [
+            _Worker(i, handler, max_pending) for i in range(workers if workers > 0 else os.cpu_count() or 1)
+        ]
+
+    def get_worker(self, channel_id: str) -> int:
+        # crc32 rather than hash(), which changes from one process to the next
+        return zlib.crc32(channel_id.encode()) % len(self.__workers)
+
+    def stats(self) -> List[WorkerStats]:
+        return [worker.stats() for worker in self.__workers]
+
+    def __dispatch(self, read_time: float, channel_id: str, item: ObjectInfo):
+        worker = self.__workers[self.get_worker(channel_id)]
+        worker.channels.add(channel_id)
+        # Waits even once stopping, the cursor is past the whole batch already and the worker keeps taking
+        worker.queue.put((read_time, channel_id, item))
 
     def run(self):
-        count = 0
-        LOGGER.info(f"Start")
+        LOGGER.info(f"Start with {len(self.__workers)} workers")
+        for worker in self.__workers:
+            worker.start()
+        last_stats = time.monotonic()
         while not self.__is_shut_down.is_set():
-            ret = self.__fsb_q.get()
-            if ret is None:
-                continue
-            channel_id, item = ret
-            LOGGER.info(f"{channel_id} {item.message_id}")
-            try:
-                face_chip_cv_mat = get_mat_from_ocvmat(item.face_chip)
-                extended_face_chip_cv_mat = get_mat_from_ocvmat(item.extended_face_chip)
-            except Exception as e:
-                pass
+            items = self.__fsb_q.get_many(max_items=64)
+            read_time = time.monotonic()
+            for channel_id, item in items:
+                self.__dispatch(read_time, channel_id, item)
+            if read_time - last_stats >= _STATS_INTERVAL:
+                last_stats = read_time
+                for stats in self.stats():
+                    LOGGER.info(f"Worker {stats.worker}: {stats.channels} channels {stats.processed} records "
+                                f"{stats.records_per_second:.1f} records/s {stats.pending} pending "
+                                f"lag {stats.lag * 1000:.1f} ms")
+        for worker in self.__workers:
+            # What was dispatched is handled before the workers end
+            worker.queue.put(None)
+        for worker in self.__workers:
+            worker.join()
         self.__fsb_q.stop()
         LOGGER.info(f"End")
 
@@ -1,21 +1,164 @@
 import logging
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple, cast
 
+import cv2
 import numpy as np
 
-from .data import OcvMat
+from .data import ObjectInfo, OcvMat
 
 LOGGER = logging.getLogger("MeraFace_recognition_engine_logs")
-def get_ocvmat_from_mat(mat) -> OcvMat:
-    (height, width, data_size) = mat.shape
-    ocvmat = OcvMat(rows=height, cols=width, mat_data_type=mat.dtype.num, mat_data_size=data_size)
-    ocvmat.mat_data = bytes(mat.data)
+
+
+class Codec(IntEnum):
+    RAW = 0
+    JPEG = 1
+    PNG = 2
+    WEBP = 3
+
+
+@dataclass
+class ImageCodec:
+    """How an image is stored in an OcvMat, ``quality`` -1 keeps the OpenCV default of the codec.
+
+    ``quality`` is the JPEG or WebP quality from 0 to 100, or the PNG compression level from 0 to 9.
+    """
+    codec: Codec = Codec.RAW
+    quality: int = -1
+
+
+_EXTENSIONS: Dict[Codec, str] = {Codec.JPEG: ".jpg", Codec.PNG: ".png", Codec.WEBP: ".webp"}
+_QUALITY_FLAGS: Dict[Codec, int] = {
+    Codec.JPEG: cv2.IMWRITE_JPEG_QUALITY,
+    Codec.PNG: cv2.IMWRITE_PNG_COMPRESSION,
+    Codec.WEBP: cv2.IMWRITE_WEBP_QUALITY,
+}
+
+# mat_data_type is an OpenCV 4 type, CV_MAKETYPE(depth, channels), whatever OpenCV is installed
+_CV_CN_SHIFT = 3
+_CV_DEPTH_MASK = (1 << _CV_CN_SHIFT) - 1
+_CV_DEPTHS: Tuple[np.dtype, ...] = tuple(
+    np.dtype(t) for t in (np.uint8, np.int8, np.uint16, np.int16, np.int32, np.float32, np.float64, np.float16))
+# What older producers stored instead, the NumPy type number
+_NUMPY_TYPES: Dict[int, np.dtype] = {np.dtype(t).num: np.dtype(t) for t in set(np.sctypeDict.values())}
+
+# Chips go to recognition and stay lossless, the full image is only looked at
+DEFAULT_IMAGE_CODECS: Dict[str, ImageCodec] = {
+    "face_chip": ImageCodec(Codec.PNG, 1),
+    "extended_face_chip": ImageCodec(Codec.PNG, 1),
+    "full_image": ImageCodec(Codec.JPEG, 80),
+}
+
+
+def get_mat_type(dtype: np.dtype, channels: int) -> int:
+    return _CV_DEPTHS.index(np.dtype(dtype)) + ((channels - 1) << _CV_CN_SHIFT)
+
+
+def get_dtype(ocvmat: OcvMat) -> Tuple[np.dtype, int]:
+    """Element type and channel count of a raw OcvMat.
+
+    Older producers stored the NumPy type number in ``mat_data_type``, those are recognized by their
+    channel count or data size not matching the OpenCV type.
+    """
+    depth = ocvmat.mat_data_type & _CV_DEPTH_MASK
+    channels = (ocvmat.mat_data_type >> _CV_CN_SHIFT) + 1
+    if channels == ocvmat.mat_data_size and len(
+            ocvmat.mat_data) == ocvmat.rows * ocvmat.cols * channels * _CV_DEPTHS[depth].itemsize:
+        return (_CV_DEPTHS[depth], channels)
+    return (_NUMPY_TYPES[ocvmat.mat_data_type], ocvmat.mat_data_size)
+
+
+def get_ocvmat_from_mat(mat: np.ndarray, codec: Optional[ImageCodec] = None, copy: bool = False) -> OcvMat:
+    """Wraps a (rows, cols) or (rows, cols, channels) array of any OpenCV depth.
+
+    Raw data is not copied unless ``copy`` is set or the array is not contiguous, ``mat_data`` is then
+    a view of the array and follows its later changes.
+    """
+    (height, width) = mat.shape[:2]
+    channels = mat.shape[2] if mat.ndim == 3 else 1
+    ocvmat = OcvMat(rows=height, cols=width, mat_data_type=get_mat_type(mat.dtype, channels), mat_data_size=channels)
+    if codec is None or codec.codec == Codec.RAW:
+        if copy:
+            ocvmat.mat_data = mat.tobytes()
+        else:
+            # Makes the one copy a non-contiguous array needs, none otherwise, betterproto serializes any buffer
+            ocvmat.mat_data = cast(bytes, np.ascontiguousarray(mat).data.cast("B"))
+        return ocvmat
+    params = [] if codec.quality < 0 else [_QUALITY_FLAGS[codec.codec], codec.quality]
+    is_encoded, encoded = cv2.imencode(_EXTENSIONS[codec.codec], mat, params)
+    if not is_encoded:
+        LOGGER.error(f"Unable to encode the matrix as {codec.codec.name}, storing it raw")
+        ocvmat.mat_data = mat.tobytes()
+        return ocvmat
+    ocvmat.codec = int(codec.codec)
+    ocvmat.mat_data = encoded.tobytes()
     return ocvmat
 
 
-def get_mat_from_ocvmat(ocvmat: OcvMat):
+def get_mat_from_ocvmat(ocvmat: OcvMat, copy: bool = False) -> Optional[np.ndarray]:
+    """Returns the image as a (rows, cols, channels) array, or None when it can not be decoded.
+
+    A raw image is a read only view of ``mat_data`` unless ``copy`` asks for a writable copy.
+    """
     mat = None
     try:
-        mat = np.frombuffer(ocvmat.mat_data, dtype=np.uint8).reshape(ocvmat.rows, ocvmat.cols, ocvmat.mat_data_size)
-    except ValueError:
+        if ocvmat.codec != Codec.RAW:
+            mat = cv2.imdecode(np.frombuffer(ocvmat.mat_data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            if mat is None:
+                LOGGER.error(f"Dropping the matrix, unable to decode it as {Codec(ocvmat.codec).name}")
+                return None
+            return mat.reshape(ocvmat.rows, ocvmat.cols, -1)
+        dtype, channels = get_dtype(ocvmat)
+        mat = np.frombuffer(ocvmat.mat_data, dtype=dtype).reshape(ocvmat.rows, ocvmat.cols, channels)
+        if copy:
+            mat = mat.copy()
+        else:
+            # mat_data may be a writable view of the producer array or of a mapped segment
+            mat.flags.writeable = False
+    except (ValueError, KeyError, IndexError):
         LOGGER.error("Dropping the matrix due to value error")
     return mat
+
+
+def get_mats_from_ocvmats(ocvmats: Sequence[OcvMat], out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Stacks images of one shape and type into a single (N, rows, cols, channels) array.
+
+    The array is allocated once, or ``out`` is filled when given. Every image is decoded once. Raises
+    ValueError when an image does not match the first one or can not be decoded.
+    """
+    first = None
+    if out is None:
+        if not ocvmats:
+            raise ValueError("No image to stack")
+        first = get_mat_from_ocvmat(ocvmats[0])
+        if first is None:
+            raise ValueError("Unable to decode the first image")
+        out = np.empty((len(ocvmats), ) + first.shape, dtype=first.dtype)
+    elif len(out) < len(ocvmats):
+        raise ValueError(f"{len(ocvmats)} images do not fit {len(out)} slots")
+    for i, ocvmat in enumerate(ocvmats):
+        mat = first if i == 0 and first is not None else get_mat_from_ocvmat(ocvmat)
+        if mat is None or mat.shape != out.shape[1:] or mat.dtype != out.dtype:
+            raise ValueError(f"Image {i} {None if mat is None else (mat.shape, mat.dtype)} does not match "
+                             f"{(out.shape[1:], out.dtype)}")
+        out[i] = mat
+    return out
+
+
+def get_ocvmats_from_mats(mats: np.ndarray, codec: Optional[ImageCodec] = None) -> List[OcvMat]:
+    """Splits a stacked (N, rows, cols[, channels]) array, raw images are views into its single buffer."""
+    mats = np.ascontiguousarray(mats)
+    return [get_ocvmat_from_mat(mat, codec) for mat in mats]
+
+
+def encode_images(object_info: ObjectInfo, codecs: Mapping[str, ImageCodec] = DEFAULT_IMAGE_CODECS) -> ObjectInfo:
+    """Encodes the raw images of ``object_info`` in place, each with the codec given for its field."""
+    for name, codec in codecs.items():
+        ocvmat: OcvMat = getattr(object_info, name)
+        if ocvmat.codec != Codec.RAW or codec.codec == Codec.RAW or len(ocvmat.mat_data) == 0:
+            continue
+        mat = get_mat_from_ocvmat(ocvmat)
+        if mat is not None:
+            setattr(object_info, name, get_ocvmat_from_mat(mat, codec))
+    return object_info
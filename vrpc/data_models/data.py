@@ -7,6 +7,19 @@ from typing import List
 import betterproto
 
 
+@dataclass
+class BlobRef(betterproto.Message):
+    segment: int = betterproto.int32_field(1)
+    offset: int = betterproto.int64_field(2)
+    length: int = betterproto.int32_field(3)
+
+    __annotations__ = {
+        "segment": int,
+        "offset": int,
+        "length": int,
+    }
+
+
 @dataclass
 class OcvMat(betterproto.Message):
     rows: int = betterproto.int32_field(1)
@@ -14,6 +27,8 @@ class OcvMat(betterproto.Message):
     mat_data_type: int = betterproto.int32_field(3)
     mat_data_size: int = betterproto.int32_field(4)
     mat_data: bytes = betterproto.bytes_field(5)
+    blob: "BlobRef" = betterproto.message_field(6)
+    codec: int = betterproto.int32_field(7)
 
     __annotations__ = {
         "rows": int,
@@ -21,6 +36,8 @@ class OcvMat(betterproto.Message):
         "mat_data_type": int,
         "mat_data_size": int,
         "mat_data": bytes,
+        "blob": "BlobRef",
+        "codec": int,
     }
 
 
@@ -0,0 +1,89 @@
+import dataclasses
+from typing import Any, Callable, Collection, Dict, Optional, Union, cast
+
+import betterproto
+
+from .data import ObjectInfo, OcvMat
+
+_WIRE_LEN_DELIM = 2
+_FIELD_NAMES: Dict[int, str] = {f.metadata["betterproto"].number: f.name for f in dataclasses.fields(ObjectInfo)}
+IMAGE_FIELDS = ("face_chip", "extended_face_chip", "full_image")
+# Always decoded, whatever the projection, it identifies the record
+_KEY_FIELDS = frozenset(("message_id", ))
+
+
+def _lazy_image_field(name: str) -> property:
+    def getter(self: "LazyObjectInfo") -> Any:
+        raw = self.__dict__.get("_lazy_images", {}).pop(name, None)
+        if raw is not None:
+            ocvmat = OcvMat().parse(raw if self.__dict__.get("_lazy_zero_copy", True) else bytes(raw))
+            resolve = self.__dict__.get("_lazy_resolve")
+            if resolve is not None and ocvmat.blob.length > 0:
+                ocvmat = resolve(ocvmat)
+            self.__dict__[name] = ocvmat
+        return self.__dict__[name]
+
+    def setter(self: "LazyObjectInfo", value: Any):
+        self.__dict__.setdefault("_lazy_images", {}).pop(name, None)
+        self.__dict__[name] = value
+
+    return property(getter, setter)
+
+
+class LazyObjectInfo(ObjectInfo):
+    """ObjectInfo whose images are kept encoded and decoded, or fetched from their blob, on first access."""
+    face_chip = _lazy_image_field("face_chip")
+    extended_face_chip = _lazy_image_field("extended_face_chip")
+    full_image = _lazy_image_field("full_image")
+
+
+def parse_object_info(data: Union[bytes, memoryview],
+                      fields: Optional[Collection[str]] = None,
+                      lazy_images: bool = False,
+                      zero_copy: bool = True,
+                      resolve: Optional[Callable[[OcvMat], OcvMat]] = None) -> ObjectInfo:
+    """Parses an ObjectInfo, decoding only what is asked for.
+
+    Only the ``fields`` named are decoded (all of them for None, ``message_id`` always), the others are
+    skipped without being materialized and keep their defaults. With ``lazy_images`` the images are kept
+    encoded in a LazyObjectInfo and decoded on first access, whether projected or not.
+
+    With ``zero_copy`` the ``mat_data`` of every OcvMat is a ``memoryview`` over ``data``, so it stays
+    valid only as long as the underlying buffer does, otherwise it is a copy.
+
+    ``resolve`` fills in the ``mat_data`` of an image stored out of line. When given, the images are
+    always lazy, so a blob is only fetched for an image that is accessed.
+    """
+    view = memoryview(data)
+    rest = bytearray()
+    images: Dict[str, OcvMat] = {}
+    lazy: Dict[str, memoryview] = {}
+    # parse_fields only slices its argument, a view keeps the image payloads uncopied
+    for field in betterproto.parse_fields(cast(bytes, view)):
+        name = _FIELD_NAMES.get(field.number)
+        if name is None:
+            # Unknown to this ObjectInfo, kept unless projected away
+            if fields is None:
+                rest += field.raw
+            continue
+        is_image = name in IMAGE_FIELDS and field.wire_type == _WIRE_LEN_DELIM
+        if is_image and lazy_images:
+            lazy[name] = field.value
+        elif fields is not None and name not in fields and name not in _KEY_FIELDS:
+            continue
+        elif is_image and resolve is not None:
+            lazy[name] = field.value
+        elif is_image:
+            # OcvMat has only integers and bytes, betterproto keeps a memoryview for the bytes as is
+            images[name] = OcvMat().parse(field.value if zero_copy else bytes(field.value))
+        else:
+            rest += field.raw
+    is_lazy = lazy_images or resolve is not None
+    object_info = (LazyObjectInfo if is_lazy else ObjectInfo)().parse(bytes(rest))
+    for name, ocvmat in images.items():
+        setattr(object_info, name, ocvmat)
+    if is_lazy:
+        object_info.__dict__["_lazy_images"] = lazy
+        object_info.__dict__["_lazy_zero_copy"] = zero_copy
+        object_info.__dict__["_lazy_resolve"] = resolve
+    return object_info
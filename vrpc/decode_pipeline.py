@@ -0,0 +1,155 @@
+import collections
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from .data_models.converter import get_mat_from_ocvmat
+from .data_models.data import ObjectInfo
+from .data_models.parser import IMAGE_FIELDS
+from .fsb_queue import FsbQueueConsumer
+
+_READ_INTERVAL: float = 0.1
+_READ_BATCH: int = 64
+
+
+@dataclass
+class DecodePolicy:
+    """What is done to the images of every record.
+
+    ``sizes`` gives the (width, height) a field is resized to, ``color_conversion`` a ``cv2.COLOR_*``
+    code applied to 3 and 4 channel images, -1 for none.
+    """
+    fields: Tuple[str, ...] = IMAGE_FIELDS
+    sizes: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+    color_conversion: int = -1
+    interpolation: int = cv2.INTER_LINEAR
+
+
+@dataclass
+class DecodedRecord:
+    """``images`` maps the fields of the policy to their decoded image, a field without one is left out."""
+    channel_id: str
+    object_info: ObjectInfo
+    images: Dict[str, np.ndarray]
+
+
+def decode_images(object_info: ObjectInfo, policy: DecodePolicy) -> Dict[str, np.ndarray]:
+    images: Dict[str, np.ndarray] = {}
+    for name in policy.fields:
+        ocvmat = getattr(object_info, name)
+        if len(ocvmat.mat_data) == 0:
+            continue
+        mat = get_mat_from_ocvmat(ocvmat)
+        if mat is None:
+            continue
+        size = policy.sizes.get(name)
+        if size is not None and (mat.shape[1], mat.shape[0]) != tuple(size):
+            mat = cv2.resize(mat, tuple(size), interpolation=policy.interpolation)
+        if policy.color_conversion >= 0 and mat.ndim == 3 and mat.shape[2] in (3, 4):
+            mat = cv2.cvtColor(mat, policy.color_conversion)
+        images[name] = mat
+    return images
+
+
+class DecodePipeline:
+    """Reads records from ``consumer`` ahead of decoding their images on a pool of ``workers`` threads.
+
+    OpenCV releases the GIL while decoding and resizing, so the threads run in parallel. Records come
+    out in order within each channel, a slow image of one channel never holds back the others. At most
+    ``max_in_flight`` records are read and not taken out yet, past that reading waits.
+    """
+    def __init__(self,
+                 consumer: FsbQueueConsumer,
+                 policy: Optional[DecodePolicy] = None,
+                 workers: int = 0,
+                 max_in_flight: int = 256) -> None:
+        self.name = "DecodePipeline"
+        self.__consumer: FsbQueueConsumer = consumer
+        self.__policy: DecodePolicy = policy if policy is not None else DecodePolicy()
+        self.__pool = ThreadPoolExecutor(workers if workers > 0 else os.cpu_count() or 1,
+                                         thread_name_prefix=self.name)
+        self.__in_flight = threading.Semaphore(max_in_flight)
+        self.__lock = threading.Lock()
+        # Decodes of each channel in read order, handed out as soon as the ones before them are done
+        self.__pending: Dict[str, Deque[Future]] = {}
+        self.__ready: "queue.Queue[Optional[DecodedRecord]]" = queue.Queue()
+        self.__is_stopped = threading.Event()
+        self.__reader = threading.Thread(target=self.__read, name=self.name, daemon=True)
+        self.__reader.start()
+
+    def __reserve(self) -> int:
+        """Takes room for up to a batch of records, waiting for at least one. Returns 0 once stopped."""
+        while not self.__in_flight.acquire(timeout=_READ_INTERVAL):
+            if self.__is_stopped.is_set():
+                return 0
+        room = 1
+        while room < _READ_BATCH and self.__in_flight.acquire(blocking=False):
+            room += 1
+        return room
+
+    def __read(self):
+        while not self.__is_stopped.is_set():
+            # Never reads more than there is room for, a record read is always submitted
+            room = self.__reserve()
+            if room == 0:
+                return
+            items = self.__consumer.get_many(max_items=room, timeout=_READ_INTERVAL)
+            for _ in range(room - len(items)):
+                self.__in_flight.release()
+            for channel_id, object_info in items:
+                future = self.__pool.submit(self.__decode, channel_id, object_info)
+                with self.__lock:
+                    self.__pending.setdefault(channel_id, collections.deque()).append(future)
+                future.add_done_callback(lambda _, channel_id=channel_id: self.__on_decoded(channel_id))
+
+    def __decode(self, channel_id: str, object_info: ObjectInfo) -> DecodedRecord:
+        try:
+            images = decode_images(object_info, self.__policy)
+        except Exception as e:
+            logging.getLogger(self.name).exception(f"Unable to decode {channel_id} {object_info.message_id} {e}")
+            images = {}
+        return DecodedRecord(channel_id, object_info, images)
+
+    def __on_decoded(self, channel_id: str):
+        with self.__lock:
+            pending = self.__pending[channel_id]
+            while pending and pending[0].done():
+                self.__ready.put(pending.popleft().result())
+
+    def get(self, timeout: Optional[float] = _READ_INTERVAL) -> Optional[DecodedRecord]:
+        """Returns the next decoded record, waiting up to ``timeout`` seconds (forever for None)."""
+        try:
+            record = self.__ready.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if record is None:
+            # Stopped, the next caller has to see it as well
+            self.__ready.put(None)
+            return None
+        self.__in_flight.release()
+        return record
+
+    def get_many(self, max_items: int = 64, timeout: Optional[float] = _READ_INTERVAL) -> List[DecodedRecord]:
+        """Returns what is decoded already, up to ``max_items``, waiting up to ``timeout`` only for the first."""
+        records: List[DecodedRecord] = []
+        record = self.get(timeout)
+        while record is not None:
+            records.append(record)
+            if len(records) >= max_items:
+                break
+            record = self.get(timeout=0)
+        return records
+
+    def stop(self):
+        """Stops reading, the consumer is left to its owner."""
+        self.__is_stopped.set()
+        self.__reader.join()
+        self.__pool.shutdown(wait=True)
+        self.__ready.put(None)
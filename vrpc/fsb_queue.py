@@ -1,5 +1,11 @@
+import bisect
+import collections
+import copy
+import dataclasses
+import functools
 import glob
 import logging
+import mmap
 import ntpath
 import os
 import pathlib
@@ -8,10 +14,20 @@ import struct
 import sys
 import threading
 import time
+import weakref
+from dataclasses import dataclass
 from enum import Enum
-from typing import Any, BinaryIO, Callable, Iterator, List, Optional, TextIO, Tuple
-
-from .data_models.data import ObjectInfo
+from typing import (Any, BinaryIO, Callable, Collection, Deque, Dict, FrozenSet, Iterable, List, Mapping, Optional,
+                    Set, TextIO, Tuple, Union)
+
+from .data_models.data import BlobRef, ObjectInfo, OcvMat
+from .data_models.parser import IMAGE_FIELDS, parse_object_info
+from .fsb_queue_groups import DEFAULT_GROUP, ConsumerGroups, check_group_name, register_group
+from .fsb_queue_notifier import FILE_CREATED, FILE_DELETED, FsbQueueDoorbell, FsbQueueNotifier
+from .fsb_queue_compression import (BlockCodec, BlockCodecs, Compression, CompressionPolicy, is_available,
+                                    load_dictionary, store_dictionary, train_dictionary)
+from .fsb_queue_ring import FsbQueueRing, get_ring_file_name
+from .fsb_queue_scheduler import FsbQueueScheduler
 from .utils import get_folder, get_int, get_session_folder
 
 
@@ -19,22 +35,710 @@ def get_queue_base_folder() -> str:
     return "/session/"
 
 
+def get_queue_folder(queue_id: int) -> str:
+    return os.path.join(get_queue_base_folder(), f"{queue_id:05d}")
+
+
 class Mode(Enum):
     UNKNOWN = 0
     PRODUCER = 1
     CONSUMER = 2
 
 
-MAX_RECORDS = 100
 _QUEUE_EXTENSION = ".fsbq"
+_BLOB_EXTENSION = ".fsbb"
 _WRITE_SESSION_EXTENSION = ".fsws"
 _READ_SESSION_EXTENSION = ".fsrs"
 _FUNC_TYPE_DATA: int = 1
 _FUNC_TYPE_EOF: int = 2
+_FUNC_TYPE_NONE: int = 0
+# A compressed batch of data records, followed by its length, _BLOCK_HEADER and the compressed records
+_FUNC_TYPE_BLOCK: int = 3
+_BLOCK_HEADER = struct.Struct("<BIi")
+_RECYCLE_FOLDER = ".recycle"
+_HEADER_SIZE = struct.calcsize("<i")
+_RECORD_HEADER_SIZE = struct.calcsize("<ii")
+_POLL_INTERVAL: float = 0.1
+_POLL_GLOB_INTERVAL: float = 5.0
+_SAFETY_NET_GLOB_INTERVAL: float = 60.0
+_RING_FULL_INTERVAL: float = 0.001
+_RING_ATTACH_INTERVAL: float = 1.0
+_DROP_LOG_INTERVAL: float = 10.0
+_QUOTA_RESCAN_INTERVAL: float = 1.0
+
+
+class Durability(Enum):
+    NONE = 0
+    FLUSH = 1
+    FDATASYNC_RECORDS = 2
+    FDATASYNC_INTERVAL = 3
+    FDATASYNC_ROTATION = 4
+
+
+@dataclass
+class DurabilityPolicy:
+    """How hard segment and session writes are pushed towards the disk.
+
+    ``records`` is used by ``FDATASYNC_RECORDS`` and ``interval_ms`` by ``FDATASYNC_INTERVAL``.
+    Every fdatasync mode also syncs when a segment is rotated or the queue is stopped.
+    """
+    mode: Durability = Durability.FLUSH
+    records: int = 1
+    interval_ms: int = 1000
+
+
+_SYNC_NONE: int = 0
+_SYNC_FLUSH: int = 1
+_SYNC_DATA: int = 2
+_fdatasync: Callable[[int], None] = getattr(os, "fdatasync", os.fsync)
+
+
+def _sync_file(file: Optional[BinaryIO], level: int):
+    if file is None:
+        return
+    if level >= _SYNC_FLUSH:
+        file.flush()
+    if level >= _SYNC_DATA:
+        _fdatasync(file.fileno())
+
+
+class _DurabilitySyncer:
+    def __init__(self, policy: Optional[DurabilityPolicy]) -> None:
+        self.__policy: DurabilityPolicy = policy if policy is not None else DurabilityPolicy()
+        self.__pending_records: int = 0
+        self.__last_sync: float = time.monotonic()
+
+    def on_commit(self, records: int) -> int:
+        mode = self.__policy.mode
+        if mode == Durability.NONE:
+            return _SYNC_NONE
+        if mode in (Durability.FLUSH, Durability.FDATASYNC_ROTATION):
+            return _SYNC_FLUSH
+        self.__pending_records += records
+        if mode == Durability.FDATASYNC_RECORDS:
+            is_due = self.__pending_records >= self.__policy.records
+        else:
+            is_due = (time.monotonic() - self.__last_sync) * 1000 >= self.__policy.interval_ms
+        if not is_due:
+            return _SYNC_FLUSH
+        self.__pending_records = 0
+        self.__last_sync = time.monotonic()
+        return _SYNC_DATA
+
+    def on_rotation(self) -> int:
+        mode = self.__policy.mode
+        if mode == Durability.NONE:
+            return _SYNC_NONE
+        if mode == Durability.FLUSH:
+            return _SYNC_FLUSH
+        self.__pending_records = 0
+        self.__last_sync = time.monotonic()
+        return _SYNC_DATA
+
+
+_CURSOR_FORMAT = "<iQQ"
+_CURSOR_SIZE = struct.calcsize(_CURSOR_FORMAT)
+_GENERATION_FORMAT = "<Q"
+_CURSOR_FILE_SIZE = _CURSOR_SIZE + struct.calcsize(_GENERATION_FORMAT)
+_CURSOR_READ_RETRIES = 1000
+
+
+class _CursorFile:
+    """Session file (``.fsws``/``.fsrs``) mapped in memory.
+
+    The first bytes keep the historical ``<iQQ`` layout, a generation counter follows it.
+    The writer makes the generation odd while it stores the record and even once it is done,
+    so a reader in another process can detect and retry a torn read. A generation that stays odd
+    belongs to a writer killed in the middle of a store, the last complete record is used instead.
+    """
+    def __init__(self, file_name: str, writable: bool = True) -> None:
+        self.name = "_CursorFile"
+        self.__file_name = file_name
+        self.__writable = writable
+        self.__fd: Optional[int] = None
+        self.__mmap: Optional[mmap.mmap] = None
+        self.__has_generation: bool = False
+        self.__generation: int = 0
+        self.__last_read: Optional[Tuple[int, int, int]] = None
+        self.__torn_generation: Optional[int] = None
+
+    def __map(self) -> Optional[mmap.mmap]:
+        if self.__mmap is not None:
+            return self.__mmap
+        try:
+            if self.__writable:
+                self.__fd = os.open(self.__file_name, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0))
+                if os.fstat(self.__fd).st_size < _CURSOR_FILE_SIZE:
+                    os.ftruncate(self.__fd, _CURSOR_FILE_SIZE)
+                self.__mmap = mmap.mmap(self.__fd, _CURSOR_FILE_SIZE)
+            else:
+                self.__fd = os.open(self.__file_name, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                size = os.fstat(self.__fd).st_size
+                if size < _CURSOR_SIZE:
+                    os.close(self.__fd)
+                    self.__fd = None
+                    return None
+                self.__mmap = mmap.mmap(self.__fd, min(size, _CURSOR_FILE_SIZE), access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError) as e:
+            if self.__fd is not None:
+                os.close(self.__fd)
+                self.__fd = None
+            if self.__writable:
+                logging.getLogger(self.name).fatal(f"Unexpected session file error {self.__file_name} {e}")
+            return None
+        self.__has_generation = len(self.__mmap) >= _CURSOR_FILE_SIZE
+        if self.__has_generation:
+            self.__generation = struct.unpack_from(_GENERATION_FORMAT, self.__mmap, _CURSOR_SIZE)[0] & ~1
+        return self.__mmap
+
+    def read(self) -> Tuple[int, int, int]:
+        m = self.__map()
+        if m is None:
+            return (0, 0, 0)
+        generation = 0
+        for _ in range(_CURSOR_READ_RETRIES):
+            if self.__has_generation:
+                generation = struct.unpack_from(_GENERATION_FORMAT, m, _CURSOR_SIZE)[0]
+                if generation & 1:
+                    if generation == self.__torn_generation:
+                        break
+                    continue
+            file_counter, message_counter, offset = struct.unpack_from(_CURSOR_FORMAT, m, 0)
+            if not self.__has_generation or generation == struct.unpack_from(_GENERATION_FORMAT, m, _CURSOR_SIZE)[0]:
+                self.__last_read = (file_counter, message_counter, offset)
+                return self.__last_read
+        if self.__torn_generation != generation:
+            self.__torn_generation = generation
+            logging.getLogger(self.name).error(f"Session file {self.__file_name} left torn at generation {generation}")
+        if self.__last_read is None:
+            file_counter, message_counter, offset = struct.unpack_from(_CURSOR_FORMAT, m, 0)
+            return (file_counter, message_counter, offset)
+        return self.__last_read
+
+    def write(self, file_counter: int, message_counter: int, offset: int):
+        m = self.__map()
+        if m is None:
+            return
+        self.__generation += 1
+        struct.pack_into(_GENERATION_FORMAT, m, _CURSOR_SIZE, self.__generation)
+        struct.pack_into(_CURSOR_FORMAT, m, 0, file_counter, message_counter, offset)
+        self.__generation += 1
+        struct.pack_into(_GENERATION_FORMAT, m, _CURSOR_SIZE, self.__generation)
+
+    def sync(self, level: int):
+        # Stores into a shared mapping are visible to other processes at once, only a data sync needs work.
+        if self.__mmap is not None and level >= _SYNC_DATA:
+            self.__mmap.flush()
+
+    def close(self):
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__mmap = None
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+
+def _parse_segment_file_name(file_name: str, extension: str = _QUEUE_EXTENSION) -> Optional[Tuple[str, int]]:
+    stem, file_extension = ntpath.splitext(ntpath.basename(file_name))
+    if file_extension != extension or stem.startswith("."):
+        return None
+    parts = stem.split("_")
+    if len(parts) != 2:
+        return None
+    return (parts[0], get_int(parts[1]))
+
+
+def get_segment_file_name(q_folder: str, channel_id: str, file_counter: int, extension: str = _QUEUE_EXTENSION) -> str:
+    return os.path.join(q_folder, f"{channel_id}_{file_counter:05d}{extension}")
+
+
+def _get_cursor_file_name(q_folder: str, channel_id: str, group: str = DEFAULT_GROUP) -> str:
+    if group == DEFAULT_GROUP:
+        return os.path.join(q_folder, f".{channel_id}{_READ_SESSION_EXTENSION}")
+    return os.path.join(q_folder, f".{channel_id}.{group}{_READ_SESSION_EXTENSION}")
+
+
+def _is_segment_passed(q_folder: str, channel_id: str, file_counter: int, groups: List[str]) -> bool:
+    """True once the cursor of every group in ``groups`` is past the segment."""
+    for group in groups:
+        cursor = _CursorFile(_get_cursor_file_name(q_folder, channel_id, group), writable=False)
+        try:
+            if cursor.read()[0] <= file_counter:
+                return False
+        finally:
+            cursor.close()
+    return True
+
+
+def purge_segment(q_folder: str, channel_id: str, file_counter: int, groups: List[str]):
+    """Deletes a segment whether or not it was read, the cursors of ``groups`` not past it yet move to the next one.
+
+    A consumer reading the segment at that moment goes on until its end, the file stays readable while open.
+    """
+    for group in groups:
+        file_name = _get_cursor_file_name(q_folder, channel_id, group)
+        if not os.path.exists(file_name):
+            # A group that never read the channel starts at whatever segment is left
+            continue
+        cursor = _CursorFile(file_name)
+        try:
+            if cursor.read()[0] <= file_counter:
+                cursor.write(file_counter + 1, 0, 0)
+        finally:
+            cursor.close()
+    _get_segment_index(q_folder).remove(channel_id, file_counter)
+    for extension in (_QUEUE_EXTENSION, _BLOB_EXTENSION):
+        try:
+            os.remove(get_segment_file_name(q_folder, channel_id, file_counter, extension))
+        except FileNotFoundError:
+            pass
+
+
+def _count_frames(file_name: str, offset: int) -> Tuple[int, int, bool]:
+    """Counts the records of the complete frames of a segment from ``offset`` on, reading their headers only.
+
+    Returns the records, the offset counting stopped at and whether the segment has ended.
+    """
+    records = 0
+    try:
+        with open(file_name, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            while offset + _HEADER_SIZE <= size:
+                f.seek(offset)
+                b = f.read(_RECORD_HEADER_SIZE + _BLOCK_HEADER.size)
+                function_type = struct.unpack_from("<i", b)[0]
+                if function_type == _FUNC_TYPE_EOF:
+                    return (records, offset, True)
+                if function_type not in (_FUNC_TYPE_DATA, _FUNC_TYPE_BLOCK) or len(b) < _RECORD_HEADER_SIZE:
+                    break
+                length = struct.unpack_from("<i", b, _HEADER_SIZE)[0]
+                if offset + _RECORD_HEADER_SIZE + length > size:
+                    break
+                if function_type == _FUNC_TYPE_DATA:
+                    records += 1
+                elif len(b) == _RECORD_HEADER_SIZE + _BLOCK_HEADER.size:
+                    records += _BLOCK_HEADER.unpack_from(b, _RECORD_HEADER_SIZE)[2]
+                else:
+                    break
+                offset += _RECORD_HEADER_SIZE + length
+    except FileNotFoundError:
+        # Deleted meanwhile, nothing is appended to it anymore
+        return (records, offset, True)
+    return (records, offset, False)
+
+
+class _SegmentIndex:
+    """Sorted segment file counters of every channel of a queue folder, with what each segment holds.
+
+    Built with one directory scan and then kept up to date from rotations, deletions and file watch
+    events, so finding the first, last or next segment of a channel never touches the disk. While
+    ``is_live`` is False nobody feeds it watch events and a channel without a known segment is
+    rescanned on lookup.
+
+    The bytes of a segment include its blob segment. Producers of the process report the bytes and
+    records of the segments they write, ``refresh_usage`` counts those of the segments of other
+    processes from their frame headers, segments it did not count yet hold their file size and no records.
+    """
+    def __init__(self, q_folder: str) -> None:
+        self.__q_folder: str = q_folder
+        self.__lock = threading.Lock()
+        self.__build_lock = threading.Lock()
+        self.__segments: Dict[str, List[int]] = {}
+        self.__usages: Dict[Tuple[str, int], Tuple[int, int]] = {}
+        self.__channel_usages: Dict[str, Tuple[int, int]] = {}
+        self.__usage: Tuple[int, int] = (0, 0)
+        # Segments a producer of the process reports the usage of
+        self.__reported: Set[Tuple[str, int]] = set()
+        # How far the frames of the segments of other processes are counted, -1 once they ended
+        self.__counted: Dict[Tuple[str, int], int] = {}
+        # Adds and removals that happen while a scan is in progress, replayed on top of its result
+        self.__changes: Optional[List[Tuple[bool, str, int]]] = None
+        self.__watch_lock = threading.Lock()
+        self.__watch: Optional[FsbQueueNotifier] = None
+        self.__watch_users: int = 0
+        self.__feeds: int = 0
+        self.build()
+
+    @property
+    def is_live(self) -> bool:
+        return self.__feeds > 0
+
+    def attach(self):
+        """A file watch feeds ``on_file_changed`` from now on, the index has to be built after it started."""
+        with self.__lock:
+            self.__feeds += 1
+
+    def detach(self):
+        with self.__lock:
+            self.__feeds -= 1
+
+    def watch(self) -> bool:
+        """Follows the segments created and deleted in the folder until ``unwatch``, with one watch for all
+        the callers. Returns False when the platform has no file watch.
+        """
+        with self.__watch_lock:
+            if self.__watch is None:
+                watch = FsbQueueNotifier(self.__q_folder, doorbell=False)
+                watch.add_listener(self.on_file_changed)
+                watch.start()
+                if not watch.is_watching_files():
+                    watch.stop()
+                    return False
+                self.__watch = watch
+                self.build()
+                self.attach()
+            self.__watch_users += 1
+            return True
+
+    def unwatch(self):
+        with self.__watch_lock:
+            self.__watch_users -= 1
+            if self.__watch_users == 0 and self.__watch is not None:
+                self.detach()
+                self.__watch.stop()
+                self.__watch = None
+
+    def __scan(self, entries: Iterable[Tuple[str, Callable[[], os.stat_result]]]
+               ) -> Tuple[Dict[str, List[int]], Dict[Tuple[str, int], int]]:
+        segments: Dict[str, List[int]] = {}
+        sizes: Dict[Tuple[str, int], int] = {}
+        blob_sizes: Dict[Tuple[str, int], int] = {}
+        for name, get_stat in entries:
+            segment = _parse_segment_file_name(name)
+            key = segment if segment is not None else _parse_segment_file_name(name, _BLOB_EXTENSION)
+            if key is None:
+                continue
+            try:
+                size = get_stat().st_size
+            except FileNotFoundError:
+                continue
+            if segment is None:
+                blob_sizes[key] = size
+            else:
+                segments.setdefault(key[0], []).append(key[1])
+                sizes[key] = size
+        for file_counters in segments.values():
+            file_counters.sort()
+        for key, size in blob_sizes.items():
+            if key in sizes:
+                sizes[key] += size
+        return segments, sizes
+
+    def build(self):
+        # One scan at a time, each of them owns the list of changes made while it runs
+        with self.__build_lock:
+            with self.__lock:
+                self.__changes = []
+            try:
+                with os.scandir(self.__q_folder) as it:
+                    segments, sizes = self.__scan((entry.name, entry.stat) for entry in list(it))
+            except FileNotFoundError:
+                segments, sizes = {}, {}
+            with self.__lock:
+                changes, self.__changes = self.__changes, None
+                self.__segments = segments
+                self.__usages = {key: self.__merge_usage(key, size) for key, size in sizes.items()}
+                self.__reported &= self.__usages.keys()
+                self.__counted = {key: offset for key, offset in self.__counted.items() if key in self.__usages}
+                self.__channel_usages = {}
+                self.__usage = (0, 0)
+                for key, usage in self.__usages.items():
+                    self.__add_usage(key[0], usage, 1)
+                for is_added, channel_id, file_counter in changes:
+                    self.__apply(is_added, channel_id, file_counter)
+
+    def refresh_channel(self, channel_id: str):
+        files = glob.glob(os.path.join(self.__q_folder, f"{channel_id}_*{_QUEUE_EXTENSION}"))
+        files += glob.glob(os.path.join(self.__q_folder, f"{channel_id}_*{_BLOB_EXTENSION}"))
+        segments, sizes = self.__scan((file, functools.partial(os.stat, file)) for file in files)
+        with self.__lock:
+            for file_counter in self.__segments.get(channel_id, []):
+                if (channel_id, file_counter) not in sizes:
+                    self.__set_usage(channel_id, file_counter, None)
+            self.__segments[channel_id] = segments.get(channel_id, [])
+            for key, size in sizes.items():
+                self.__set_usage(channel_id, key[1], self.__merge_usage(key, size))
+
+    def __merge_usage(self, key: Tuple[str, int], size: int) -> Tuple[int, int]:
+        # What was reported or counted is exact, a preallocated file is larger than its data
+        usage = self.__usages.get(key)
+        if usage is not None and (key in self.__reported or key in self.__counted):
+            return usage
+        return (size, 0)
+
+    def __add_usage(self, channel_id: str, usage: Tuple[int, int], sign: int):
+        channel_usage = self.__channel_usages.get(channel_id, (0, 0))
+        self.__channel_usages[channel_id] = (channel_usage[0] + sign * usage[0], channel_usage[1] + sign * usage[1])
+        self.__usage = (self.__usage[0] + sign * usage[0], self.__usage[1] + sign * usage[1])
+
+    def __set_usage(self, channel_id: str, file_counter: int, usage: Optional[Tuple[int, int]]):
+        key = (channel_id, file_counter)
+        previous = self.__usages.pop(key, None)
+        if previous is not None:
+            self.__add_usage(channel_id, previous, -1)
+        if usage is not None:
+            self.__usages[key] = usage
+            self.__add_usage(channel_id, usage, 1)
+        else:
+            self.__reported.discard(key)
+            self.__counted.pop(key, None)
+
+    def __apply(self, is_added: bool, channel_id: str, file_counter: int):
+        file_counters = self.__segments.setdefault(channel_id, [])
+        i = bisect.bisect_left(file_counters, file_counter)
+        is_present = i < len(file_counters) and file_counters[i] == file_counter
+        if is_added and not is_present:
+            file_counters.insert(i, file_counter)
+            if (channel_id, file_counter) not in self.__usages:
+                self.__set_usage(channel_id, file_counter, (0, 0))
+        elif not is_added and is_present:
+            del file_counters[i]
+            self.__set_usage(channel_id, file_counter, None)
+
+    def __record(self, is_added: bool, channel_id: str, file_counter: int):
+        with self.__lock:
+            self.__apply(is_added, channel_id, file_counter)
+            if self.__changes is not None:
+                self.__changes.append((is_added, channel_id, file_counter))
+
+    def add(self, channel_id: str, file_counter: int):
+        self.__record(True, channel_id, file_counter)
+
+    def remove(self, channel_id: str, file_counter: int):
+        self.__record(False, channel_id, file_counter)
+
+    def set_usage(self, channel_id: str, file_counter: int, size: int, records: int):
+        """Reports what a known segment holds now, its producer does so on every commit."""
+        with self.__lock:
+            if (channel_id, file_counter) in self.__usages:
+                self.__reported.add((channel_id, file_counter))
+                self.__set_usage(channel_id, file_counter, (size, records))
+
+    def refresh_usage(self, channel_id: Optional[str] = None):
+        """Counts what other processes appended to their segments since the last call, to those of
+        ``channel_id`` only unless None. A segment that ended is never read again.
+        """
+        with self.__lock:
+            pending = [(key, self.__counted.get(key, 0)) for key in self.__usages
+                       if (channel_id is None or key[0] == channel_id) and key not in self.__reported
+                       and self.__counted.get(key, 0) >= 0]
+        for key, offset in pending:
+            records, end, is_ended = _count_frames(get_segment_file_name(self.__q_folder, *key), offset)
+            try:
+                blob_size = os.stat(get_segment_file_name(self.__q_folder, *key, _BLOB_EXTENSION)).st_size
+            except FileNotFoundError:
+                blob_size = 0
+            with self.__lock:
+                usage = self.__usages.get(key)
+                if usage is None or key in self.__reported or self.__counted.get(key, 0) != offset:
+                    # Removed, reported or counted by another caller meanwhile
+                    continue
+                self.__counted[key] = -1 if is_ended else end
+                self.__set_usage(key[0], key[1], (end + blob_size, usage[1] + records))
+
+    def usage(self, channel_id: Optional[str] = None) -> Tuple[int, int]:
+        """Bytes and records held by the segments of ``channel_id``, of the whole queue for None."""
+        with self.__lock:
+            return self.__usage if channel_id is None else self.__channel_usages.get(channel_id, (0, 0))
+
+    def first(self, channel_id: str, start: int = 0) -> Optional[int]:
+        """The oldest segment of ``channel_id`` whose counter is ``start`` or more."""
+        file_counters = self.__segments.get(channel_id)
+        if not self.is_live and (not file_counters or file_counters[-1] < start):
+            # Without watch events segments another process created since are only found on disk
+            self.refresh_channel(channel_id)
+            file_counters = self.__segments.get(channel_id)
+        if not file_counters:
+            return None
+        i = bisect.bisect_left(file_counters, start)
+        return file_counters[i] if i < len(file_counters) else None
+
+    def channels(self) -> List[str]:
+        """Channels with at least one segment."""
+        with self.__lock:
+            return [channel_id for channel_id, file_counters in self.__segments.items() if file_counters]
+
+    def last(self, channel_id: str) -> Optional[int]:
+        file_counters = self.__segments.get(channel_id)
+        return file_counters[-1] if file_counters else None
+
+    def has_next(self, channel_id: str, file_counter: int) -> bool:
+        file_counters = self.__segments.get(channel_id)
+        return file_counters is not None and len(file_counters) > 0 and file_counters[-1] > file_counter
+
+    def on_file_changed(self, file_name: str, kind: int):
+        if kind == FILE_CREATED or kind == FILE_DELETED:
+            parsed = _parse_segment_file_name(file_name)
+            if parsed is not None:
+                if kind == FILE_CREATED:
+                    self.add(*parsed)
+                else:
+                    self.remove(*parsed)
+
+
+_segment_indexes: Dict[str, _SegmentIndex] = {}
+_segment_indexes_lock = threading.Lock()
+
+
+def _get_segment_index(q_folder: str) -> _SegmentIndex:
+    key = os.path.abspath(q_folder)
+    with _segment_indexes_lock:
+        index = _segment_indexes.get(key)
+        if index is None:
+            index = _SegmentIndex(key)
+            _segment_indexes[key] = index
+        return index
+
+
+def _drop_segment_index(q_folder: str):
+    with _segment_indexes_lock:
+        _segment_indexes.pop(os.path.abspath(q_folder), None)
+
+
+class FsbQueueSegments:
+    """The segments of a queue as the producers and consumers of the process see them, for tools that
+    look after a queue from outside of them. Segments are identified by channel and file counter.
+    """
+    def __init__(self, queue_id: int) -> None:
+        self.folder: str = get_queue_folder(queue_id)
+        self.__index: _SegmentIndex = _get_segment_index(self.folder)
+
+    def refresh(self):
+        """Rescans the folder, what other processes created, deleted or appended is only known afterwards."""
+        self.__index.build()
+        self.__index.refresh_usage()
+
+    def channels(self) -> List[str]:
+        return self.__index.channels()
+
+    def first(self, channel_id: str, start: int = 0) -> Optional[int]:
+        return self.__index.first(channel_id, start)
+
+    def last(self, channel_id: str) -> Optional[int]:
+        return self.__index.last(channel_id)
+
+    def usage(self, channel_id: Optional[str] = None) -> Tuple[int, int]:
+        return self.__index.usage(channel_id)
+
+    def file_name(self, channel_id: str, file_counter: int) -> str:
+        return get_segment_file_name(self.folder, channel_id, file_counter)
+
+    def purge(self, channel_id: str, file_counter: int, groups: List[str]):
+        purge_segment(self.folder, channel_id, file_counter, groups)
+
+
+@dataclass
+class RotationPolicy:
+    """When a producer closes its segment and starts the next one, whichever limit is hit first.
+
+    Zero disables a limit. Limits are checked before a record is appended, so a segment only
+    grows past ``max_bytes`` when a single record is larger than that, and ``max_age_ms`` is
+    only noticed on the next put.
+    """
+    max_bytes: int = 16 * 1024 * 1024
+    max_records: int = 0
+    max_age_ms: int = 0
+
+
+@dataclass
+class AllocationPolicy:
+    """How segment files are created and retired.
+
+    ``preallocate`` reserves ``RotationPolicy.max_bytes`` with fallocate when a segment is opened.
+    ``recycle_pool_size`` lets the consumer keep up to that many consumed segments in a ``.recycle``
+    folder, which the producer renames and overwrites instead of creating a new file.
+    """
+    preallocate: bool = False
+    recycle_pool_size: int = 0
+
+
+@dataclass
+class CheckpointPolicy:
+    """When a consumer persists its in-memory cursor to the ``.fsrs`` session file.
+
+    The cursor is written once ``records`` records were read or ``interval_ms`` elapsed since the
+    last checkpoint, whichever comes first; zero disables that trigger. Stop always checkpoints and
+    the end of a segment resets the session file.
+    """
+    records: int = 1
+    interval_ms: int = 0
+
+
+@dataclass
+class BlobPolicy:
+    """Stores image payloads out of line, in a ``.fsbb`` blob segment paired with every segment.
+
+    The ``mat_data`` of images at least ``min_bytes`` long goes to the blob segment and the record
+    keeps only a BlobRef to it, so reading the records never pays for the image I/O. Consumers
+    resolve such an image on first access and blob segments are deleted with their segment.
+    """
+    enabled: bool = False
+    min_bytes: int = 4096
+
+
+@dataclass
+class RingPolicy:
+    """Hands records to a consumer on the same host through a shared memory ring instead of the segments.
+
+    The ring is a ``.{channel}.fsrb`` file of ``capacity`` bytes mapped by both sides, consumers pick it
+    up on their own. When it is full records spill to the segments if ``spill`` is set, until the consumer
+    caught up with them, otherwise puts wait for room. Records in the ring do not survive a reboot.
+    """
+    enabled: bool = False
+    capacity: int = 4 * 1024 * 1024
+    spill: bool = True
+
+
+class Overflow(Enum):
+    BLOCK = 0
+    DROP_NEWEST = 1
+    DROP_OLDEST = 2
+    DEGRADE = 3
+
+
+@dataclass
+class QuotaPolicy:
+    """How much the segments of a channel, and of the whole queue, may hold before ``overflow`` applies.
+
+    Zero disables a limit. Usage comes from the segment index of the process, which a file watch keeps up
+    to date with the segments created and deleted, what other processes append to theirs is only counted
+    while a limit is exceeded. Without a file watch the folder is rescanned instead, at most once a second.
+
+    ``BLOCK`` waits up to ``block_timeout_ms`` for consumers to make room and then drops the record,
+    ``DROP_NEWEST`` drops the record put, ``DROP_OLDEST`` deletes the oldest segments of the channel, read
+    or not, and ``DEGRADE`` writes the record without its ``degrade_fields``. Whatever still does not fit
+    is dropped. A dropped record is left with a ``message_id`` of 0.
+    """
+    channel_max_bytes: int = 0
+    channel_max_records: int = 0
+    queue_max_bytes: int = 0
+    queue_max_records: int = 0
+    overflow: Overflow = Overflow.BLOCK
+    block_timeout_ms: int = 1000
+    degrade_fields: Tuple[str, ...] = ("full_image",)
+
+
+@dataclass
+class DropCounters:
+    """What a producer gave up to stay within its quota since it started."""
+    dropped_records: int = 0
+    dropped_segments: int = 0
+    degraded_records: int = 0
+    block_timeouts: int = 0
 
 
 class _FsbQueueProducer:
-    def __init__(self, queue_id: int, channel_id: str) -> None:
+    def __init__(self,
+                 queue_id: int,
+                 channel_id: str,
+                 durability: Optional[DurabilityPolicy] = None,
+                 rotation: Optional[RotationPolicy] = None,
+                 allocation: Optional[AllocationPolicy] = None,
+                 blob: Optional[BlobPolicy] = None,
+                 ring: Optional[RingPolicy] = None,
+                 compression: Optional[CompressionPolicy] = None,
+                 quota: Optional[QuotaPolicy] = None) -> None:
         self.name = "_FsbQueueProducer"
         remove_characters = ["_", "."]
         for r in remove_characters:
@@ -43,59 +747,99 @@ class _FsbQueueProducer:
         self.__queue_id = queue_id
         self.__file_counter: int = 0
         self.__message_counter: int = 0
-        self.__message_write_started: bool = False
         self.__offset: int = 0
-
-        self.__q_folder = get_folder(os.path.join(get_queue_base_folder(), f"{self.__queue_id:05d}"))
+        self.__rotation: RotationPolicy = rotation if rotation is not None else RotationPolicy()
+        self.__segment_bytes: int = 0
+        self.__segment_records: int = 0
+        self.__segment_opened: float = time.monotonic()
+        self.__allocation: AllocationPolicy = allocation if allocation is not None else AllocationPolicy()
+        self.__is_recycled: bool = False
+        self.__blob: BlobPolicy = blob if blob is not None else BlobPolicy()
+        self.__blob_file: Optional[BinaryIO] = None
+        self.__blob_offset: int = 0
+        self.__syncer = _DurabilitySyncer(durability)
+        self.__sync_level: int = _SYNC_FLUSH
+        self.__ring_policy: RingPolicy = ring if ring is not None else RingPolicy()
+        self.__ring: Optional[FsbQueueRing] = None
+        # Id of the last record spilled to the segments, the ring is used again once the consumer took it
+        self.__spilled_message_id: int = 0
+        self.__quota: QuotaPolicy = quota if quota is not None else QuotaPolicy()
+        self.__has_quota: bool = (self.__quota.channel_max_bytes > 0 or self.__quota.channel_max_records > 0
+                                  or self.__quota.queue_max_bytes > 0 or self.__quota.queue_max_records > 0)
+        self.__drops = DropCounters()
+        self.__last_quota_refresh: float = float("-inf")
+        self.__last_quota_rescan: float = float("-inf")
+        self.__last_drop_log: float = float("-inf")
+
+        self.__q_folder = get_folder(get_queue_folder(self.__queue_id))
         self.__file: Optional[BinaryIO] = None
-        self.__producer_seek_file: Optional[BinaryIO] = None
-
+        self.__compression: CompressionPolicy = compression if compression is not None else CompressionPolicy()
+        self.__block_codec: Optional[BlockCodec] = None
+        # Records kept to train the dictionary of the queue, None once it is known
+        self.__samples: Optional[List[bytes]] = None
+        self.__open_block_codec()
+        if self.__ring_policy.enabled:
+            # Created before the session file, consumers discovering the channel find the ring as well
+            self.__ring = FsbQueueRing(get_ring_file_name(self.__q_folder, self.__channel_id),
+                                       self.__ring_policy.capacity)
+        self.__producer_seek_file = _CursorFile(
+            os.path.join(self.__q_folder, f".{self.__channel_id}{_WRITE_SESSION_EXTENSION}"))
+        self.__doorbell = FsbQueueDoorbell(self.__q_folder, f".{self.__channel_id}{_WRITE_SESSION_EXTENSION}")
+        self.__groups = ConsumerGroups(self.__q_folder)
+
+        self.__index: _SegmentIndex = _get_segment_index(self.__q_folder)
+        # Consumers of other processes delete segments, the quota follows them through a file watch
+        self.__is_watching: bool = self.__has_quota and self.__index.watch()
+        has_backlog = self.__index.first(self.__channel_id) is not None
         self.__find_last_file()
         self.__open()
+        if has_backlog:
+            # Whatever the segments still hold has to be consumed before records can overtake it in the ring
+            self.__spilled_message_id = self.__message_counter
+
+    def __open_block_codec(self):
+        policy = self.__compression
+        if policy.codec == Compression.NONE:
+            return
+        codec = policy.codec
+        if not is_available(codec):
+            logging.getLogger(self.name).error(f"{codec.name} compression is not available, using ZLIB")
+            codec = Compression.ZLIB
+        dictionary = load_dictionary(self.__q_folder) if policy.dictionary_size > 0 else None
+        if dictionary is None and policy.dictionary_size > 0:
+            self.__samples = []
+        self.__block_codec = BlockCodec(codec, policy.level, dictionary)
+
+    def __train_dictionary(self):
+        policy = self.__compression
+        dictionary = train_dictionary(self.__block_codec.codec, self.__samples, policy.dictionary_size)
+        dictionary = store_dictionary(self.__q_folder, dictionary)
+        self.__samples = None
+        self.__block_codec = BlockCodec(self.__block_codec.codec, policy.level, dictionary)
+        logging.getLogger(self.name).info(f"Compressing with a {len(dictionary)} bytes dictionary "
+                                          f"for Q_id: {self.__queue_id} Ch_id: {self.__channel_id}")
+
+    def __compress(self, buffer: bytearray, records: int) -> bytearray:
+        block_codec = self.__block_codec
+        assert block_codec is not None, "compression is disabled"
+        compressed = block_codec.compress(buffer)
+        block = bytearray(struct.pack("<ii", _FUNC_TYPE_BLOCK, _BLOCK_HEADER.size + len(compressed)))
+        block += _BLOCK_HEADER.pack(block_codec.codec.value, block_codec.dictionary_id, records)
+        block += compressed
+        return block
 
     def __find_last_file(self):
-        for file in glob.glob(os.path.join(self.__q_folder, f"{self.__channel_id}_*{_QUEUE_EXTENSION}")):
-            file_counter = get_int(ntpath.splitext(ntpath.basename(file))[0].split("_")[1])
-            if file_counter > self.__file_counter:
-                self.__file_counter = file_counter
+        file_counter = _get_segment_index(self.__q_folder).last(self.__channel_id)
+        if file_counter is not None and file_counter > self.__file_counter:
+            self.__file_counter = file_counter
 
     def __read_producer_seek_file(self) -> Tuple[int, int, int]:
-        file_counter, message_counter, offset = 0, 0, 0
-        if self.__producer_seek_file is None:
-            session_file_name = os.path.join(self.__q_folder, f".{self.__channel_id}{_WRITE_SESSION_EXTENSION}")
-            try:
-                if os.path.exists(session_file_name):
-                    self.__producer_seek_file = open(session_file_name, "rb+")
-                else:
-                    self.__producer_seek_file = open(session_file_name, "wb+")
-            except FileNotFoundError as e:
-                logging.getLogger(self.name).fatal("Unexpected read error {e}")
-
-        if self.__producer_seek_file is not None:
-            try:
-                file_counter, message_counter, offset = struct.unpack(
-                    "<iQQ", self.__producer_seek_file.read(struct.calcsize("<iQQ")))
-            except struct.error:
-                pass
-        return (file_counter, message_counter, offset)
+        return self.__producer_seek_file.read()
 
     def __write_seek_file(self):
-        if self.__producer_seek_file is None:
-            session_file_name = os.path.join(self.__q_folder, f".{self.__channel_id}{_WRITE_SESSION_EXTENSION}")
-            try:
-                if os.path.exists(session_file_name):
-                    self.__producer_seek_file = open(session_file_name, "rb+")
-                else:
-                    self.__producer_seek_file = open(session_file_name, "wb")
-            except FileNotFoundError as e:
-                logging.getLogger(self.name).fatal("Unexpected read error {e}")
-
-        if self.__producer_seek_file is not None:
-            self.__offset = self.__file.tell()
-            self.__producer_seek_file.seek(0)
-            self.__producer_seek_file.write(
-                struct.pack("<iQQ", self.__file_counter, self.__message_counter, self.__offset))
-            self.__producer_seek_file.flush()
+        self.__offset = self.__file.tell()
+        self.__producer_seek_file.write(self.__file_counter, self.__message_counter, self.__offset)
+        self.__producer_seek_file.sync(self.__sync_level)
 
     def __open(self):
 
@@ -109,38 +853,300 @@ class _FsbQueueProducer:
             self.__q_folder,
             f"{self.__channel_id}_{self.__file_counter:05d}{_QUEUE_EXTENSION}",
         )
-        self.__file = open(self.__file_name, "wb")
+        if self.__blob.enabled:
+            # Created first, a consumer that sees the segment always finds its blob segment as well
+            self.__blob_file = open(
+                get_segment_file_name(self.__q_folder, self.__channel_id, self.__file_counter, _BLOB_EXTENSION),
+                "wb",
+                buffering=0)
+            self.__blob_offset = 0
+        self.__is_recycled = self.__take_recycled_file()
+        self.__file = open(self.__file_name, "r+b" if self.__is_recycled else "wb")
+        # Consumers of this process see the rotation without waiting for a watch event or a glob
+        self.__index.add(self.__channel_id, self.__file_counter)
+        self.__preallocate()
+        self.__segment_bytes = 0
+        self.__segment_records = 0
+        self.__segment_opened = time.monotonic()
         self.__write_seek_file()
+        self.__doorbell.open()
         logging.getLogger(self.name).info(
             f"Opening file {self.__file_name} for Q_id: {self.__queue_id} Ch_id: {self.__channel_id} file_counter: {self.__file_counter} record: {self.__message_counter}"
         )
 
+    def __take_recycled_file(self) -> bool:
+        try:
+            with os.scandir(os.path.join(self.__q_folder, _RECYCLE_FOLDER)) as it:
+                for entry in it:
+                    try:
+                        # Readers find the file as soon as it is renamed, before the write session names it
+                        # and bounds what they read, its stale records must be terminated first
+                        with open(entry.path, "r+b") as f:
+                            f.write(struct.pack("<i", _FUNC_TYPE_NONE))
+                        os.rename(entry.path, self.__file_name)
+                        return True
+                    except OSError:
+                        # Taken by another producer in the meantime
+                        continue
+        except FileNotFoundError:
+            pass
+        return False
+
+    def __preallocate(self):
+        if not self.__allocation.preallocate or self.__rotation.max_bytes <= 0 or not hasattr(os, "posix_fallocate"):
+            return
+        try:
+            os.posix_fallocate(self.__file.fileno(), 0, self.__rotation.max_bytes)
+        except OSError as e:
+            logging.getLogger(self.name).error(f"Unable to preallocate {self.__file_name} {e}")
+
     def put(self, item: ObjectInfo):
-        if (self.__message_write_started and self.__message_counter > 0 and self.__message_counter % MAX_RECORDS == 0):
-            self.__mark_end()
-            self.__close()
-            self.__open()
-        self.__message_counter += 1
-        item.message_id = self.__message_counter
+        self.put_many([item])
+
+    def put_many(self, items: Iterable[ObjectInfo]):
+        # Frames every record of a segment into one buffer so a batch costs a single write,
+        # a single flush and a single write session update per segment touched.
+        buffer = bytearray()
+        blob_buffer = bytearray()
+        records = 0
+        ring_records = 0
+        ring = self.__ring
+        # Only the default group reads the ring, with more groups every record goes to the segments
+        is_ring_shared = ring is not None and len(self.__groups.names()) > 1
+        for item in items:
+            item.message_id = self.__message_counter + 1
+            if ring is not None and not is_ring_shared and self.__is_ring_active(ring):
+                if self.__put_ring(ring, item):
+                    self.__message_counter += 1
+                    ring_records += 1
+                    continue
+                # Spilled records must not become visible before the ring records preceding them
+                ring.publish()
+            if ring is not None:
+                self.__spilled_message_id = item.message_id
+            b, blobs = self.__serialize(item, len(blob_buffer))
+            record_size = _RECORD_HEADER_SIZE + len(b) + sum(len(blob) for blob in blobs)
+            if self.__has_quota and self.__is_over_quota(len(buffer) + len(blob_buffer) + record_size, records + 1):
+                # Room is looked for with the batch so far committed, the consumers may take it meanwhile
+                self.__commit(buffer, records, blob_buffer)
+                buffer = bytearray()
+                blob_buffer = bytearray()
+                records = 0
+                admitted = self.__make_room(item, b, blobs, record_size)
+                if admitted is None:
+                    continue
+                b, blobs, record_size = admitted
+            if self.__is_rotation_due(record_size):
+                self.__commit(buffer, records, blob_buffer)
+                buffer = bytearray()
+                blob_buffer = bytearray()
+                records = 0
+                self.__mark_end()
+                self.__close()
+                self.__open()
+                # The references point into the blob segment just opened now
+                b, blobs = self.__serialize(item, 0)
+            self.__message_counter += 1
+            buffer += struct.pack("<ii", _FUNC_TYPE_DATA, len(b))
+            buffer += b
+            if self.__samples is not None and len(self.__samples) < self.__compression.dictionary_samples:
+                self.__samples.append(b)
+            for blob in blobs:
+                blob_buffer += blob
+            records += 1
+            self.__segment_bytes += record_size
+            self.__segment_records += 1
+        if ring is not None and ring_records > 0:
+            ring.publish()
+            if not buffer:
+                self.__doorbell.ring()
+        self.__commit(buffer, records, blob_buffer)
+
+    def __is_over_quota(self, size: int, records: int, refresh: bool = False) -> bool:
+        """True when ``size`` bytes and ``records`` records more do not fit, with ``refresh`` what other
+        processes appended is counted first unless it was a moment ago.
+        """
+        policy = self.__quota
+        has_channel_limit = policy.channel_max_bytes > 0 or policy.channel_max_records > 0
+        has_queue_limit = policy.queue_max_bytes > 0 or policy.queue_max_records > 0
+        now = time.monotonic()
+        if refresh and now - self.__last_quota_refresh >= _POLL_INTERVAL:
+            self.__last_quota_refresh = now
+            if not self.__index.is_live and now - self.__last_quota_rescan >= _QUOTA_RESCAN_INTERVAL:
+                # Without a file watch deletions by consumers of other processes are only found on disk
+                self.__last_quota_rescan = now
+                if has_queue_limit:
+                    self.__index.build()
+                else:
+                    self.__index.refresh_channel(self.__channel_id)
+            self.__index.refresh_usage(None if has_queue_limit else self.__channel_id)
+        for channel_id, max_bytes, max_records, is_limited in (
+            (self.__channel_id, policy.channel_max_bytes, policy.channel_max_records, has_channel_limit),
+            (None, policy.queue_max_bytes, policy.queue_max_records, has_queue_limit),
+        ):
+            if not is_limited:
+                continue
+            used_bytes, used_records = self.__index.usage(channel_id)
+            if ((max_bytes > 0 and used_bytes + size > max_bytes)
+                    or (max_records > 0 and used_records + records > max_records)):
+                return True
+        return False
+
+    def __make_room(self, item: ObjectInfo, b: bytes, blobs: List[bytes],
+                    record_size: int) -> Optional[Tuple[bytes, List[bytes], int]]:
+        """Applies the overflow policy to a record over quota, returns the record to write or None when dropped."""
+        policy = self.__quota
+        if not self.__is_over_quota(record_size, 1, refresh=True):
+            return (b, blobs, record_size)
+        if policy.overflow == Overflow.BLOCK:
+            if self.__segment_records > 0:
+                # Consumers free whole segments only, the one being written has to end for them to free it
+                self.__mark_end()
+                self.__close()
+                self.__open()
+                b, blobs = self.__serialize(item, 0)
+                record_size = _RECORD_HEADER_SIZE + len(b) + sum(len(blob) for blob in blobs)
+            deadline = time.monotonic() + policy.block_timeout_ms / 1000
+            while self.__is_over_quota(record_size, 1, refresh=True):
+                if time.monotonic() >= deadline:
+                    self.__drops.block_timeouts += 1
+                    self.__drop(item)
+                    return None
+                time.sleep(_POLL_INTERVAL)
+        elif policy.overflow == Overflow.DROP_OLDEST:
+            groups = self.__groups.names() or [DEFAULT_GROUP]
+            while self.__is_over_quota(record_size, 1):
+                file_counter = self.__index.first(self.__channel_id)
+                if file_counter is None or file_counter >= self.__file_counter:
+                    # Only segments of its own channel are the producer's to delete, never the one it writes
+                    self.__drop(item)
+                    return None
+                purge_segment(self.__q_folder, self.__channel_id, file_counter, groups)
+                self.__drops.dropped_segments += 1
+                logging.getLogger(self.name).warning(f"Over quota, dropped segment {file_counter} "
+                                                     f"for Q_id: {self.__queue_id} Ch_id: {self.__channel_id}")
+        elif policy.overflow == Overflow.DEGRADE:
+            # The caller keeps its record as is
+            degraded = copy.copy(item)
+            for name in policy.degrade_fields:
+                setattr(degraded, name, OcvMat())
+            b, blobs = self.__serialize(degraded, 0)
+            record_size = _RECORD_HEADER_SIZE + len(b) + sum(len(blob) for blob in blobs)
+            if self.__is_over_quota(record_size, 1):
+                self.__drop(item)
+                return None
+            self.__drops.degraded_records += 1
+        else:
+            self.__drop(item)
+            return None
+        return (b, blobs, record_size)
+
+    def __drop(self, item: ObjectInfo) -> None:
+        item.message_id = 0
+        self.__drops.dropped_records += 1
+        if time.monotonic() - self.__last_drop_log >= _DROP_LOG_INTERVAL:
+            self.__last_drop_log = time.monotonic()
+            logging.getLogger(self.name).warning(
+                f"Over quota for Q_id: {self.__queue_id} Ch_id: {self.__channel_id} {self.__drops}")
+
+    def drop_counters(self) -> DropCounters:
+        return dataclasses.replace(self.__drops)
+
+    def __is_ring_active(self, ring: FsbQueueRing) -> bool:
+        return ring.consumed_message_id() >= self.__spilled_message_id
+
+    def __put_ring(self, ring: FsbQueueRing, item: ObjectInfo) -> bool:
         b = bytes(item)
-        l = len(b)
+        if ring.append(b):
+            return True
+        if self.__ring_policy.spill:
+            return False
+        if len(b) + _HEADER_SIZE > ring.capacity():
+            raise ValueError(f"Record of {len(b)} bytes never fits the ring of {ring.capacity()} bytes")
+        ring.publish()
+        self.__doorbell.ring()
+        while not ring.append(b):
+            time.sleep(_RING_FULL_INTERVAL)
+        return True
+
+    def __serialize(self, item: ObjectInfo, blob_offset: int) -> Tuple[bytes, List[bytes]]:
+        """Serializes ``item`` with its large images moved out of line, ``blob_offset`` bytes past what
+        the blob segment holds already. Returns the record and the image payloads, ``item`` is left as is.
+        """
+        if self.__blob_file is None:
+            return (bytes(item), [])
+        blobs = []
+        images: List[Tuple[str, OcvMat]] = []
+        for name in IMAGE_FIELDS:
+            ocvmat = getattr(item, name)
+            if len(ocvmat.mat_data) < max(self.__blob.min_bytes, 1):
+                continue
+            images.append((name, ocvmat))
+            blob = BlobRef(segment=self.__file_counter,
+                           offset=self.__blob_offset + blob_offset,
+                           length=len(ocvmat.mat_data))
+            setattr(item, name, dataclasses.replace(ocvmat, mat_data=b"", blob=blob))
+            blobs.append(ocvmat.mat_data)
+            blob_offset += blob.length
+        try:
+            return (bytes(item), blobs)
+        finally:
+            for name, ocvmat in images:
+                setattr(item, name, ocvmat)
+
+    def __is_rotation_due(self, record_size: int) -> bool:
+        if self.__segment_records == 0:
+            return False
+        policy = self.__rotation
+        return ((policy.max_bytes > 0 and self.__segment_bytes + record_size > policy.max_bytes)
+                or (policy.max_records > 0 and self.__segment_records >= policy.max_records)
+                or (policy.max_age_ms > 0 and (time.monotonic() - self.__segment_opened) * 1000 >= policy.max_age_ms))
+
+    def __commit(self, buffer: bytearray, records: int, blob_buffer: Optional[bytearray] = None):
+        if not buffer:
+            return
+        self.__sync_level = self.__syncer.on_commit(records)
+        if self.__blob_file is not None and blob_buffer:
+            # Unbuffered, the images are in the file before the records referring to them
+            self.__blob_file.write(blob_buffer)
+            self.__blob_offset += len(blob_buffer)
+            _sync_file(self.__blob_file, self.__sync_level)
+        if self.__block_codec is not None:
+            # Records are counted uncompressed until their block is built, rotation follows the file
+            # size and a batch never takes a segment past max_bytes
+            uncompressed_size = len(buffer)
+            buffer = self.__compress(buffer, records)
+            self.__segment_bytes += len(buffer) - uncompressed_size
+            if self.__samples is not None and len(self.__samples) >= self.__compression.dictionary_samples:
+                self.__train_dictionary()
         if self.__file is not None:
-            self.__message_write_started = True
-            self.__file.write(struct.pack("<i", _FUNC_TYPE_DATA))
-            self.__file.write(struct.pack("<i", l))
-            self.__file.write(b)
-            self.__file.flush()
+            if self.__is_recycled:
+                # Stale records of the previous life of the file follow, terminate the data explicitly
+                # and make sure it reached the file before the session points past it
+                buffer += struct.pack("<i", _FUNC_TYPE_NONE)
+                self.__sync_level = max(self.__sync_level, _SYNC_FLUSH)
+            self.__file.write(buffer)
+            if self.__is_recycled:
+                self.__file.seek(-_HEADER_SIZE, os.SEEK_CUR)
+            _sync_file(self.__file, self.__sync_level)
+        self.__index.set_usage(self.__channel_id, self.__file_counter, self.__segment_bytes, self.__segment_records)
         self.__write_seek_file()
+        self.__doorbell.ring()
 
     def __close(self):
         self.__file.close()
         self.__file = None
-        self.__producer_seek_file.close()
-        self.__producer_seek_file = None
+        if self.__blob_file is not None:
+            self.__blob_file.close()
+            self.__blob_file = None
+        self.__producer_seek_file.sync(self.__sync_level)
 
     def __mark_end(self):
         self.__file.write(struct.pack("<i", _FUNC_TYPE_EOF))
-        self.__file.flush()
+        self.__sync_level = max(self.__syncer.on_rotation(), _SYNC_FLUSH)
+        _sync_file(self.__blob_file, self.__sync_level)
+        _sync_file(self.__file, self.__sync_level)
+        self.__write_seek_file()
         logging.getLogger(self.name).info(
             f"Marking end {self.__file_name} for Q_id: {self.__queue_id} Ch_id: {self.__channel_id} file_counter: {self.__file_counter} record: {self.__message_counter}"
         )
@@ -148,113 +1154,305 @@ class _FsbQueueProducer:
     def stop(self):
         self.__mark_end()
         self.__close()
+        self.__producer_seek_file.close()
+        if self.__ring is not None:
+            self.__ring.close()
+        self.__doorbell.close()
+        if self.__is_watching:
+            self.__is_watching = False
+            self.__index.unwatch()
+
+
+class _SegmentReader:
+    """Reads a segment sequentially through a buffered file, records are returned as bytes."""
+    def __init__(self, file_name: str) -> None:
+        self.__file: BinaryIO = open(file_name, "rb")
+
+    def seek(self, offset: int):
+        self.__file.seek(offset)
+
+    def read(self, size: int) -> bytes:
+        return self.__file.read(size)
+
+    def rewind(self, offset: int):
+        # Seeking from the end first drops the read ahead buffer, a plain seek inside it would keep it
+        self.__file.seek(0, os.SEEK_END)
+        self.__file.seek(offset)
+
+    def close(self) -> bool:
+        """Returns True when nothing refers to the file any more, so it may be reused."""
+        self.__file.close()
+        return True
+
+
+class _MmapSegmentReader:
+    """Reads a segment through a read only mapping, records are returned as views into it.
+
+    A mapping can not reach past the end of the file, so the segment is mapped again as the producer
+    appends, once the file has doubled since the last mapping. Records beyond the mapping until then
+    are read as copies, which bounds the mappings of a segment to a few dozen whatever its size.
+    Superseded mappings are unmapped as soon as no view refers to them. A mapping still referred to
+    on close lives on until the last view is released and the file must not be recycled, the
+    producer would overwrite what the views show.
+    """
+    def __init__(self, file_name: str) -> None:
+        self.__file: BinaryIO = open(file_name, "rb")
+        self.__maps: List[mmap.mmap] = []
+        self.__view: Optional[memoryview] = None
+        self.__position: int = 0
+
+    def __remap(self):
+        size = os.fstat(self.__file.fileno()).st_size
+        if size == 0 or (self.__view is not None and size < 2 * len(self.__view)):
+            return
+        try:
+            m = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            logging.getLogger("_MmapSegmentReader").error(f"Reading by copy, unable to map the segment {e}")
+            return
+        if self.__view is not None:
+            self.__view.release()
+        self.__view = memoryview(m)
+        self.__maps = [old for old in self.__maps if not self.__unmap(old)]
+        self.__maps.append(m)
+
+    @staticmethod
+    def __unmap(m: mmap.mmap) -> bool:
+        try:
+            m.close()
+        except BufferError:
+            return False
+        return True
+
+    def seek(self, offset: int):
+        self.__position = offset
+
+    def read(self, size: int) -> memoryview:
+        end = self.__position + size
+        if self.__view is None or end > len(self.__view):
+            self.__remap()
+        if self.__view is None or end > len(self.__view):
+            # Seeking from the end first drops the read ahead buffer, it may hold a shorter file
+            self.__file.seek(0, os.SEEK_END)
+            self.__file.seek(self.__position)
+            b = memoryview(self.__file.read(size))
+        else:
+            b = self.__view[self.__position:end]
+        self.__position += len(b)
+        return b
+
+    def rewind(self, offset: int):
+        self.__position = offset
+
+    def close(self) -> bool:
+        """Returns True when nothing refers to the file any more, so it may be reused."""
+        if self.__view is not None:
+            self.__view.release()
+            self.__view = None
+        is_released = all([self.__unmap(m) for m in self.__maps])
+        self.__maps = []
+        self.__file.close()
+        return is_released
+
+
+class _BlobSegmentReader:
+    """Fetches the images a segment stores out of line.
+
+    Records resolving their images keep it alive, and with it the open file, so they can still be
+    resolved once the segment was consumed and its blob segment deleted.
+    """
+    def __init__(self, file_name: str) -> None:
+        self.name = "_BlobSegmentReader"
+        self.__file_name: str = file_name
+        self.__file: BinaryIO = open(file_name, "rb", buffering=0)
+        self.__lock = threading.Lock()
+        weakref.finalize(self, self.__file.close)
+
+    def resolve(self, ocvmat: OcvMat) -> OcvMat:
+        blob = ocvmat.blob
+        with self.__lock:
+            self.__file.seek(blob.offset)
+            data = self.__file.read(blob.length)
+        if len(data) != blob.length:
+            logging.getLogger(self.name).error(
+                f"Short blob read {self.__file_name} offset: {blob.offset} length: {blob.length} read: {len(data)}")
+            return ocvmat
+        ocvmat.mat_data = data
+        return ocvmat
 
 
 class _FsbQueueConsumer:
-    def __init__(self, queue_id: int, channel_id: str) -> None:
+    def __init__(self,
+                 queue_id: int,
+                 channel_id: str,
+                 durability: Optional[DurabilityPolicy] = None,
+                 checkpoint: Optional[CheckpointPolicy] = None,
+                 notifier: Optional[FsbQueueNotifier] = None,
+                 index: Optional[_SegmentIndex] = None,
+                 allocation: Optional[AllocationPolicy] = None,
+                 zero_copy: bool = False,
+                 fields: Optional[Collection[str]] = None,
+                 lazy_images: bool = False,
+                 group: str = DEFAULT_GROUP) -> None:
         self.name = "_FsbQueueConsumer"
         self.__channel_id = channel_id
         self.__queue_id = queue_id
+        self.__q_folder = get_queue_folder(self.__queue_id)
         self.__file_counter: int = sys.maxsize
         self.__message_counter = 0
-        self.__q_folder = os.path.join(get_queue_base_folder(), f"{self.__queue_id:05d}")
-        self.__file: Optional[BinaryIO] = None
-        self.__session_file_name = os.path.join(self.__q_folder, f".{self.__channel_id}{_READ_SESSION_EXTENSION}")
-        self.__producer_seek_file: Optional[BinaryIO] = None
-        self.__consumer_seek_file: Optional[BinaryIO] = None
-
-    def __find_first_file(self) -> bool:
-        file_counter = sys.maxsize
-        for file in glob.glob(os.path.join(self.__q_folder, f"{self.__channel_id}_*{_QUEUE_EXTENSION}")):
-            t = get_int(ntpath.splitext(ntpath.basename(file))[0].split("_")[1])
-            if t < file_counter:
-                file_counter = t
-        if file_counter < sys.maxsize:
+        self.__offset: int = 0
+        self.__checkpoint_policy: CheckpointPolicy = checkpoint if checkpoint is not None else CheckpointPolicy()
+        self.__records_since_checkpoint: int = 0
+        self.__last_checkpoint: float = time.monotonic()
+        self.__notifier: Optional[FsbQueueNotifier] = notifier
+        self.__index: _SegmentIndex = index if index is not None else _get_segment_index(self.__q_folder)
+        self.__allocation: AllocationPolicy = allocation if allocation is not None else AllocationPolicy()
+        self.__zero_copy: bool = zero_copy
+        self.__fields: Optional[Collection[str]] = fields
+        self.__lazy_images: bool = lazy_images
+        self.__file: Optional[Union[_SegmentReader, _MmapSegmentReader]] = None
+        self.__is_file_reusable: bool = True
+        self.__blobs: Optional[_BlobSegmentReader] = None
+        self.__ring: Optional[FsbQueueRing] = None
+        self.__ring_attached: float = float("-inf")
+        self.__record_size: int = 0
+        self.__codecs = BlockCodecs(self.__q_folder)
+        # Decompressed records of the current block not returned yet, the cursor stays at the start of
+        # the block until the last of them is read
+        self.__block: Deque[bytes] = collections.deque()
+        self.__block_end: int = 0
+        self.__block_skip: int = 0
+        self.__group: str = group
+        self.__groups = ConsumerGroups(self.__q_folder)
+        self.__session_file_name = _get_cursor_file_name(self.__q_folder, self.__channel_id, group)
+        self.__producer_seek_file: Optional[_CursorFile] = None
+        self.__consumer_seek_file: Optional[_CursorFile] = None
+        self.__syncer = _DurabilitySyncer(durability)
+
+    def __find_first_file(self, start: int) -> bool:
+        # Segments other groups still have to read stay behind the cursor
+        file_counter = self.__index.first(self.__channel_id, start)
+        if file_counter is not None:
             self.__file_counter = file_counter
             return True
         return False
 
     def __is_next_file_exists(self, file_counter_current) -> bool:
-        for file in glob.glob(os.path.join(self.__q_folder, f"{self.__channel_id}_*{_QUEUE_EXTENSION}")):
-            file_counter_1 = get_int(ntpath.splitext(ntpath.basename(file))[0].split("_")[1])
-            if file_counter_1 > file_counter_current:
-                return True
-        return False
+        return self.__index.has_next(self.__channel_id, file_counter_current)
+
+    def __recycle(self) -> bool:
+        # Another group may still hold views of the segment, an unlinked file keeps them valid
+        if (self.__allocation.recycle_pool_size <= 0 or not self.__is_file_reusable
+                or len(self.__groups.names()) > 1):
+            return False
+        recycle_folder = os.path.join(self.__q_folder, _RECYCLE_FOLDER)
+        try:
+            os.makedirs(recycle_folder, exist_ok=True)
+            if len(os.listdir(recycle_folder)) >= self.__allocation.recycle_pool_size:
+                return False
+            os.rename(self.__file_name, os.path.join(recycle_folder, ntpath.basename(self.__file_name)))
+        except OSError as e:
+            logging.getLogger(self.name).error(f"Unable to recycle {self.__file_name} {e}")
+            return False
+        return True
 
-    def __delete(self):
+    def __delete(self, file_counter: int):
+        self.__index.remove(self.__channel_id, file_counter)
         try:
-            os.remove(self.__file_name)
+            if not self.__recycle():
+                os.remove(self.__file_name)
+        except FileNotFoundError:
+            # Another group passed the segment at the same time and deleted it first
+            pass
         except Exception as e:
             logging.getLogger(self.name).error(f"Unable to delete {self.__file_name} Channel_id:: {self.__channel_id}")
 
         try:
-            os.remove(self.__session_file_name)
+            os.remove(self.__blob_file_name)
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            logging.getLogger(self.name).error(f"Unable to delete {self.__session_file_name} Channel_id:: {self.__channel_id}")
+            logging.getLogger(self.name).error(
+                f"Unable to delete {self.__blob_file_name} Channel_id:: {self.__channel_id} {e}")
+
+    def __pass_segment(self):
+        """Moves the cursor past the segment just finished, which goes once every group has passed it."""
+        file_counter = self.__file_counter
+        self.__file_counter, self.__message_counter, self.__offset = file_counter + 1, 0, 0
+        # Persisted before looking at the other groups, of two groups passing together one sees the other
+        self.__write_seek_file()
+        self.__close()
+        groups = self.__groups.names() or [self.__group]
+        if _is_segment_passed(self.__q_folder, self.__channel_id, file_counter, groups):
+            self.__delete(file_counter)
 
     def __read_producer_seek_file(self) -> Tuple[int, int, int]:
-        file_counter, message_counter, offset = 0, 0, 0
         if self.__producer_seek_file is None:
-            session_file_name = os.path.join(self.__q_folder, f".{self.__channel_id}{_WRITE_SESSION_EXTENSION}")
-            try:
-                self.__producer_seek_file = open(session_file_name, "rb")
-            except FileNotFoundError as e:
-                logging.getLogger(self.name).fatal("Unexpected read error {e}")
-
-        if self.__producer_seek_file is not None:
-            try:
-                file_counter, message_counter, offset = struct.unpack(
-                    "<iQQ", self.__producer_seek_file.read(struct.calcsize("<iQQ")))
-            except struct.error:
-                pass
-        return (file_counter, message_counter, offset)
+            self.__producer_seek_file = _CursorFile(
+                os.path.join(self.__q_folder, f".{self.__channel_id}{_WRITE_SESSION_EXTENSION}"), writable=False)
+        return self.__producer_seek_file.read()
 
-    def __open_seek_file(self):
+    def __open_seek_file(self) -> _CursorFile:
         if self.__consumer_seek_file is None:
-            try:
-                if os.path.exists(self.__session_file_name):
-                    self.__consumer_seek_file = open(self.__session_file_name, "rb+")
-                else:
-                    self.__consumer_seek_file = open(self.__session_file_name, "wb+")
-            except FileNotFoundError as e:
-                logging.getLogger(self.name).fatal("Unexpected read error {e}")
+            self.__consumer_seek_file = _CursorFile(self.__session_file_name)
+        return self.__consumer_seek_file
 
     def __read_seek_file(self) -> Tuple[int, int, int]:
-        file_counter, message_counter, offset = 0, 0, 0
-        self.__open_seek_file()
-        if self.__consumer_seek_file is not None:
-            self.__consumer_seek_file.seek(0)
-            try:
-                file_counter, message_counter, offset = struct.unpack(
-                    "<iQQ", self.__consumer_seek_file.read(struct.calcsize("<iQQ")))
-            except struct.error as e:
-                pass
-        return (file_counter, message_counter, offset)
+        return self.__open_seek_file().read()
 
     def __write_seek_file(self):
-        self.__open_seek_file()
-        if self.__consumer_seek_file is not None:
-            self.__offset = self.__file.tell()
-            self.__consumer_seek_file.seek(0)
-            self.__consumer_seek_file.write(
-                struct.pack("<iQQ", self.__file_counter, self.__message_counter, self.__offset))
-            self.__consumer_seek_file.flush()
+        cursor = self.__open_seek_file()
+        cursor.write(self.__file_counter, self.__message_counter, self.__offset)
+        cursor.sync(self.__syncer.on_commit(self.__records_since_checkpoint))
+        self.__records_since_checkpoint = 0
+        self.__last_checkpoint = time.monotonic()
+
+    def __checkpoint(self, force: bool = False):
+        if self.__records_since_checkpoint == 0:
+            return
+        policy = self.__checkpoint_policy
+        if (force or (policy.records > 0 and self.__records_since_checkpoint >= policy.records)
+                or (policy.interval_ms > 0
+                    and (time.monotonic() - self.__last_checkpoint) * 1000 >= policy.interval_ms)):
+            self.__write_seek_file()
 
     def __open(self) -> bool:
-        if not self.__find_first_file():
+        # The cursor is read once per segment, afterwards it lives in memory and the file is read sequentially
+        file_counter, message_counter, offset = self.__read_seek_file()
+        if not self.__find_first_file(file_counter):
             return False
         self.__file_name = os.path.join(
             self.__q_folder,
             f"{self.__channel_id}_{self.__file_counter:05d}{_QUEUE_EXTENSION}",
         )
+        self.__blob_file_name = os.path.join(
+            self.__q_folder,
+            f"{self.__channel_id}_{self.__file_counter:05d}{_BLOB_EXTENSION}",
+        )
+        try:
+            self.__blobs = _BlobSegmentReader(self.__blob_file_name)
+        except FileNotFoundError:
+            self.__blobs = None
         try:
-            self.__file = open(self.__file_name, "rb")
+            self.__file = _MmapSegmentReader(self.__file_name) if self.__zero_copy else _SegmentReader(
+                self.__file_name)
         except FileNotFoundError as e:
+            self.__index.remove(self.__channel_id, self.__file_counter)
             logging.getLogger(self.name).error(
                 f"Read error very strange {self.__file_name} for Q_id: {self.__queue_id} Ch_id: {self.__channel_id} file_counter: {self.__file_counter} record: {self.__message_counter} {e}"
             )
             return False
 
+        if file_counter != self.__file_counter:
+            message_counter, offset = 0, 0
+        self.__message_counter, self.__offset = message_counter, offset
+        self.__block.clear()
+        self.__block_skip = 0
+        if self.__message_counter > 0 and self.__is_block_at(self.__offset):
+            # Stopped inside a block, the records of the block already read are skipped once it is decompressed
+            self.__block_skip = self.__message_counter - self.__count_records_before(self.__offset)
+        self.__file.rewind(self.__offset)
+        self.__records_since_checkpoint = 0
         logging.getLogger(self.name).info(
             f"Opening file {self.__file_name} for Q_id: {self.__queue_id} Ch_id: {self.__channel_id} file_counter: {self.__file_counter} record: {self.__message_counter}"
         )
@@ -263,8 +1461,9 @@ class _FsbQueueConsumer:
 
     def __close(self):
         if self.__file:
-            self.__file.close()
+            self.__is_file_reusable = self.__file.close()
             self.__file = None
+        self.__blobs = None
 
         if self.__consumer_seek_file:
             self.__consumer_seek_file.close()
@@ -274,70 +1473,231 @@ class _FsbQueueConsumer:
             self.__producer_seek_file.close()
             self.__producer_seek_file = None
 
-    def get(self) -> Optional[Tuple[str, ObjectInfo]]:
+    def get_many(self, max_items: int, max_bytes: int = 0) -> Tuple[List[Tuple[str, ObjectInfo]], int]:
+        """Reads whatever is already available, up to ``max_items`` records or ``max_bytes`` bytes
+        (zero for no limit), and persists the cursor once for the whole batch. Never waits.
+        Returns the records and the number of bytes they took in the segments or the ring.
+        """
+        items: List[Tuple[str, ObjectInfo]] = []
+        bytes_read = 0
+        while len(items) < max_items and (max_bytes <= 0 or bytes_read < max_bytes):
+            object_info, is_end_detected = self.__read(checkpoint=False)
+            if object_info is not None:
+                items.append((self.__channel_id, object_info))
+                bytes_read += self.__record_size
+            elif not is_end_detected:
+                break
+        self.__checkpoint()
+        return (items, bytes_read)
+
+    def __attach_ring(self) -> Optional[FsbQueueRing]:
+        # The ring has a single reader, producers only use it while the default group is the only one
+        if self.__group != DEFAULT_GROUP:
+            return None
+        if self.__ring is None and time.monotonic() - self.__ring_attached >= _RING_ATTACH_INTERVAL:
+            self.__ring_attached = time.monotonic()
+            self.__ring = FsbQueueRing.attach(get_ring_file_name(self.__q_folder, self.__channel_id))
+        return self.__ring
+
+    def __read_ring(self) -> Optional[ObjectInfo]:
+        # Whatever is in the ring is older than what the producer spilled to the segments meanwhile
+        ring = self.__attach_ring()
+        if ring is None:
+            return None
+        b = ring.read()
+        if b is None:
+            return None
+        self.__record_size = _HEADER_SIZE + len(b)
+        object_info = self.__parse(b)
+        ring.set_consumed_message_id(object_info.message_id)
+        return object_info
+
+    def __read(self, checkpoint: bool = True) -> Tuple[Optional[ObjectInfo], bool]:
+        object_info: Optional[ObjectInfo] = self.__read_ring()
+        if object_info is not None:
+            return (object_info, False)
         if self.__file is None:
             self.__open()
-        object_info: Optional[ObjectInfo] = None
+        is_end_detected = False
         if self.__file is not None:
-            _, message_counter, offset = self.__read_seek_file()
-            self.__file.seek(offset)
-            is_end_detected = False
-            # LOGGER.info(f"Here 1 {self.__message_counter} {message_counter}")
-            try:
-                bytes_to_read = struct.calcsize("<i")
-                function_type = struct.unpack("<i", self.__file.read(bytes_to_read))[0]
-                if function_type == _FUNC_TYPE_DATA:
-                    message_counter += 1
-                    l = struct.unpack("<i", self.__file.read(struct.calcsize("<i")))[0]
-                    if l == 0:
-                        object_info = ObjectInfo()
-                    elif l > 0:
-                        b = self.__file.read(l)
-                        object_info = ObjectInfo().parse(b)
-                elif function_type == _FUNC_TYPE_EOF:
-                    is_end_detected = True
-            except struct.error:
-                pass
-
-            if self.__message_counter == message_counter:
-                # producer_file_counter, _, _ = self.__read_producer_seek_file()
-                # if producer_file_counter > self.__file_counter:
-                if self.__is_next_file_exists(self.__file_counter):
+            object_info, is_end_detected = self.__read_record()
+            # producer_file_counter, _, _ = self.__read_producer_seek_file()
+            # if producer_file_counter > self.__file_counter:
+            if object_info is None and not is_end_detected and self.__is_next_file_exists(self.__file_counter):
+                # What was read ahead before the next segment showed up may be stale, look at the file once more
+                object_info, is_end_detected = self.__read_record()
+                if object_info is None and not is_end_detected:
                     logging.getLogger(
                         self.name).info(f"File counter difference found hence resetting {self.__file_counter}")
                     is_end_detected = True
-            else:
-                self.__message_counter = message_counter
-                self.__write_seek_file()
+
+            if object_info is not None:
+                self.__message_counter += 1
+                self.__records_since_checkpoint += 1
+                if self.__ring is not None:
+                    self.__ring.set_consumed_message_id(object_info.message_id)
+                if checkpoint:
+                    self.__checkpoint()
 
             if is_end_detected:
-                self.__message_counter = 0
-                self.__offset = 0
-                self.__close()
-                self.__delete()
-        if object_info is None:
-            time.sleep(0.1)
-            return None
-        return (self.__channel_id, object_info)
+                self.__pass_segment()
+        return (object_info, is_end_detected)
+
+    def __parse(self, b: Union[bytes, memoryview]) -> ObjectInfo:
+        if len(b) == 0:
+            return ObjectInfo()
+        if self.__zero_copy or self.__fields is not None or self.__lazy_images or self.__blobs is not None:
+            return parse_object_info(b, self.__fields, self.__lazy_images, self.__zero_copy,
+                                     self.__blobs.resolve if self.__blobs is not None else None)
+        # Only the zero copy reader returns views
+        return ObjectInfo().parse(bytes(b))
+
+    def __is_block_at(self, offset: int) -> bool:
+        file = self.__file
+        assert file is not None, "no segment is open"
+        file.seek(offset)
+        b = file.read(_HEADER_SIZE)
+        return len(b) == _HEADER_SIZE and struct.unpack("<i", b)[0] == _FUNC_TYPE_BLOCK
+
+    def __count_records_before(self, offset: int) -> int:
+        """Counts the records of the segment before ``offset`` from the frame headers, nothing is decompressed."""
+        file = self.__file
+        assert file is not None, "no segment is open"
+        position = 0
+        records = 0
+        while position < offset:
+            file.seek(position)
+            b = file.read(_RECORD_HEADER_SIZE + _BLOCK_HEADER.size)
+            if len(b) < _RECORD_HEADER_SIZE:
+                break
+            function_type, length = struct.unpack_from("<ii", b)
+            if function_type == _FUNC_TYPE_DATA:
+                records += 1
+            elif function_type == _FUNC_TYPE_BLOCK and len(b) == _RECORD_HEADER_SIZE + _BLOCK_HEADER.size:
+                records += _BLOCK_HEADER.unpack_from(b, _RECORD_HEADER_SIZE)[2]
+            else:
+                break
+            position += _RECORD_HEADER_SIZE + length
+        return records
+
+    def __decompress(self, b: bytes) -> List[bytes]:
+        codec, dictionary_id, records = _BLOCK_HEADER.unpack_from(b)
+        try:
+            block_codec = self.__codecs.get(Compression(codec), dictionary_id)
+            if block_codec is None:
+                raise ValueError(f"no codec for {Compression(codec).name} with dictionary {dictionary_id:08x}")
+            data = block_codec.decompress(b[_BLOCK_HEADER.size:])
+        except Exception as e:
+            logging.getLogger(self.name).error(
+                f"Dropping a block of {records} records of {self.__file_name} at {self.__offset} {e}")
+            return []
+        payloads = []
+        i = 0
+        while i + _RECORD_HEADER_SIZE <= len(data):
+            _, length = struct.unpack_from("<ii", data, i)
+            i += _RECORD_HEADER_SIZE
+            payloads.append(data[i:i + length])
+            i += length
+        return payloads
+
+    def __read_block_record(self) -> ObjectInfo:
+        b = self.__block.popleft()
+        self.__record_size = _RECORD_HEADER_SIZE + len(b)
+        if not self.__block:
+            self.__offset = self.__block_end
+        return self.__parse(b)
+
+    def __read_record(self) -> Tuple[Optional[ObjectInfo], bool]:
+        if self.__block:
+            return (self.__read_block_record(), False)
+        file = self.__file
+        assert file is not None, "no segment is open"
+        object_info: Optional[ObjectInfo] = None
+        is_end_detected = False
+        block: Optional[List[bytes]] = None
+        bytes_read = 0
+        try:
+            # Never read past what the producer has committed to the segment it is still writing,
+            # recycled and preallocated files carry stale bytes or zeros beyond that point
+            producer_file_counter, _, producer_offset = self.__read_producer_seek_file()
+            if producer_file_counter == self.__file_counter and self.__offset >= producer_offset:
+                return (None, False)
+            b = file.read(_HEADER_SIZE)
+            bytes_read += len(b)
+            function_type = struct.unpack("<i", b)[0]
+            if function_type == _FUNC_TYPE_DATA:
+                b = file.read(_HEADER_SIZE)
+                bytes_read += len(b)
+                length = struct.unpack("<i", b)[0]
+                b = file.read(length) if length > 0 else b""
+                bytes_read += len(b)
+                if len(b) == length:
+                    object_info = self.__parse(b)
+            elif function_type == _FUNC_TYPE_BLOCK:
+                b = file.read(_HEADER_SIZE)
+                bytes_read += len(b)
+                length = struct.unpack("<i", b)[0]
+                b = file.read(length)
+                bytes_read += len(b)
+                if len(b) == length:
+                    block = self.__decompress(bytes(b))
+            elif function_type == _FUNC_TYPE_EOF:
+                is_end_detected = True
+        except struct.error:
+            pass
+
+        if block is not None:
+            self.__block.extend(block[self.__block_skip:])
+            self.__block_skip = 0
+            self.__block_end = self.__offset + bytes_read
+            if not self.__block:
+                self.__offset = self.__block_end
+                return self.__read_record()
+            return (self.__read_block_record(), False)
+        if object_info is not None:
+            self.__offset += bytes_read
+            self.__record_size = bytes_read
+        elif not is_end_detected and bytes_read > 0:
+            # Partially written record or stale read ahead, read it again from the file next time
+            file.rewind(self.__offset)
+        return (object_info, is_end_detected)
 
     def get_channel_id(self):
         return self.__channel_id
 
     def stop(self):
+        if self.__file is not None:
+            self.__checkpoint(force=True)
+        if self.__consumer_seek_file is not None:
+            self.__consumer_seek_file.sync(self.__syncer.on_rotation())
         self.__close()
+        if self.__ring is not None:
+            self.__ring.close()
+            self.__ring = None
 
 
 class FsbQueueProducer:
-    def __init__(self, queue_id: int, channel_id: str) -> None:
+    def __init__(self,
+                 queue_id: int,
+                 channel_id: str,
+                 durability: Optional[DurabilityPolicy] = None,
+                 rotation: Optional[RotationPolicy] = None,
+                 allocation: Optional[AllocationPolicy] = None,
+                 blob: Optional[BlobPolicy] = None,
+                 ring: Optional[RingPolicy] = None,
+                 compression: Optional[CompressionPolicy] = None,
+                 quota: Optional[QuotaPolicy] = None) -> None:
         # Required variable for common mode
         self.name = "FsbQueueProducer"
         self.__queue_id: int = queue_id
         self.__channel_id: str = channel_id
-        self.__q_folder: str = os.path.join(get_queue_base_folder(), f"{self.__queue_id:05d}")
+        self.__q_folder: str = get_queue_folder(self.__queue_id)
         self.__reset()
 
         # Required variables for producer mode
-        self.__fsb_queue_producer: _FsbQueueProducer = _FsbQueueProducer(self.__queue_id, self.__channel_id)
+        self.__fsb_queue_producer: _FsbQueueProducer = _FsbQueueProducer(self.__queue_id, self.__channel_id,
+                                                                         durability, rotation, allocation, blob,
+                                                                         ring, compression, quota)
 
     def __reset(self):
         reset_file_name = os.path.join(self.__q_folder, "reset")
@@ -345,6 +1705,7 @@ class FsbQueueProducer:
             path = str(pathlib.Path(self.__q_folder).absolute())
             try:
                 shutil.rmtree(path)    # remove dir and all contains
+                _drop_segment_index(self.__q_folder)
             except Exception as e:
                 logging.getLogger(self.name).fatal(f"Queue reset exception {e}")
         pass
@@ -352,6 +1713,12 @@ class FsbQueueProducer:
     def put(self, item: ObjectInfo):
         self.__fsb_queue_producer.put(item)
 
+    def put_many(self, items: Iterable[ObjectInfo]):
+        self.__fsb_queue_producer.put_many(items)
+
+    def drop_counters(self) -> DropCounters:
+        return self.__fsb_queue_producer.drop_counters()
+
     def stop(self) -> None:
         self.__fsb_queue_producer.stop()
 
@@ -359,41 +1726,110 @@ class FsbQueueProducer:
         pass
 
 
-class _RepeatingTimer:
+class RepeatingTimer:
+    """Calls ``f`` every ``interval`` seconds from one long-lived thread, ``trigger`` runs it early."""
     def __init__(self, interval: float, f, *args, **kwargs) -> None:
         self.interval: float = interval
         self.f: Callable[..., None] = f
         self.args: Any = args
         self.kwargs: Any = kwargs
 
-        self.timer: Optional[threading.Timer] = None
+        self.timer: Optional[threading.Thread] = None
+        self.__is_cancelled = threading.Event()
+        self.__is_triggered = threading.Event()
 
     def callback(self) -> None:
-        self.f(*self.args, **self.kwargs)
-        self.start()
+        while not self.__is_cancelled.is_set():
+            try:
+                self.f(*self.args, **self.kwargs)
+            except Exception as e:
+                logging.getLogger("RepeatingTimer").exception(f"Repeating timer callback failed {e}")
+            self.__is_triggered.wait(self.interval)
+            self.__is_triggered.clear()
+
+    def trigger(self) -> None:
+        self.__is_triggered.set()
 
     def cancel(self) -> None:
-        if self.timer is not None:
-            self.timer.cancel()
+        self.__is_cancelled.set()
+        self.__is_triggered.set()
+        if self.timer is not None and self.timer is not threading.current_thread():
+            self.timer.join()
 
     def start(self) -> None:
-        self.timer = threading.Timer(self.interval, self.callback)
-        if self.timer is not None:
-            self.timer.start()
+        self.timer = threading.Thread(target=self.callback, name="RepeatingTimer", daemon=True)
+        self.timer.start()
+
+
+def _get_channel_id_from_session_file(file_name: str) -> Optional[str]:
+    base_name = ntpath.basename(file_name)
+    if not base_name.startswith(".") or not base_name.endswith(_WRITE_SESSION_EXTENSION):
+        return None
+    return base_name[1:-len(_WRITE_SESSION_EXTENSION)]
 
 
 class FsbQueueConsumer:
-    def __init__(self, queue_id: int) -> None:
+    def __init__(self,
+                 queue_id: int,
+                 durability: Optional[DurabilityPolicy] = None,
+                 checkpoint: Optional[CheckpointPolicy] = None,
+                 allocation: Optional[AllocationPolicy] = None,
+                 zero_copy: bool = False,
+                 fields: Optional[Collection[str]] = None,
+                 exclude_images: bool = False,
+                 lazy_images: bool = False,
+                 weights: Optional[Mapping[str, int]] = None,
+                 group: str = DEFAULT_GROUP) -> None:
+        """With ``zero_copy`` segments are memory mapped and the ``mat_data`` of the images returned are
+        views into the mapping instead of copies, valid for as long as they are referenced.
+
+        ``fields`` projects the records on the ObjectInfo fields named, the others are skipped without
+        being decoded, ``exclude_images`` projects on everything but the images. With ``lazy_images``
+        the images are decoded only when first accessed, whatever the projection.
+
+        Only channels with pending data are read, in deficit round robin: a channel is served up to its
+        weight in records, 1 unless given in ``weights``, before the next ready channel is.
+
+        Every consumer ``group`` reads the whole queue with a cursor of its own. A segment is deleted
+        once all the groups ever registered in the queue folder have read it, ``unregister_group``
+        stops a group that went away from holding segments back.
+        """
         # Required variable for common mode
         self.name = "FsbQueueConsumer"
         self.__queue_id: int = queue_id
-        self.__q_folder: str = os.path.join(get_queue_base_folder(), f"{self.__queue_id:05d}")
+        self.__zero_copy: bool = zero_copy
+        if exclude_images:
+            fields = [f.name for f in dataclasses.fields(ObjectInfo)] if fields is None else fields
+            fields = [name for name in fields if name not in IMAGE_FIELDS]
+        self.__fields: Optional[FrozenSet[str]] = None if fields is None else frozenset(fields)
+        self.__lazy_images: bool = lazy_images
+        self.__durability: Optional[DurabilityPolicy] = durability
+        self.__checkpoint: Optional[CheckpointPolicy] = checkpoint
+        self.__allocation: Optional[AllocationPolicy] = allocation
+        self.__q_folder: str = get_queue_folder(self.__queue_id)
         self.__reset()
+        check_group_name(group)
+        self.__group: str = group
+        register_group(self.__q_folder, group)
         # Required variables for consumer mode
         self.__lock = threading.Lock()
-        self.__list_fsb_queue_consumer: List[_FsbQueueConsumer] = []
-        self.__list_fsb_queue_consumer_iter: Iterator[_FsbQueueConsumer] = iter(self.__list_fsb_queue_consumer)
-        self.__timer: _RepeatingTimer = _RepeatingTimer(5.0, self.glob_directory)
+        self.__fsb_queue_consumers: Dict[str, _FsbQueueConsumer] = {}
+        self.__weights: Dict[str, int] = dict(weights) if weights is not None else {}
+        self.__scheduler = FsbQueueScheduler()
+        self.__index = _get_segment_index(self.__q_folder)
+        self.__notifier = FsbQueueNotifier(self.__q_folder, group)
+        self.__notifier.add_listener(self.__index.on_file_changed)
+        self.__notifier.add_listener(self.__on_file_changed)
+        self.__notifier.start()
+        # Rebuilt after the watch is in place so no segment created in between is missed
+        self.__index.build()
+        self.__is_index_attached: bool = self.__notifier.is_watching_files()
+        if self.__is_index_attached:
+            self.__index.attach()
+        # New channels are discovered through the notifier, globbing is only a safety net
+        self.__timer: RepeatingTimer = RepeatingTimer(
+            _SAFETY_NET_GLOB_INTERVAL if self.__notifier.is_watching_files() else _POLL_GLOB_INTERVAL,
+            self.glob_directory)
         self.__timer.start()
 
     def __reset(self):
@@ -402,43 +1838,136 @@ class FsbQueueConsumer:
             path = str(pathlib.Path(self.__q_folder).absolute())
             try:
                 shutil.rmtree(path)    # remove dir and all contains
+                _drop_segment_index(self.__q_folder)
             except Exception as e:
                 logging.getLogger(self.name).fatal(f"Queue reset exception {e}")
         pass
 
+    def __on_file_changed(self, file_name: str, kind: int):
+        if not file_name:
+            # A ring that does not say which channel it is for
+            self.__scheduler.mark_all_ready()
+            return
+        channel_id = _get_channel_id_from_session_file(file_name)
+        if channel_id is not None and channel_id not in self.__fsb_queue_consumers:
+            self.__add_channels([channel_id])
+        if channel_id is None:
+            segment = _parse_segment_file_name(file_name)
+            channel_id = segment[0] if segment is not None else None
+        if channel_id is not None and kind != FILE_DELETED:
+            self.__scheduler.mark_ready(channel_id)
+
+    def __add_channels(self, channel_ids: List[str]):
+        added = 0
+        with self.__lock:
+            for channel_id in channel_ids:
+                if channel_id not in self.__fsb_queue_consumers:
+                    self.__fsb_queue_consumers[channel_id] = _FsbQueueConsumer(
+                        self.__queue_id, channel_id, self.__durability, self.__checkpoint, self.__notifier,
+                        self.__index, self.__allocation, self.__zero_copy, self.__fields, self.__lazy_images,
+                        self.__group)
+                    self.__scheduler.add(channel_id, self.__weights.get(channel_id, 1))
+                    added += 1
+        if added > 0:
+            logging.getLogger(self.name).info(f"Adding {added} entries")
+
     def glob_directory(self) -> None:
         logging.getLogger(self.name).info("-------------------Globbing -----------")
-        # self.__timer.cancel()
         globbed_channel_list = []
         for file in glob.glob(os.path.join(self.__q_folder, f".*{_WRITE_SESSION_EXTENSION}")):
-            globbed_channel_list.append(ntpath.splitext(ntpath.basename(file))[0].split(".")[1])
-        channels_to_add = []
-        for channel in globbed_channel_list:
-            is_already_added = False
-            for l in self.__list_fsb_queue_consumer:
-                if l.get_channel_id() == channel:
-                    is_already_added = True
-            if not is_already_added:
-                channels_to_add.append(_FsbQueueConsumer(self.__queue_id, channel))
-
-        if len(channels_to_add) > 0:
-            logging.getLogger(self.name).info(f"Globbing: Adding {len(channels_to_add)} entries")
-            with self.__lock:
-                self.__list_fsb_queue_consumer.extend(channels_to_add)
-
-    def get(self) -> Optional[Tuple[str, ObjectInfo]]:
-        fsb_queue_consumer = None
+            channel_id = _get_channel_id_from_session_file(file)
+            if channel_id is not None:
+                globbed_channel_list.append(channel_id)
+        self.__add_channels(globbed_channel_list)
+        self.__index.build()
+        self.__scheduler.mark_all_ready()
+
+    def set_weight(self, channel_id: str, weight: int):
+        """Serves ``channel_id`` up to ``weight`` records per round, from the next round on."""
         with self.__lock:
-            try:
-                fsb_queue_consumer = next(self.__list_fsb_queue_consumer_iter)
-            except (StopIteration, RuntimeError):
-                self.__list_fsb_queue_consumer_iter = iter(self.__list_fsb_queue_consumer)
-
-        if fsb_queue_consumer is None:
-            return None
-        return fsb_queue_consumer.get()
+            self.__weights[channel_id] = weight
+        self.__scheduler.set_weight(channel_id, weight)
+
+    def get(self, timeout: Optional[float] = _POLL_INTERVAL) -> Optional[Tuple[str, ObjectInfo]]:
+        """Returns the next record of the ready channels, waiting up to ``timeout`` seconds (forever for None)
+        for one to arrive. None once ``timeout`` elapsed without any.
+        """
+        items = self.get_many(max_items=1, timeout=timeout)
+        return items[0] if items else None
+
+    def get_many(self,
+                 max_items: int = 64,
+                 max_bytes: int = 0,
+                 timeout: Optional[float] = _POLL_INTERVAL) -> List[Tuple[str, ObjectInfo]]:
+        """Drains up to ``max_items`` records or ``max_bytes`` bytes (zero for no limit) across the ready
+        channels, keeping the order within each channel. Waits up to ``timeout`` seconds (forever for
+        None) only while nothing at all is available. Returns what was read once the consumer is stopped.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        items: List[Tuple[str, ObjectInfo]] = []
+        bytes_read = 0
+        while not self.__scheduler.is_stopped():
+            while len(items) < max_items and (max_bytes <= 0 or bytes_read < max_bytes):
+                taken = self.__scheduler.take()
+                if taken is None:
+                    break
+                channel_id, quantum = taken
+                channel_items: List[Tuple[str, ObjectInfo]] = []
+                is_drained = True
+                try:
+                    with self.__lock:
+                        fsb_queue_consumer = self.__fsb_queue_consumers[channel_id]
+                    requested = min(quantum, max_items - len(items))
+                    byte_budget = max_bytes - bytes_read if max_bytes > 0 else 0
+                    channel_items, channel_bytes = fsb_queue_consumer.get_many(requested, byte_budget)
+                    is_drained = len(channel_items) < requested and (byte_budget <= 0 or channel_bytes < byte_budget)
+                finally:
+                    self.__scheduler.release(channel_id, len(channel_items), is_drained)
+                items.extend(channel_items)
+                bytes_read += channel_bytes
+            if items:
+                return items
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return items
+            self.__wait(remaining)
+        return items
+
+    def __wait(self, timeout: Optional[float]):
+        if self.__notifier.is_event_driven():
+            self.__scheduler.wait(timeout)
+            return
+        # Nothing tells which channel changed, all of them are looked at again once in a while
+        if not self.__scheduler.wait(_POLL_INTERVAL if timeout is None else min(timeout, _POLL_INTERVAL)):
+            self.__scheduler.mark_all_ready()
+
+    def add_ready_listener(self, listener: Callable[[], None]):
+        """Calls ``listener``, from any thread and without blocking, when a channel has data or the consumer
+        stops. For callers that wait elsewhere and then ``get_many`` with a zero timeout.
+
+        Unless ``is_event_driven``, channels only become ready again when ``refresh`` is called, which
+        such callers should do every ``_POLL_INTERVAL`` seconds while nothing arrives.
+        """
+        self.__scheduler.add_listener(listener)
+
+    def is_event_driven(self) -> bool:
+        return self.__notifier.is_event_driven()
+
+    def refresh(self):
+        """Looks at every channel again on the next read."""
+        self.__scheduler.mark_all_ready()
+
+    def is_stopped(self) -> bool:
+        return self.__scheduler.is_stopped()
 
     def stop(self) -> None:
         self.__timer.cancel()
-        for fsb_queue_consumer in self.__list_fsb_queue_consumer:
+        self.__notifier.stop()
+        if self.__is_index_attached:
+            self.__is_index_attached = False
+            self.__index.detach()
+        self.__scheduler.stop()
+        with self.__lock:
+            fsb_queue_consumers = list(self.__fsb_queue_consumers.values())
+        for fsb_queue_consumer in fsb_queue_consumers:
             fsb_queue_consumer.stop()
@@ -0,0 +1,170 @@
+import asyncio
+import collections
+import os
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Deque, Iterable, List, Optional, Tuple
+
+from .data_models.data import ObjectInfo
+from .fsb_queue import _POLL_INTERVAL, FsbQueueConsumer, FsbQueueProducer
+
+_writer_lock = threading.Lock()
+_writer: Optional[Executor] = None
+
+
+def _get_writer() -> Executor:
+    """The thread all async producers without an executor of their own write from."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = ThreadPoolExecutor(1, thread_name_prefix="AsyncFsbQueueWriter")
+        return _writer
+
+
+class AsyncFsbQueueConsumer:
+    """``FsbQueueConsumer`` for an asyncio event loop, without a thread of its own.
+
+    The loop watches a pipe the consumer writes to as soon as a channel has data, records are then
+    read on the loop thread without waiting, a batch of at most ``max_items`` records at a time.
+    Keyword arguments are those of ``FsbQueueConsumer``.
+    """
+    def __init__(self, queue_id: int, max_items: int = 64, **kwargs: Any) -> None:
+        self.name = "AsyncFsbQueueConsumer"
+        self.__max_items: int = max_items
+        self.__items: Deque[Tuple[str, ObjectInfo]] = collections.deque()
+        self.__lock = threading.Lock()
+        self.__wake_r, self.__wake_w = os.pipe()
+        os.set_blocking(self.__wake_r, False)
+        os.set_blocking(self.__wake_w, False)
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__waiter: Optional[asyncio.Future] = None
+        self.__consumer = FsbQueueConsumer(queue_id, **kwargs)
+        self.__consumer.add_ready_listener(self.__ring)
+
+    def __ring(self):
+        with self.__lock:
+            if self.__wake_w < 0:
+                return
+            try:
+                os.write(self.__wake_w, b"\0")
+            except BlockingIOError:
+                # A full pipe wakes the loop up already
+                pass
+
+    def __on_ring(self):
+        try:
+            while os.read(self.__wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        if self.__waiter is not None and not self.__waiter.done():
+            self.__waiter.set_result(None)
+
+    def __attach(self) -> asyncio.AbstractEventLoop:
+        loop = asyncio.get_running_loop()
+        if self.__loop is not loop:
+            if self.__loop is not None:
+                raise RuntimeError(f"{self.name} is already used by another event loop")
+            self.__loop = loop
+            loop.add_reader(self.__wake_r, self.__on_ring)
+        return loop
+
+    async def get_many(self,
+                       max_items: int = 64,
+                       max_bytes: int = 0,
+                       timeout: Optional[float] = None) -> List[Tuple[str, ObjectInfo]]:
+        """Like ``FsbQueueConsumer.get_many``, waiting up to ``timeout`` seconds (forever for None)
+        without blocking the loop. Returns what was read once the consumer is stopped.
+        """
+        loop = self.__attach()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not self.__consumer.is_stopped():
+            items = self.__consumer.get_many(max_items, max_bytes, timeout=0)
+            if items:
+                return items
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return items
+            if not self.__consumer.is_event_driven():
+                remaining = _POLL_INTERVAL if remaining is None else min(remaining, _POLL_INTERVAL)
+            # Created before yielding to the loop, a ring arriving from now on is not missed
+            if self.__waiter is None or self.__waiter.done():
+                self.__waiter = loop.create_future()
+            done, _ = await asyncio.wait({self.__waiter}, timeout=remaining)
+            if not done and not self.__consumer.is_event_driven():
+                self.__consumer.refresh()
+        return []
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Tuple[str, ObjectInfo]]:
+        """Returns the next record, None once ``timeout`` elapsed without any or the consumer is stopped."""
+        if self.__items:
+            return self.__items.popleft()
+        items = await self.get_many(max_items=1, timeout=timeout)
+        return items[0] if items else None
+
+    def __aiter__(self) -> "AsyncFsbQueueConsumer":
+        return self
+
+    async def __anext__(self) -> Tuple[str, ObjectInfo]:
+        if not self.__items:
+            self.__items.extend(await self.get_many(self.__max_items))
+            if not self.__items:
+                raise StopAsyncIteration
+        return self.__items.popleft()
+
+    def set_weight(self, channel_id: str, weight: int):
+        self.__consumer.set_weight(channel_id, weight)
+
+    def stop(self):
+        """Ends ``async for`` loops and wakes up pending ``get`` calls, which return None."""
+        self.__consumer.stop()
+        if self.__loop is not None:
+            if self.__loop.is_closed():
+                self.__loop = None
+            else:
+                self.__loop.call_soon_threadsafe(self.__detach)
+                return
+        self.__close()
+
+    def __detach(self):
+        self.__on_ring()
+        self.__loop.remove_reader(self.__wake_r)
+        self.__loop = None
+        self.__close()
+
+    def __close(self):
+        with self.__lock:
+            if self.__wake_w < 0:
+                return
+            os.close(self.__wake_w)
+            os.close(self.__wake_r)
+            self.__wake_w = self.__wake_r = -1
+
+
+class AsyncFsbQueueProducer:
+    """``FsbQueueProducer`` for an asyncio event loop.
+
+    Writes run on ``writer``, by default one thread shared by every async producer of the process, so
+    any number of channels are written without a thread each. Puts of one producer are written in the
+    order they were awaited in. Keyword arguments are those of ``FsbQueueProducer``.
+    """
+    def __init__(self, queue_id: int, channel_id: str, writer: Optional[Executor] = None, **kwargs: Any) -> None:
+        self.name = "AsyncFsbQueueProducer"
+        self.__writer: Executor = writer if writer is not None else _get_writer()
+        self.__lock: Optional[asyncio.Lock] = None
+        self.__producer = FsbQueueProducer(queue_id, channel_id, **kwargs)
+
+    async def __run(self, f, *args):
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        async with self.__lock:
+            return await asyncio.get_running_loop().run_in_executor(self.__writer, f, *args)
+
+    async def put(self, item: ObjectInfo):
+        await self.__run(self.__producer.put, item)
+
+    async def put_many(self, items: Iterable[ObjectInfo]):
+        await self.__run(self.__producer.put_many, list(items))
+
+    async def stop(self):
+        await self.__run(self.__producer.stop)
@@ -0,0 +1,173 @@
+import logging
+import os
+import zlib
+from dataclasses import dataclass
+from enum import Enum
+from types import ModuleType
+from typing import Dict, List, Optional, Union
+
+try:
+    import lz4.block as _lz4_block
+except ImportError:
+    _lz4_block = None
+
+# Declared as a module so it can be None without the zstandard stubs objecting
+_zstd: Optional[ModuleType]
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+_DICTIONARY_FILE_NAME = ".dictionary"
+_ZLIB_WINDOW_SIZE = 32 * 1024
+
+
+class Compression(Enum):
+    NONE = 0
+    ZLIB = 1
+    LZ4 = 2
+    ZSTD = 3
+
+
+@dataclass
+class CompressionPolicy:
+    """Compresses every batch a producer commits to a segment as one block.
+
+    ``LZ4`` needs the ``lz4`` package and ``ZSTD`` the ``zstandard`` package, without them the producer
+    falls back to ``ZLIB``. ``level`` -1 keeps the default of the codec. Unless ``dictionary_size`` is
+    zero, the first ``dictionary_samples`` records train a dictionary that is stored once per queue and
+    shared by all of its channels, records written before it exists are compressed without one.
+    """
+    codec: Compression = Compression.NONE
+    level: int = -1
+    dictionary_size: int = 16 * 1024
+    dictionary_samples: int = 256
+
+
+def is_available(codec: Compression) -> bool:
+    if codec == Compression.LZ4:
+        return _lz4_block is not None
+    if codec == Compression.ZSTD:
+        return _zstd is not None
+    return True
+
+
+def train_dictionary(codec: Compression, samples: List[bytes], size: int) -> bytes:
+    """Builds a dictionary of at most ``size`` bytes from sample records."""
+    if codec == Compression.ZSTD and _zstd is not None:
+        try:
+            dictionary: bytes = _zstd.train_dictionary(size, samples).as_bytes()
+            return dictionary
+        except _zstd.ZstdError as e:
+            logging.getLogger("FsbQueueCompression").info(f"Falling back to a raw dictionary, training failed {e}")
+    if codec == Compression.ZLIB:
+        size = min(size, _ZLIB_WINDOW_SIZE)
+    # Without a trainer the latest samples are the dictionary, the closest to the end match best
+    raw = b"".join(samples)
+    return raw[-size:]
+
+
+def get_dictionary_file_name(folder: str) -> str:
+    return os.path.join(folder, _DICTIONARY_FILE_NAME)
+
+
+def load_dictionary(folder: str) -> Optional[bytes]:
+    try:
+        with open(get_dictionary_file_name(folder), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def store_dictionary(folder: str, dictionary: bytes) -> bytes:
+    """Stores ``dictionary`` unless another producer of the queue stored one first, returns the one in use."""
+    file_name = get_dictionary_file_name(folder)
+    temp_file_name = f"{file_name}.{os.getpid()}.{id(dictionary)}"
+    with open(temp_file_name, "wb") as f:
+        f.write(dictionary)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        # Unlike a rename, a link never replaces a dictionary segments may already refer to
+        os.link(temp_file_name, file_name)
+    except FileExistsError:
+        dictionary = load_dictionary(folder) or dictionary
+    finally:
+        os.remove(temp_file_name)
+    return dictionary
+
+
+def dictionary_id(dictionary: Optional[bytes]) -> int:
+    """Identifies the dictionary a block was compressed with, zero for none."""
+    return (zlib.crc32(dictionary) or 1) if dictionary else 0
+
+
+class BlockCodec:
+    def __init__(self, codec: Compression, level: int = -1, dictionary: Optional[bytes] = None) -> None:
+        self.codec: Compression = codec
+        self.dictionary: Optional[bytes] = dictionary
+        self.dictionary_id: int = dictionary_id(dictionary)
+        self.__level: int = level
+        if codec == Compression.ZSTD:
+            assert _zstd is not None, "zstandard is not installed"
+            zstd_dictionary = _zstd.ZstdCompressionDict(dictionary) if dictionary else None
+            self.__compressor = _zstd.ZstdCompressor(level=level if level != -1 else 3, dict_data=zstd_dictionary)
+            self.__decompressor = _zstd.ZstdDecompressor(dict_data=zstd_dictionary)
+
+    def compress(self, data: Union[bytes, bytearray]) -> bytes:
+        compressed: bytes
+        if self.codec == Compression.ZLIB:
+            if self.dictionary:
+                c = zlib.compressobj(self.__level, zdict=self.dictionary)
+            else:
+                c = zlib.compressobj(self.__level)
+            compressed = c.compress(data) + c.flush()
+        elif self.codec == Compression.LZ4:
+            assert _lz4_block is not None, "lz4 is not installed"
+            if self.__level > 0:
+                compressed = _lz4_block.compress(data,
+                                                 mode="high_compression",
+                                                 compression=self.__level,
+                                                 dict=self.dictionary)
+            else:
+                compressed = _lz4_block.compress(data, dict=self.dictionary)
+        elif self.codec == Compression.ZSTD:
+            compressed = self.__compressor.compress(data)
+        else:
+            compressed = bytes(data)
+        return compressed
+
+    def decompress(self, data: bytes) -> bytes:
+        decompressed: bytes
+        if self.codec == Compression.ZLIB:
+            d = zlib.decompressobj(zdict=self.dictionary) if self.dictionary else zlib.decompressobj()
+            decompressed = d.decompress(data) + d.flush()
+        elif self.codec == Compression.LZ4:
+            assert _lz4_block is not None, "lz4 is not installed"
+            decompressed = _lz4_block.decompress(data, dict=self.dictionary)
+        elif self.codec == Compression.ZSTD:
+            decompressed = self.__decompressor.decompress(data)
+        else:
+            decompressed = bytes(data)
+        return decompressed
+
+
+class BlockCodecs:
+    """Codecs of a queue by codec and dictionary id, the dictionary is loaded from the queue folder when needed."""
+    def __init__(self, folder: str) -> None:
+        self.__folder: str = folder
+        self.__codecs: Dict[tuple, BlockCodec] = {}
+
+    def get(self, codec: Compression, dict_id: int) -> Optional[BlockCodec]:
+        block_codec = self.__codecs.get((codec, dict_id))
+        if block_codec is None:
+            dictionary = None
+            if dict_id != 0:
+                dictionary = load_dictionary(self.__folder)
+                if dictionary_id(dictionary) != dict_id:
+                    return None
+            if not is_available(codec):
+                return None
+            block_codec = BlockCodec(codec, dictionary=dictionary)
+            self.__codecs[(codec, dict_id)] = block_codec
+        return block_codec
@@ -0,0 +1,70 @@
+import logging
+import os
+from typing import List, Optional, Tuple
+
+DEFAULT_GROUP = "default"
+_GROUPS_FILE_NAME = ".groups"
+
+
+def get_groups_file_name(folder: str) -> str:
+    return os.path.join(folder, _GROUPS_FILE_NAME)
+
+
+def check_group_name(group: str):
+    if not group or "." in group or "/" in group or "\\" in group or "\n" in group:
+        raise ValueError(f"Invalid consumer group name {group!r}")
+
+
+def load_groups(folder: str) -> List[str]:
+    """Names of the consumer groups registered in a queue folder, in registration order."""
+    try:
+        with open(get_groups_file_name(folder), "r") as f:
+            return list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    except FileNotFoundError:
+        return []
+
+
+def register_group(folder: str, group: str):
+    check_group_name(group)
+    if group in load_groups(folder):
+        return
+    os.makedirs(folder, exist_ok=True)
+    # One short appended line, concurrent registrations never interleave, a duplicate is harmless
+    fd = os.open(get_groups_file_name(folder), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, f"{group}\n".encode())
+    finally:
+        os.close(fd)
+    logging.getLogger("FsbQueueGroups").info(f"Registered consumer group {group} in {folder}")
+
+
+def unregister_group(folder: str, group: str):
+    """Stops ``group`` from holding back the deletion of segments it has not read yet."""
+    groups = [name for name in load_groups(folder) if name != group]
+    file_name = get_groups_file_name(folder)
+    temp_file_name = f"{file_name}.{os.getpid()}"
+    with open(temp_file_name, "w") as f:
+        f.writelines(f"{name}\n" for name in groups)
+    os.replace(temp_file_name, file_name)
+
+
+class ConsumerGroups:
+    """Registered groups of a queue folder, reloaded when the registry changes.
+
+    Costs one ``stat`` per lookup, cheap enough for the producer to look on every commit.
+    """
+    def __init__(self, folder: str) -> None:
+        self.__folder: str = folder
+        self.__stamp: Optional[Tuple[int, int, int]] = None
+        self.__names: List[str] = []
+
+    def names(self) -> List[str]:
+        try:
+            st = os.stat(get_groups_file_name(self.__folder))
+            stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp != self.__stamp:
+            self.__stamp = stamp
+            self.__names = load_groups(self.__folder) if stamp is not None else []
+        return self.__names
@@ -0,0 +1,275 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import selectors
+import struct
+import sys
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .fsb_queue_groups import DEFAULT_GROUP, ConsumerGroups
+
+_DOORBELL_FILE_NAME = ".doorbell"
+
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+_IN_EVENT_FORMAT = "iIII"
+_IN_EVENT_SIZE = struct.calcsize(_IN_EVENT_FORMAT)
+_READ_SIZE = 65536
+
+FILE_MODIFIED = 0
+FILE_CREATED = 1
+FILE_DELETED = 2
+
+
+def _load_libc() -> Optional[ctypes.CDLL]:
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def get_doorbell_file_name(folder: str, group: str = DEFAULT_GROUP) -> str:
+    """Every consumer group listens on a doorbell of its own, a FIFO hands each ring to one reader only."""
+    if group == DEFAULT_GROUP:
+        return os.path.join(folder, _DOORBELL_FILE_NAME)
+    return os.path.join(folder, f"{_DOORBELL_FILE_NAME}.{group}")
+
+
+class FsbQueueNotifier:
+    """Wakes up readers of a queue folder as soon as something is written to it.
+
+    inotify is used on Linux. A FIFO doorbell, rung by the producers once a commit is visible in
+    their session file, is listened to as well wherever the platform has named pipes, so readers are
+    not woken before the session points at the new data. Without either, waiting degrades to a plain
+    timeout. A ring names the file the producer changed, so readers know which channel has data
+    without looking at all of them. A single thread owns the watch and bumps a sequence number, so
+    any number of readers can wait without losing a wakeup that happened between their check and
+    their wait.
+
+    Without ``doorbell`` only inotify is used, for watchers that must not take the rings of the consumers.
+    """
+    def __init__(self, folder: str, group: str = DEFAULT_GROUP, doorbell: bool = True) -> None:
+        self.name = "FsbQueueNotifier"
+        self.__folder: str = folder
+        self.__group: str = group
+        self.__has_doorbell: bool = doorbell
+        self.__condition = threading.Condition()
+        self.__sequence: int = 0
+        self.__listeners: List[Callable[[str, int], None]] = []
+        self.__inotify_fd: Optional[int] = None
+        self.__doorbell_fd: Optional[int] = None
+        self.__doorbell_writer_fd: Optional[int] = None
+        self.__wake_r: Optional[int] = None
+        self.__wake_w: Optional[int] = None
+        self.__doorbell_pending: bytes = b""
+        self.__thread: Optional[threading.Thread] = None
+        self.__is_stopped: bool = False
+
+    def is_event_driven(self) -> bool:
+        return self.__inotify_fd is not None or self.__doorbell_fd is not None
+
+    def is_watching_files(self) -> bool:
+        """True when listeners are told which files were created and deleted, not only that something changed."""
+        return self.__inotify_fd is not None
+
+    def add_listener(self, callback: Callable[[str, int], None]):
+        """``callback`` receives the changed file name and one of ``FILE_MODIFIED``, ``FILE_CREATED`` or
+        ``FILE_DELETED``. A doorbell ring is reported as a modification of the file it names, of an empty
+        file name when it names none.
+        """
+        self.__listeners.append(callback)
+
+    def start(self):
+        os.makedirs(self.__folder, exist_ok=True)
+        self.__open_inotify()
+        if self.__has_doorbell:
+            self.__open_doorbell()
+        if not self.is_event_driven():
+            logging.getLogger(self.name).info(f"No file watch available for {self.__folder}, falling back to polling")
+            return
+        self.__wake_r, self.__wake_w = os.pipe()
+        self.__thread = threading.Thread(target=self.__run, name=self.name, daemon=True)
+        self.__thread.start()
+
+    def __open_inotify(self):
+        libc = _load_libc()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            logging.getLogger(self.name).error(f"inotify_init1 failed {os.strerror(ctypes.get_errno())}")
+            return
+        if libc.inotify_add_watch(fd, os.fsencode(self.__folder), _IN_MASK) < 0:
+            logging.getLogger(self.name).error(
+                f"inotify_add_watch failed for {self.__folder} {os.strerror(ctypes.get_errno())}")
+            os.close(fd)
+            return
+        self.__inotify_fd = fd
+
+    def __open_doorbell(self):
+        if not hasattr(os, "mkfifo"):
+            return
+        file_name = get_doorbell_file_name(self.__folder, self.__group)
+        try:
+            os.mkfifo(file_name)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            logging.getLogger(self.name).error(f"Unable to create doorbell {file_name} {e}")
+            return
+        self.__doorbell_fd = os.open(file_name, os.O_RDONLY | os.O_NONBLOCK)
+        # Keeping a writer open stops the FIFO from reporting EOF forever once the producers go away
+        self.__doorbell_writer_fd = os.open(file_name, os.O_WRONLY | os.O_NONBLOCK)
+
+    def __run(self):
+        selector = selectors.DefaultSelector()
+        for fd in (self.__inotify_fd, self.__doorbell_fd, self.__wake_r):
+            if fd is not None:
+                selector.register(fd, selectors.EVENT_READ)
+        while not self.__is_stopped:
+            events: List[Tuple[str, int]] = []
+            for key, _ in selector.select():
+                try:
+                    data = os.read(key.fd, _READ_SIZE)
+                except BlockingIOError:
+                    continue
+                if key.fd == self.__inotify_fd:
+                    events.extend(self.__parse_inotify_events(data))
+                elif key.fd == self.__doorbell_fd:
+                    events.extend(self.__parse_doorbell_rings(data))
+            if events:
+                # A busy producer rings once per commit, its listeners need to hear it once
+                self.notify(list(dict.fromkeys(events)))
+        selector.close()
+
+    @staticmethod
+    def __parse_inotify_events(data: bytes) -> List[Tuple[str, int]]:
+        events = []
+        i = 0
+        while i + _IN_EVENT_SIZE <= len(data):
+            _, mask, _, length = struct.unpack_from(_IN_EVENT_FORMAT, data, i)
+            i += _IN_EVENT_SIZE
+            if mask & (_IN_CREATE | _IN_MOVED_TO):
+                kind = FILE_CREATED
+            elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                kind = FILE_DELETED
+            else:
+                kind = FILE_MODIFIED
+            events.append((os.fsdecode(data[i:i + length].rstrip(b"\0")), kind))
+            i += length
+        return events
+
+    def __parse_doorbell_rings(self, data: bytes) -> List[Tuple[str, int]]:
+        # Rings are newline terminated file names, older producers ring with a bare zero byte
+        rings = (self.__doorbell_pending + data).split(b"\n")
+        self.__doorbell_pending = rings.pop()
+        if not self.__doorbell_pending.strip(b"\0"):
+            if self.__doorbell_pending:
+                rings.append(b"")
+            self.__doorbell_pending = b""
+        if len(data) >= _READ_SIZE:
+            # The pipe may have been full, rings that did not fit were lost
+            rings.append(b"")
+        return [(os.fsdecode(ring.strip(b"\0")), FILE_MODIFIED) for ring in rings]
+
+    def notify(self, events: Optional[List[Tuple[str, int]]] = None):
+        for name, kind in events or [("", FILE_MODIFIED)]:
+            for callback in self.__listeners:
+                try:
+                    callback(name, kind)
+                except Exception as e:
+                    logging.getLogger(self.name).exception(f"Listener failed for {name} {e}")
+        with self.__condition:
+            self.__sequence += 1
+            self.__condition.notify_all()
+
+    def sequence(self) -> int:
+        return self.__sequence
+
+    def wait(self, sequence: int, timeout: Optional[float]) -> bool:
+        """Waits until something happened after ``sequence`` was read, returns False on timeout."""
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.__sequence != sequence or self.__is_stopped, timeout)
+
+    def stop(self):
+        self.__is_stopped = True
+        if self.__wake_w is not None:
+            os.write(self.__wake_w, b"\0")
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        for fd in (self.__inotify_fd, self.__doorbell_fd, self.__doorbell_writer_fd, self.__wake_r, self.__wake_w):
+            if fd is not None:
+                os.close(fd)
+        self.__inotify_fd = self.__doorbell_fd = self.__doorbell_writer_fd = self.__wake_r = self.__wake_w = None
+        with self.__condition:
+            self.__condition.notify_all()
+
+
+class FsbQueueDoorbell:
+    """Producer side of the FIFO doorbells, one per consumer group, a no-op while no consumer listens.
+
+    A consumer that shows up later is picked up by retrying the open on every ring, consumers rely on
+    the ring to learn that a commit became visible. Rings name ``changed_file_name``, the base name of
+    the file whose change they announce.
+    """
+    def __init__(self, folder: str, changed_file_name: str = "") -> None:
+        self.name = "FsbQueueDoorbell"
+        self.__folder: str = folder
+        self.__groups = ConsumerGroups(folder)
+        # Below PIPE_BUF, so a ring is never interleaved with the ring of another producer
+        self.__ring: bytes = os.fsencode(changed_file_name) + b"\n"
+        self.__fds: Dict[str, Optional[int]] = {}
+
+    def open(self):
+        if not hasattr(os, "mkfifo"):
+            return
+        file_names = [get_doorbell_file_name(self.__folder, group) for group in self.__groups.names()]
+        for file_name in set(self.__fds) - set(file_names):
+            self.__close(file_name)
+        for file_name in file_names or [get_doorbell_file_name(self.__folder)]:
+            if self.__fds.get(file_name) is not None:
+                continue
+            try:
+                self.__fds[file_name] = os.open(file_name, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                self.__fds[file_name] = None
+                if e.errno not in (errno.ENOENT, errno.ENXIO):
+                    logging.getLogger(self.name).error(f"Unable to open doorbell {file_name} {e}")
+
+    def ring(self):
+        self.open()
+        for file_name, fd in list(self.__fds.items()):
+            if fd is None:
+                continue
+            try:
+                os.write(fd, self.__ring)
+            except BlockingIOError:
+                # The pipe is full of rings nobody has read yet, the consumer then looks at every channel
+                pass
+            except OSError:
+                self.__close(file_name)
+
+    def __close(self, file_name: str):
+        fd = self.__fds.pop(file_name, None)
+        if fd is not None:
+            os.close(fd)
+
+    def close(self):
+        for file_name in list(self.__fds):
+            self.__close(file_name)
@@ -0,0 +1,81 @@
+import heapq
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import List, Tuple
+
+from .fsb_queue import FsbQueueSegments, RepeatingTimer
+from .fsb_queue_groups import DEFAULT_GROUP, ConsumerGroups
+
+
+@dataclass
+class RetentionPolicy:
+    """How long and how much a queue keeps what its consumers did not read, zero disables a limit.
+
+    A segment goes once its last write is older than ``max_age_ms``, the oldest segments go while the
+    queue holds more than ``max_bytes``. The last segment of a channel, the one its producer writes to,
+    is always kept. Checked every ``check_interval_ms``.
+    """
+    max_age_ms: int = 0
+    max_bytes: int = 0
+    check_interval_ms: int = 10000
+
+
+class FsbQueueJanitor:
+    """Enforces a RetentionPolicy on a queue from a background thread, whether its consumers run or not.
+
+    Whole segments are deleted, oldest first by file modification time, looking only at the head
+    segment of every channel. The cursors of the consumer groups still inside a deleted segment move
+    on to the next one.
+    """
+    def __init__(self, queue_id: int, policy: RetentionPolicy) -> None:
+        self.name = "FsbQueueJanitor"
+        self.__queue_id: int = queue_id
+        self.__policy: RetentionPolicy = policy
+        self.__segments = FsbQueueSegments(queue_id)
+        self.__groups = ConsumerGroups(self.__segments.folder)
+        self.__timer = RepeatingTimer(policy.check_interval_ms / 1000, self.purge)
+
+    def start(self):
+        self.__timer.start()
+
+    def stop(self):
+        self.__timer.cancel()
+
+    def __push_head(self, heads: List[Tuple[float, str, int]], channel_id: str, start: int):
+        file_counter = self.__segments.first(channel_id, start)
+        while file_counter is not None and file_counter != self.__segments.last(channel_id):
+            try:
+                st = os.stat(self.__segments.file_name(channel_id, file_counter))
+            except FileNotFoundError:
+                # Consumed in the meantime
+                file_counter = self.__segments.first(channel_id, file_counter + 1)
+                continue
+            heapq.heappush(heads, (st.st_mtime, channel_id, file_counter))
+            return
+
+    def purge(self) -> int:
+        """Applies the policy once, returns the number of segments deleted."""
+        policy = self.__policy
+        # Sizes of segments other processes write are only known from the disk
+        self.__segments.refresh()
+        groups = self.__groups.names() or [DEFAULT_GROUP]
+        cutoff = time.time() - policy.max_age_ms / 1000
+        heads: List[Tuple[float, str, int]] = []
+        for channel_id in self.__segments.channels():
+            self.__push_head(heads, channel_id, 0)
+        purged = 0
+        while heads:
+            mtime, channel_id, file_counter = heads[0]
+            is_expired = policy.max_age_ms > 0 and mtime < cutoff
+            is_over = policy.max_bytes > 0 and self.__segments.usage()[0] > policy.max_bytes
+            if not is_expired and not is_over:
+                break
+            heapq.heappop(heads)
+            self.__segments.purge(channel_id, file_counter, groups)
+            purged += 1
+            self.__push_head(heads, channel_id, file_counter + 1)
+        if purged > 0:
+            logging.getLogger(self.name).info(f"Purged {purged} segments of Q_id: {self.__queue_id}")
+        return purged
@@ -0,0 +1,125 @@
+import logging
+import mmap
+import os
+import struct
+from typing import Optional
+
+_RING_EXTENSION = ".fsrb"
+# Each field on its own cache line, the producer and the consumer never write the same one
+_CAPACITY_OFFSET = 0
+_WRITE_POSITION_OFFSET = 64
+_READ_POSITION_OFFSET = 128
+_CONSUMED_MESSAGE_ID_OFFSET = 192
+_DATA_OFFSET = 256
+_LENGTH_SIZE = struct.calcsize("<i")
+
+
+def get_ring_file_name(folder: str, channel_id: str) -> str:
+    return os.path.join(folder, f".{channel_id}{_RING_EXTENSION}")
+
+
+class FsbQueueRing:
+    """Single producer, single consumer ring of length prefixed records in a memory mapped file.
+
+    The producer and the consumer of a channel on the same host exchange records through the page
+    cache only. Positions only ever grow, the ring holds ``write - read`` bytes. Each side writes one
+    aligned 8 byte position and only reads the other one, which is all the synchronization needed.
+    Being a file the ring outlives both processes, what was published is still there after a restart.
+    """
+    def __init__(self, file_name: str, capacity: int = 0) -> None:
+        """Creates the ring with ``capacity`` bytes if it does not exist yet, ``capacity`` zero only attaches."""
+        self.name = "FsbQueueRing"
+        self.__file_name: str = file_name
+        fd = os.open(file_name, os.O_RDWR | (os.O_CREAT if capacity > 0 else 0))
+        try:
+            size = os.fstat(fd).st_size
+            if size < _DATA_OFFSET:
+                if capacity <= 0:
+                    raise FileNotFoundError(f"Ring {file_name} is not initialized yet")
+                os.ftruncate(fd, _DATA_OFFSET + capacity)
+            self.__map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        if size < _DATA_OFFSET:
+            struct.pack_into("<Q", self.__map, _CAPACITY_OFFSET, capacity)
+        self.__capacity: int = struct.unpack_from("<Q", self.__map, _CAPACITY_OFFSET)[0]
+        if self.__capacity == 0:
+            # Attached between the creation of the file and the initialization of its header
+            self.__map.close()
+            raise FileNotFoundError(f"Ring {file_name} is not initialized yet")
+        if capacity > 0 and capacity != self.__capacity:
+            logging.getLogger(self.name).info(
+                f"Keeping the capacity {self.__capacity} of the existing ring {file_name} instead of {capacity}")
+        self.__view = memoryview(self.__map)[_DATA_OFFSET:_DATA_OFFSET + self.__capacity]
+        # The producer accumulates records here and publishes them at once
+        self.__write_position: int = self.__load(_WRITE_POSITION_OFFSET)
+
+    @classmethod
+    def attach(cls, file_name: str) -> Optional["FsbQueueRing"]:
+        try:
+            return cls(file_name)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def capacity(self) -> int:
+        return self.__capacity
+
+    def __load(self, offset: int) -> int:
+        value: int = struct.unpack_from("<Q", self.__map, offset)[0]
+        return value
+
+    def __store(self, offset: int, value: int):
+        struct.pack_into("<Q", self.__map, offset, value)
+
+    def __copy_in(self, position: int, data: bytes):
+        view = memoryview(data)
+        start = position % self.__capacity
+        first = min(len(view), self.__capacity - start)
+        self.__view[start:start + first] = view[:first]
+        if first < len(view):
+            self.__view[:len(view) - first] = view[first:]
+
+    def __copy_out(self, position: int, size: int) -> bytes:
+        start = position % self.__capacity
+        first = min(size, self.__capacity - start)
+        b = bytes(self.__view[start:start + first])
+        if first < size:
+            b += bytes(self.__view[:size - first])
+        return b
+
+    def append(self, payload: bytes) -> bool:
+        """Copies a record into the ring, returns False when it does not fit. Invisible until published."""
+        size = _LENGTH_SIZE + len(payload)
+        if self.__write_position + size - self.__load(_READ_POSITION_OFFSET) > self.__capacity:
+            return False
+        self.__copy_in(self.__write_position, struct.pack("<i", len(payload)))
+        self.__copy_in(self.__write_position + _LENGTH_SIZE, payload)
+        self.__write_position += size
+        return True
+
+    def publish(self):
+        self.__store(_WRITE_POSITION_OFFSET, self.__write_position)
+
+    def read(self) -> Optional[bytes]:
+        """Returns the oldest published record and frees its room, None when the ring is empty."""
+        read_position = self.__load(_READ_POSITION_OFFSET)
+        if read_position >= self.__load(_WRITE_POSITION_OFFSET):
+            return None
+        length = struct.unpack("<i", self.__copy_out(read_position, _LENGTH_SIZE))[0]
+        payload = self.__copy_out(read_position + _LENGTH_SIZE, length)
+        self.__store(_READ_POSITION_OFFSET, read_position + _LENGTH_SIZE + length)
+        return payload
+
+    def is_empty(self) -> bool:
+        return self.__load(_READ_POSITION_OFFSET) >= self.__load(_WRITE_POSITION_OFFSET)
+
+    def consumed_message_id(self) -> int:
+        """The id of the last record the consumer took, from the ring or from the segments."""
+        return self.__load(_CONSUMED_MESSAGE_ID_OFFSET)
+
+    def set_consumed_message_id(self, message_id: int):
+        self.__store(_CONSUMED_MESSAGE_ID_OFFSET, message_id)
+
+    def close(self):
+        self.__view.release()
+        self.__map.close()
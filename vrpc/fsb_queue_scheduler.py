@@ -0,0 +1,123 @@
+import collections
+import threading
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+
+class FsbQueueScheduler:
+    """Deficit round robin over the channels that have pending data.
+
+    Channels are only visited once marked ready, by a notification naming them or because their last
+    visit did not drain them. Each visit of a new round adds ``weight`` records to the deficit of the
+    channel, which is then served for as many records. A channel is handed to a single reader at a
+    time, a notification arriving during its visit keeps it ready afterwards so no wakeup is lost.
+    Readers with nothing ready block on one condition.
+    """
+    def __init__(self) -> None:
+        self.name = "FsbQueueScheduler"
+        self.__condition = threading.Condition()
+        self.__weights: Dict[str, int] = {}
+        self.__deficits: Dict[str, int] = {}
+        self.__ready: Deque[str] = collections.deque()
+        self.__queued: Set[str] = set()
+        self.__in_service: Set[str] = set()
+        self.__notified: Set[str] = set()
+        self.__is_stopped: bool = False
+        self.__listeners: List[Callable[[], None]] = []
+
+    def add_listener(self, listener: Callable[[], None]):
+        """Calls ``listener`` whenever a channel becomes ready or the scheduler stops, for readers waiting on
+        something else than ``wait``. It is called with the scheduler locked and must not block.
+        """
+        with self.__condition:
+            self.__listeners.append(listener)
+
+    def __wake_up(self):
+        self.__condition.notify()
+        for listener in self.__listeners:
+            listener()
+
+    def add(self, channel_id: str, weight: int = 1):
+        """Schedules a new channel, ready until a first visit finds it empty."""
+        with self.__condition:
+            self.__weights.setdefault(channel_id, max(weight, 1))
+            self.__deficits.setdefault(channel_id, 0)
+        self.mark_ready(channel_id)
+
+    def set_weight(self, channel_id: str, weight: int):
+        with self.__condition:
+            self.__weights[channel_id] = max(weight, 1)
+
+    def mark_ready(self, channel_id: str):
+        with self.__condition:
+            self.__mark_ready(channel_id)
+
+    def mark_all_ready(self, channel_ids: Optional[Iterable[str]] = None):
+        with self.__condition:
+            for channel_id in list(self.__weights) if channel_ids is None else channel_ids:
+                self.__mark_ready(channel_id)
+
+    def __mark_ready(self, channel_id: str):
+        if channel_id not in self.__weights:
+            return
+        if channel_id in self.__in_service:
+            self.__notified.add(channel_id)
+        elif channel_id not in self.__queued:
+            self.__queued.add(channel_id)
+            self.__ready.append(channel_id)
+            self.__wake_up()
+
+    def is_stopped(self) -> bool:
+        return self.__is_stopped
+
+    def take(self) -> Optional[Tuple[str, int]]:
+        """Hands out the next ready channel with the number of records it may be served, None when none is ready.
+
+        The channel must be given back with ``release``.
+        """
+        with self.__condition:
+            if not self.__ready:
+                return None
+            channel_id = self.__ready.popleft()
+            self.__queued.discard(channel_id)
+            self.__in_service.add(channel_id)
+            self.__notified.discard(channel_id)
+            if self.__deficits[channel_id] <= 0:
+                self.__deficits[channel_id] += self.__weights[channel_id]
+            return (channel_id, self.__deficits[channel_id])
+
+    def release(self, channel_id: str, served: int, is_drained: bool):
+        """Gives back a channel taken with ``take`` after ``served`` records were read from it."""
+        with self.__condition:
+            self.__in_service.discard(channel_id)
+            if channel_id not in self.__weights:
+                return
+            self.__deficits[channel_id] -= served
+            is_notified = channel_id in self.__notified
+            self.__notified.discard(channel_id)
+            if is_drained:
+                # An idle channel does not save up credit for later
+                self.__deficits[channel_id] = 0
+                if not is_notified:
+                    return
+            if channel_id in self.__queued:
+                return
+            self.__queued.add(channel_id)
+            if self.__deficits[channel_id] > 0:
+                # What is left of its quantum is served before the round moves on
+                self.__ready.appendleft(channel_id)
+            else:
+                self.__ready.append(channel_id)
+            self.__wake_up()
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """Waits until a channel is ready, returns False on timeout or once stopped."""
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.__ready or self.__is_stopped,
+                                             timeout) and not self.__is_stopped
+
+    def stop(self):
+        with self.__condition:
+            self.__is_stopped = True
+            self.__condition.notify_all()
+            for listener in self.__listeners:
+                listener()